@@ -0,0 +1,123 @@
+import pickle
+import sys
+import timeit
+import tracemalloc
+
+from dataclasses import dataclass
+from typing import Dict, List
+
+from ipystate.impl.memo import ChunkedFile, MemoryChunk
+
+# total size of a component in the benchmark, MiB
+DEFAULT_SIZE_MB = 2048
+VARIABLE_SIZE_MB = 256
+# the component of small variables is this times smaller
+SMALL_VARIABLES_SIZE_RATIO = 16
+
+
+class BytearrayChunkedFile:
+    """
+    In-memory ChunkedFile of the previous revision: frames are copied into a bytearray per chunk
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._ba = bytearray()
+
+    def write(self, inp) -> int:
+        self._ba.extend(inp)
+        return len(inp)
+
+    def current_chunk(self):
+        return MemoryChunk([self._ba])
+
+    def reset(self) -> None:
+        self._ba = bytearray()
+
+
+@dataclass
+class Metrics:
+    """Class for keeping track single component dump statistics"""
+    pref: str
+    time_ms: float
+    speed_mbs: float
+    peak_mb: float
+
+    def to_dict(self):
+        return {
+            self.pref + ' time_ms'  : self.time_ms,
+            self.pref + ' speed_mbs': self.speed_mbs,
+            self.pref + ' peak_mb'  : self.peak_mb,
+        }
+
+
+def dump_component(chunked_file_class, ns: Dict[str, object]) -> List:
+    """
+    Pickles variables to chunks of a single file, as Serializer does for a component
+    """
+    cf = chunked_file_class(spill_threshold=float('inf'))
+    pickler = pickle.Pickler(cf, protocol=4)
+    chunks = []
+    for value in ns.values():
+        pickler.dump(value)
+        chunks.append(cf.current_chunk())
+        cf.reset()
+    return chunks
+
+
+def peak_memory_mb(f) -> float:
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def benchmark_on_namespace(run_prefix: str, chunked_file_class, ns: Dict[str, object], size_mb: float):
+    times = timeit.repeat(lambda: dump_component(chunked_file_class, ns), number=1, repeat=3)
+    time_s = min(times)
+    peak_mb = peak_memory_mb(lambda: dump_component(chunked_file_class, ns))
+    return Metrics(run_prefix, time_ms=time_s * 1000., speed_mbs=size_mb / time_s, peak_mb=peak_mb)
+
+
+def chunked_file_benchmark_helper(chunked_file_class, size_mb: int):
+    variables = max(size_mb // VARIABLE_SIZE_MB, 1)
+    # distinct objects, so the pickler memo does not shorten the dump
+    ns = {f'blob{i}': bytes([i % 256]) * (size_mb * 2 ** 20 // variables) for i in range(variables)}
+    yield from benchmark_on_namespace('large frames', chunked_file_class, ns, size_mb).to_dict().items()
+    del ns
+
+    # small lists take several times more memory than their pickles of about 256 bytes
+    size_mb = max(size_mb // SMALL_VARIABLES_SIZE_RATIO, 1)
+    ns = {f'v{i}': list(range(i, i + 50)) for i in range(size_mb * 2 ** 20 // 256)}
+    yield from benchmark_on_namespace('many small variables', chunked_file_class, ns, size_mb).to_dict().items()
+
+
+def chunked_file_benchmark(chunked_file_class, size_mb: int = DEFAULT_SIZE_MB, stdout=True):
+    res = {}
+    for metric_name, metric_value in chunked_file_benchmark_helper(chunked_file_class, size_mb):
+        if stdout:
+            print(f'{metric_name}: {metric_value:.3f}')
+        res[metric_name] = metric_value
+    return res
+
+
+if __name__ == '__main__':
+    # usage: chunked_file_benchmark.py [size_mb]
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB
+
+    print("Bytearray chunks metrics:")
+    baseline_metrics = chunked_file_benchmark(BytearrayChunkedFile, size_mb)
+    print("-" * 80)
+    print()
+
+    print("Zero-copy chunks metrics:")
+    metrics = chunked_file_benchmark(ChunkedFile, size_mb)
+    print("-" * 80)
+    print()
+
+    print("Speedup:")
+    for name in metrics.keys():
+        if name.endswith('time_ms'):
+            print(f"{name.replace('time_ms', 'speedup')}: {baseline_metrics[name] / metrics[name]:.2f}x")
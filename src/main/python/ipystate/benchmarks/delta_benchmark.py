@@ -0,0 +1,83 @@
+import os
+import pickle
+import sys
+import timeit
+
+from dataclasses import dataclass
+from typing import Callable, Dict
+
+from ipystate.impl.delta import apply_delta, encode_delta
+
+DEFAULT_SIZE = 10 ** 6
+
+
+@dataclass
+class Metrics:
+    """Class for keeping track single delta encoding statistics"""
+    pref: str
+    ratio: float
+    encode_ms: float
+    encode_mbs: float
+    apply_ms: float
+
+    def to_dict(self):
+        return {
+            self.pref + ' ratio'     : self.ratio,
+            self.pref + ' encode_ms' : self.encode_ms,
+            self.pref + ' encode_mbs': self.encode_mbs,
+            self.pref + ' apply_ms'  : self.apply_ms,
+        }
+
+
+def benchmark_on_change(run_prefix: str, value: object, change: Callable[[object], None]) -> Metrics:
+    base = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    change(value)
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    delta = encode_delta(base, data)
+    assert apply_delta(base, delta) == data
+    encode_s = min(timeit.repeat(lambda: encode_delta(base, data), number=1, repeat=3))
+    apply_s = min(timeit.repeat(lambda: apply_delta(base, delta), number=1, repeat=3))
+    return Metrics(run_prefix, ratio=len(data) / len(delta), encode_ms=encode_s * 1000.,
+                   encode_mbs=len(data) / 1e6 / encode_s, apply_ms=apply_s * 1000.)
+
+
+def delta_benchmark_helper(size: int):
+    def edit_list(values):
+        values.insert(size // 3, 'inserted')
+        values[size // 2] = -1
+        del values[-size // 10:-size // 10 + 100]
+
+    yield benchmark_on_change('int list', list(range(size)), edit_list)
+
+    def edit_dict(d):
+        d['0'] = None
+        d['new'] = [0]
+        del d[str(size // 20)]
+
+    yield benchmark_on_change('dict', {str(i): [i, str(i)] for i in range(size // 10)}, edit_dict)
+
+    def train_step(model):
+        # a few layers of a model change, e.g. fine-tuning
+        for layer in list(model)[-2:]:
+            model[layer] = [w * 0.9 for w in model[layer]]
+
+    model = {f'layer{i}': [float(j) for j in range(size // 20)] for i in range(20)}
+    yield benchmark_on_change('model weights', model, train_step)
+
+    yield benchmark_on_change('random bytes', bytearray(os.urandom(size * 5)),
+                              lambda b: b.__setitem__(slice(size, size + 100), b'x' * 10))
+
+
+def delta_benchmark(size: int = DEFAULT_SIZE, stdout=True) -> Dict[str, float]:
+    res = {}
+    for metrics in delta_benchmark_helper(size):
+        for metric_name, metric_value in metrics.to_dict().items():
+            if stdout:
+                print(f'{metric_name}: {metric_value:.3f}')
+            res[metric_name] = metric_value
+    return res
+
+
+if __name__ == '__main__':
+    # usage: delta_benchmark.py [size]
+    delta_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE)
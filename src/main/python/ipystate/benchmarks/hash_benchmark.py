@@ -0,0 +1,87 @@
+import pickle
+import sys
+import timeit
+
+from dataclasses import dataclass
+from typing import Dict
+
+from ipystate.impl.hashing import default_hash_functions, default_sample_functions, hash_chunk, xxhash
+from ipystate.impl.memo import ChunkedFile
+
+# size of every hashed value, MiB
+DEFAULT_SIZE_MB = 1024
+
+
+@dataclass
+class Metrics:
+    """Class for keeping track single value hashing statistics"""
+    pref: str
+    hash_ms: float
+    hash_mbs: float
+    pickled_mbs: float
+    streamed_mbs: float
+    sample_ms: float
+
+    def to_dict(self):
+        return {
+            self.pref + ' hash_ms'    : self.hash_ms,
+            self.pref + ' hash_mbs'   : self.hash_mbs,
+            self.pref + ' pickled_mbs': self.pickled_mbs,
+            self.pref + ' streamed_mbs': self.streamed_mbs,
+            self.pref + ' sample_ms'  : self.sample_ms,
+        }
+
+
+def pickle_and_hash(value: object, streaming: bool = False) -> bytes:
+    """
+    Change detection at the pickled stage, which values without a hash function wait for.
+    Streaming hashes the pickle as it is written instead of reading it again
+    """
+    cf = ChunkedFile(spill_threshold=float('inf'), hash_chunks=streaming)
+    pickle.dump(value, cf, protocol=pickle.HIGHEST_PROTOCOL)
+    return hash_chunk(cf.current_chunk())
+
+
+def benchmark_on_value(run_prefix: str, value: object, size_mb: float) -> Metrics:
+    hash_fun = default_hash_functions()[type(value)]
+    hash_s = min(timeit.repeat(lambda: hash_fun(value), number=1, repeat=3))
+    pickled_s = min(timeit.repeat(lambda: pickle_and_hash(value), number=1, repeat=3))
+    streamed_s = min(timeit.repeat(lambda: pickle_and_hash(value, streaming=True), number=1, repeat=3))
+    # pre-checks of values hashed by blocks
+    sample_fun = default_sample_functions().get(type(value))
+    sample_s = min(timeit.repeat(lambda: sample_fun(value), number=1, repeat=3)) if sample_fun else float('nan')
+    return Metrics(run_prefix, hash_ms=hash_s * 1000., hash_mbs=size_mb / hash_s, pickled_mbs=size_mb / pickled_s,
+                   streamed_mbs=size_mb / streamed_s, sample_ms=sample_s * 1000.)
+
+
+def hash_benchmark_helper(size_mb: int):
+    nbytes = size_mb * 2 ** 20
+    yield benchmark_on_value('bytearray', bytearray(nbytes), size_mb)
+
+    import numpy as np
+    array = np.random.default_rng(0).random(nbytes // 8)
+    yield benchmark_on_value('ndarray', array, size_mb)
+    # every other column, hashed from a copy
+    yield benchmark_on_value('strided ndarray', array.reshape(-1, 2)[:, 0], size_mb / 2)
+
+    import pyarrow as pa
+    yield benchmark_on_value('arrow table', pa.table({'a': array}), size_mb)
+
+    import pandas as pd
+    yield benchmark_on_value('dataframe', pd.DataFrame(array.reshape(-1, 8)), size_mb)
+
+
+def hash_benchmark(size_mb: int = DEFAULT_SIZE_MB, stdout=True) -> Dict[str, float]:
+    res = {}
+    for metrics in hash_benchmark_helper(size_mb):
+        for metric_name, metric_value in metrics.to_dict().items():
+            if stdout:
+                print(f'{metric_name}: {metric_value:.3f}')
+            res[metric_name] = metric_value
+    return res
+
+
+if __name__ == '__main__':
+    # usage: hash_benchmark.py [size_mb]
+    print(f"Hash: {'xxh3' if xxhash is not None else 'blake2b'}")
+    hash_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB)
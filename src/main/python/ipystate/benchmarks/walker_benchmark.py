@@ -1,6 +1,7 @@
 import cloudpickle as pickle
 import logging
 import timeit
+import tracemalloc
 import sys
 
 from dataclasses import dataclass
@@ -19,14 +20,30 @@ class Metrics:
     pref: str
     time_ms: float
     speed_mbs: float
+    peak_mb: float
 
     def to_dict(self):
         return {
             self.pref + ' time_ms'  : self.time_ms,
             self.pref + ' speed_mbs': self.speed_mbs,
+            self.pref + ' peak_mb'  : self.peak_mb,
         }
 
 
+def peak_memory_mb(f) -> float:
+    """
+    Peak memory allocated through the Python allocators during a single f call.
+    Memory of C++ containers, e.g. in walkers of older revisions, is not traced
+    """
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6
+
+
 def benchmark_on_namespace(run_prefix: str, walker, ns: Dict[str, any]):
     sz = asizeof.asizeof(ns)
     try:
@@ -36,7 +53,8 @@ def benchmark_on_namespace(run_prefix: str, walker, ns: Dict[str, any]):
         logging.exception('An exception occurred:', e)
         raise e
     speed_mbs = (sz / 1e6) / time_s
-    return Metrics(run_prefix, speed_mbs=speed_mbs, time_ms=time_s * 1000.)
+    peak_mb = peak_memory_mb(lambda: walker.walk(ns))
+    return Metrics(run_prefix, speed_mbs=speed_mbs, time_ms=time_s * 1000., peak_mb=peak_mb)
 
 
 def walker_benchmark_helper(walker) -> Dict[str, float]:
@@ -62,14 +80,18 @@ def walker_benchmark_helper(walker) -> Dict[str, float]:
     recursive_dict = {}
     for _ in range(DEFAULT_SIZE):
         recursive_dict = {'dict': recursive_dict}
-    metrics = benchmark_on_namespace('recursive dict', walker, {'d': d}).to_dict()
+    metrics = benchmark_on_namespace('recursive dict', walker, {'d': recursive_dict}).to_dict()
     for name, value in metrics.items():
         yield name, value
 
+    shared = [0]
+    small_vars = {f'v{i}': [i, str(i)] if i % 10 else [i, shared] for i in range(DEFAULT_SIZE // 10)}
+    metrics = benchmark_on_namespace('many small variables', walker, small_vars).to_dict()
+    for name, value in metrics.items():
+        yield name, value
 
-def walker_benchmark(walker, stdout=True):
-    sys.setrecursionlimit(DEFAULT_SIZE + 5)
 
+def walker_benchmark(walker, stdout=True):
     res = {}
     for metric_name, metric_value in walker_benchmark_helper(walker):
         if stdout:
@@ -79,10 +101,41 @@ def walker_benchmark(walker, stdout=True):
     return {key: res[key] for key in order}
 
 
+def load_walker(path: str):
+    """
+    Compiles a walker source file, e.g. walker.pyx of a previous revision, and returns its Walker class
+    """
+    import importlib
+    import os
+    import shutil
+    import tempfile
+    import pyximport
+
+    pyximport.install(language_level=3)
+    build_dir = tempfile.mkdtemp()
+    shutil.copy(path, os.path.join(build_dir, 'baseline_walker.pyx'))
+    sys.path.insert(0, build_dir)
+    try:
+        return importlib.import_module('baseline_walker').Walker
+    finally:
+        sys.path.remove(build_dir)
+
+
+def walker_speedup(baseline: Dict[str, float], candidate: Dict[str, float]) -> Dict[str, float]:
+    return {
+        name.replace('time_ms', 'speedup'): baseline[name] / candidate[name]
+        for name in candidate.keys() if name.endswith('time_ms') and name in baseline
+    }
+
+
 if __name__ == '__main__':
     class PickleWalker:
         def walk(self, ns):
-            return pickle.dumps(ns)
+            try:
+                return pickle.dumps(ns)
+            except pickle.pickle.PicklingError:
+                # pickle is recursive, unlike the walker
+                return None
 
     print("Pickle metrics:")
     print(walker_benchmark(walker=PickleWalker()))
@@ -90,6 +143,25 @@ if __name__ == '__main__':
     print()
 
     print("Walker metrics:")
-    print(walker_benchmark(walker=Walker(getLogger())))
+    walker = Walker(getLogger())
+    walker.enable_full_walk()
+    walker_metrics = walker_benchmark(walker=walker)
+    print(walker_metrics)
     print("-" * 80)
     print()
+
+    # usage: walker_benchmark.py [baseline_walker.pyx]
+    if len(sys.argv) > 1:
+        print("Baseline walker metrics:")
+        baseline_walker = load_walker(sys.argv[1])(getLogger())
+        baseline_walker.enable_full_walk()
+        baseline_metrics = walker_benchmark(walker=baseline_walker)
+        print(baseline_metrics)
+        print("-" * 80)
+        print()
+
+        print("Walker speedup:")
+        for metric_name, metric_value in walker_speedup(baseline_metrics, walker_metrics).items():
+            print(f'{metric_name}: {metric_value:.2f}x')
+        print("-" * 80)
+        print()
@@ -1,8 +1,12 @@
 from abc import abstractmethod
 
 from .decl import VarDecl
+from .impl.chunkstore import ChunkRef
+from .impl.compression import decompressed
+from .impl.delta import apply_delta
+from .utils import StreamingUtils
 from .serialization import Deserializer
-from typing import BinaryIO, Iterable, Set, Tuple
+from typing import BinaryIO, Dict, Iterable, List, Set, Tuple
 
 class AtomicChange:
     def __init__(self, change_id: str, deserialization: Deserializer):
@@ -30,11 +34,13 @@ class RemoveAtomicChange(AtomicChange):
 
 
 class PrimitiveAtomicChange(AtomicChange):
-    def __init__(self, change_id: str, var: VarDecl, payload: BinaryIO, deserialization: Deserializer):
+    def __init__(self, change_id: str, var: VarDecl, payload: BinaryIO, deserialization: Deserializer,
+                 out_of_band_buffers: Iterable[BinaryIO] = ()):
         super().__init__(change_id, deserialization)
         self._var = var
         self._name = var.name()
         self._payload = payload
+        self._out_of_band_buffers = list(out_of_band_buffers)
 
     def var(self) -> VarDecl:
         return self._var
@@ -42,6 +48,9 @@ class PrimitiveAtomicChange(AtomicChange):
     def payload(self) -> BinaryIO:
         return self._payload
 
+    def out_of_band_buffers(self) -> List[BinaryIO]:
+        return list(self._out_of_band_buffers)
+
     def _do_apply(self, ns: 'Namespace') -> None:
         loaded = self._deserialization.load(self._payload)
         value = loaded.variables().get(self._name)
@@ -52,11 +61,14 @@ class PrimitiveAtomicChange(AtomicChange):
 
 class ComponentAtomicChange(AtomicChange):
     def __init__(self, change_id: str, all_vars: Set[VarDecl], serialized_vars: Iterable[Tuple[str, BinaryIO]], non_serialized_vars: Set[str],
-                 deserialization: Deserializer):
+                 deserialization: Deserializer, out_of_band_buffers: Dict[str, List[BinaryIO]] = None,
+                 codecs: Dict[str, str] = None):
         super().__init__(change_id, deserialization)
         self._all_vars = set(all_vars)
         self._serialized_vars = list(serialized_vars)
         self._non_serialized_vars = set(non_serialized_vars)
+        self._out_of_band_buffers = dict(out_of_band_buffers or {})
+        self._codecs = dict(codecs or {})
 
     def all_vars(self) -> Set[VarDecl]:
         return set(self._all_vars)
@@ -67,6 +79,24 @@ class ComponentAtomicChange(AtomicChange):
     def non_serialized_vars(self) -> Set[str]:
         return set(self._non_serialized_vars)
 
+    def out_of_band_buffers(self) -> Dict[str, List[BinaryIO]]:
+        return {name: list(buffers) for name, buffers in self._out_of_band_buffers.items()}
+
+    def codecs(self) -> Dict[str, str]:
+        """
+        Codecs of compressed payloads by variable name, and of compressed out-of-band buffers by f'{name}#{i}';
+        decompressed() reads them back
+        """
+        return dict(self._codecs)
+
+    def digests(self) -> Set[str]:
+        """
+        Digests of the chunks the change refers to, if its payloads are in a ChunkStore
+        """
+        payloads = [payload for _, payload in self._serialized_vars]
+        payloads.extend(buffer for buffers in self._out_of_band_buffers.values() for buffer in buffers)
+        return {payload.digest() for payload in payloads if isinstance(payload, ChunkRef)}
+
     def _do_apply(self, ns: 'Namespace') -> None:
         loaded = self._deserialization.load(self._payload)
         variables = loaded.variables()
@@ -78,6 +108,38 @@ class ComponentAtomicChange(AtomicChange):
                 ns.unmark_dirty(name)
 
 
+class DeltaComponentAtomicChange(ComponentAtomicChange):
+    """
+    Component change where payloads of the variables in delta_bases are deltas
+    against the full payloads of these variables sent before
+    """
+
+    def __init__(self, change_id: str, all_vars: Set[VarDecl], serialized_vars: Iterable[Tuple[str, BinaryIO]],
+                 non_serialized_vars: Set[str], deserialization: Deserializer,
+                 out_of_band_buffers: Dict[str, List[BinaryIO]] = None, delta_bases: Dict[str, str] = None,
+                 codecs: Dict[str, str] = None):
+        super().__init__(change_id, all_vars, serialized_vars, non_serialized_vars, deserialization,
+                         out_of_band_buffers, codecs)
+        self._delta_bases = dict(delta_bases or {})
+
+    def delta_bases(self) -> Dict[str, str]:
+        """
+        Variable names to chunk_digest of the full payloads their deltas apply to
+        """
+        return dict(self._delta_bases)
+
+    def full_payload(self, name: str, base: BinaryIO) -> bytes:
+        """
+        Decompressed full payload of the variable, given the decompressed full payload of its delta base
+        """
+        payload = dict(self._serialized_vars)[name]
+        codec = self._codecs.get(name)
+        payload = decompressed(payload, codec).read() if codec else StreamingUtils.to_bytes(payload)
+        if name not in self._delta_bases:
+            return payload
+        return apply_delta(StreamingUtils.to_bytes(base), payload)
+
+
 class ComponentStructure(AtomicChange):
     '''
     Unchanged component structure info
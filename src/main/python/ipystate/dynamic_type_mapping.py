@@ -1,5 +1,6 @@
 from abc import ABC
-from collections import defaultdict, MutableMapping
+from collections import defaultdict
+from collections.abc import MutableMapping
 from typing import Mapping, Tuple, Union, VT_co
 
 
@@ -9,7 +10,6 @@ class DynamicTypeMapping(MutableMapping, ABC):
     def __init__(self, data: Mapping[Key, VT_co] = ()):
         self._module_name_value = defaultdict(dict)
         for item in data:
-            print(item)
             self[item] = data[item]
 
     def __getitem__(self, key: Key):
@@ -20,8 +20,9 @@ class DynamicTypeMapping(MutableMapping, ABC):
             module, name = key
         else:
             raise TypeError(key)
-        name_value = self._module_name_value[module]
-        if name not in name_value:
+        # lookups do not insert into the defaultdict, so concurrent readers do not mutate the mapping
+        name_value = self._module_name_value.get(module)
+        if name_value is None or name not in name_value:
             raise KeyError(key)
         return name_value[name]
 
@@ -49,7 +50,7 @@ class DynamicTypeMapping(MutableMapping, ABC):
         return ((module, name) for module, name_value in self._module_name_value.items() for name in name_value)
 
     def __len__(self):
-        return sum(map(len, self._module_name_value), 0)
+        return sum(map(len, self._module_name_value.values()), 0)
 
     def __repr__(self):
         return repr(self._module_name_value)
@@ -0,0 +1,259 @@
+import ast
+import sys
+import threading
+from collections import OrderedDict
+from enum import Enum
+from typing import Dict, FrozenSet, Iterable, Mapping, Optional
+
+from ipystate.impl.hashing import new_hash
+
+try:
+    from IPython.core.inputtransformer2 import TransformerManager
+except ImportError:
+    TransformerManager = None
+
+# analyses of this many cell sources are cached
+CELL_ANALYSIS_CACHE_SIZE = 1024
+# builtins which size, test or identify their arguments without running code of the items of builtin containers
+SIZING_CALLABLES = frozenset(('bool', 'callable', 'dir', 'hasattr', 'id', 'isinstance', 'issubclass', 'len', 'type'))
+# builtins which convert their arguments, e.g. to strings, running code of every value they reach
+FORMATTING_CALLABLES = frozenset(('abs', 'display', 'float', 'format', 'hash', 'int', 'print', 'repr', 'round', 'str'))
+# builtins which do not mutate arguments of builtin types
+READ_ONLY_CALLABLES = SIZING_CALLABLES | FORMATTING_CALLABLES
+# exact types of values which formatting, e.g. by FORMATTING_CALLABLES or displays, runs no other code for
+FORMATTED_TYPES = frozenset((bool, bytes, complex, float, int, str, type(None)))
+# exact types of values which SIZING_CALLABLES and tests run no other code for
+SIZED_TYPES = FORMATTED_TYPES | frozenset((bytearray, dict, frozenset, list, set, tuple))
+
+# nodes of closed cells: rebinding and deleting names, calls of READ_ONLY_CALLABLES, tests and displays of values;
+# anything else, e.g. attribute or item access and operators, may run code of the values. Calls, tests and displays
+# run dunders of the values too, so the cells are closed only for values of SIZED_TYPES and FORMATTED_TYPES
+_CLOSED_NODES = (
+    ast.Module, ast.Interactive, ast.Expr, ast.Assign, ast.Delete, ast.Pass, ast.If, ast.IfExp, ast.BoolOp, ast.And,
+    ast.Or, ast.Assert, ast.Name, ast.Load, ast.Store, ast.Del, ast.Constant, ast.Call, ast.keyword, ast.JoinedStr,
+    ast.FormattedValue, ast.Tuple, ast.List, ast.Set, ast.Dict,
+)
+if sys.version_info < (3, 8):
+    _CLOSED_NODES += (ast.Num, ast.Str, ast.Bytes, ast.NameConstant, ast.Ellipsis)
+# expressions which pass the values of their operands on, which are read only if the expression is
+_PASSING_NODES = (ast.BoolOp, ast.Tuple, ast.List, ast.Set, ast.Dict)
+
+
+class Access(Enum):
+    READ_ONLY = 0
+    REBOUND = 1
+    # e.g. aliased, by a method call, an attribute or item assignment, or passed to an unknown callable
+    MUTATED = 2
+
+
+class CellAccesses:
+    """
+    Names a cell refers to by how it accesses them; a name accessed in several ways has the strongest access
+    """
+
+    def __init__(self, accesses: Dict[str, Access], closed: bool, builtins: FrozenSet[str],
+                 sized: FrozenSet[str] = frozenset(), formatted: FrozenSet[str] = frozenset()):
+        self._accesses = accesses
+        self._closed = closed
+        self._builtins = builtins
+        self._sized = sized
+        self._formatted = formatted
+
+    def accesses(self) -> Dict[str, Access]:
+        return dict(self._accesses)
+
+    def closed(self) -> bool:
+        """
+        Whether the cell does nothing but rebind and delete names, call READ_ONLY_CALLABLES, test and display
+        values, so nothing it runs mutates the names it only reads, as long as their values are of builtin types
+        """
+        return self._closed
+
+    def builtins(self) -> FrozenSet[str]:
+        """
+        READ_ONLY_CALLABLES the cell calls, which the namespace must not shadow
+        """
+        return self._builtins
+
+    def read_only(self) -> FrozenSet[str]:
+        """
+        Names the cell does not change, empty unless the cell is closed
+        """
+        if not self._closed:
+            return frozenset()
+        return frozenset(name for name, access in self._accesses.items() if access == Access.READ_ONLY)
+
+    def sized(self) -> FrozenSet[str]:
+        """
+        Names which values the cell sizes or tests, running their dunders
+        """
+        return self._sized
+
+    def formatted(self) -> FrozenSet[str]:
+        """
+        Names which values the cell formats, e.g. displays or prints, running dunders of all values they reach
+        """
+        return self._formatted
+
+
+class _Classifier:
+    def __init__(self, tree: ast.AST):
+        self._parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+        self.accesses = dict()
+        self.closed = True
+        self.builtins = set()
+        self.sized = set()
+        self.formatted = set()
+        for node in ast.walk(tree):
+            self._visit(node)
+
+    def _access(self, name: str, access: Access) -> None:
+        previous = self.accesses.get(name)
+        if previous is None or previous.value < access.value:
+            self.accesses[name] = access
+
+    def _visit(self, node: ast.AST) -> None:
+        if self.closed and not self._closed(node):
+            self.closed = False
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            self._access(node.name, Access.REBOUND)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                self._access((alias.asname or alias.name).partition('.')[0], Access.REBOUND)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            for name in node.names:
+                self._access(name, Access.MUTATED)
+        elif isinstance(node, ast.Name):
+            self._visit_name(node)
+
+    @staticmethod
+    def _closed(node: ast.AST) -> bool:
+        if not isinstance(node, _CLOSED_NODES):
+            return False
+        if isinstance(node, (ast.Assign, ast.Delete)):
+            return all(isinstance(target, ast.Name) for target in node.targets)
+        if isinstance(node, ast.Call):
+            return isinstance(node.func, ast.Name) and node.func.id in READ_ONLY_CALLABLES
+        if isinstance(node, ast.keyword):
+            # **kwargs unpacks a mapping
+            return node.arg is not None
+        if isinstance(node, ast.Dict):
+            return None not in node.keys
+        if isinstance(node, (ast.Tuple, ast.List)):
+            return isinstance(node.ctx, ast.Load)
+        return True
+
+    def _visit_name(self, node: ast.Name) -> None:
+        if not isinstance(node.ctx, ast.Load):
+            parent = self._parents.get(node)
+            # in-place operators mutate mutable values
+            inplace = isinstance(parent, ast.AugAssign) and parent.target is node
+            self._access(node.id, Access.MUTATED if inplace else Access.REBOUND)
+            return
+
+        parent = self._parents.get(node)
+        if isinstance(parent, ast.Call) and parent.func is node and node.id in READ_ONLY_CALLABLES:
+            self.builtins.add(node.id)
+            return
+        formatted = self._reads(node)
+        if formatted is not None:
+            self._access(node.id, Access.READ_ONLY)
+            if formatted:
+                self.formatted.add(node.id)
+            else:
+                self.sized.add(node.id)
+        else:
+            # the value is passed somewhere, e.g. assigned, aliased or called, and may be mutated there
+            self._access(node.id, Access.MUTATED)
+
+    def _reads(self, node: ast.AST) -> Optional[bool]:
+        """
+        Whether the value of the expression is formatted, False if it is only sized or tested,
+        None if it is passed anywhere else
+        """
+        parent = self._parents.get(node)
+        if isinstance(parent, _PASSING_NODES) or isinstance(parent, ast.IfExp) and parent.test is not node:
+            return self._reads(parent)
+        if isinstance(parent, (ast.Expr, ast.FormattedValue)):
+            return True
+        if isinstance(parent, ast.Call):
+            if parent.func is node or not isinstance(parent.func, ast.Name) \
+                    or parent.func.id not in READ_ONLY_CALLABLES:
+                return None
+            return parent.func.id in FORMATTING_CALLABLES
+        if isinstance(parent, ast.keyword):
+            return self._reads(parent)
+        if isinstance(parent, (ast.If, ast.IfExp, ast.Assert)) and parent.test is node:
+            return False
+        return None
+
+
+class CellAnalyzer:
+    """
+    Finds how cells access names by their sources, without running them. IPython syntax is transformed
+    to Python first if IPython is installed. Analyses are cached by source hash
+    """
+
+    def __init__(self, cache_size: int = CELL_ANALYSIS_CACHE_SIZE):
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._transformer = TransformerManager() if TransformerManager is not None else None
+
+    def analyze(self, source: str) -> Optional[CellAccesses]:
+        """
+        None if the source could not be parsed
+        """
+        h = new_hash()
+        h.update(source.encode('utf-8', 'surrogatepass'))
+        key = h.digest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        accesses = self._analyze(source)
+        with self._lock:
+            self._cache[key] = accesses
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return accesses
+
+    def _analyze(self, source: str) -> Optional[CellAccesses]:
+        try:
+            if self._transformer is not None:
+                source = self._transformer.transform_cell(source)
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):
+            return None
+        classifier = _Classifier(tree)
+        return CellAccesses(classifier.accesses, classifier.closed, frozenset(classifier.builtins),
+                            frozenset(classifier.sized), frozenset(classifier.formatted))
+
+    def read_only(self, sources: Iterable[str], namespace: Mapping[str, object]) -> FrozenSet[str]:
+        """
+        Names some of the cells read and none of them changes; empty if any cell is not closed or not parsed,
+        if it calls READ_ONLY_CALLABLES the namespace shadows, or if it sizes or formats a name which any cell
+        changes or which value in the namespace is not of SIZED_TYPES or FORMATTED_TYPES respectively,
+        so it may have run any code
+        """
+        read_only = set()
+        changed = set()
+        sized = set()
+        formatted = set()
+        for source in sources:
+            accesses = self.analyze(source)
+            if accesses is None or not accesses.closed() or any(name in namespace for name in accesses.builtins()):
+                return frozenset()
+            cell_read_only = accesses.read_only()
+            read_only.update(cell_read_only)
+            changed.update(name for name in accesses.accesses() if name not in cell_read_only)
+            sized.update(accesses.sized())
+            formatted.update(accesses.formatted())
+        read_only -= changed
+        # values which are not changed are the ones the cells ran dunders of
+        for names, types in ((sized, SIZED_TYPES), (formatted, FORMATTED_TYPES)):
+            for name in names:
+                if name not in read_only or name not in namespace or type(namespace[name]) not in types:
+                    return frozenset()
+        return frozenset(read_only)
@@ -1,7 +1,11 @@
+import os
 from abc import abstractmethod
 from enum import Enum
+from typing import Hashable, List, Optional
 
 from ipystate.dynamic_type_mapping import DynamicTypeMapping
+from ipystate.impl.hashindex import HashIndex
+from ipystate.impl.hashing import BlockHashes, default_hash_functions
 
 
 class ChangedState(Enum):
@@ -14,6 +18,8 @@ class ChangedState(Enum):
 class ChangeStage(Enum):
     RAW = 0
     PICKLED = 1
+    # structural fingerprints of the walker
+    STRUCTURE = 2
 
 
 class ChangeDetector:
@@ -23,9 +29,24 @@ class ChangeDetector:
     def begin(self):
         pass
 
+    def commit(self):
+        """
+        Called once the changes found since begin() are committed, before end()
+        """
+        pass
+
     def end(self):
         pass
 
+    def state(self) -> object:
+        """
+        Picklable state to continue with, e.g. in another process
+        """
+        return None
+
+    def set_state(self, state: object) -> None:
+        pass
+
     @abstractmethod
     def update(self, stage: ChangeStage, name: str, value: object) -> ChangedState:
         pass
@@ -40,23 +61,89 @@ class DummyChangeDetector(ChangeDetector):
 
 
 class HashChangeDetector(ChangeDetector):
-    def __init__(self):
+    def __init__(self, hash_functions: DynamicTypeMapping = None, sample_functions: DynamicTypeMapping = None,
+                 index: HashIndex = None):
+        """
+        hash_functions map types to functions of their values, default_hash_functions() by default;
+        values of other types, or which hash functions raise, are UNKNOWN.
+        Values hashed by blocks before are pre-checked with sample_functions, e.g. default_sample_functions(), if set:
+        if samples of their blocks differ, values are CHANGED without being hashed. Their next update is UNKNOWN,
+        as there is no hash to compare to, so pre-checks pay off for values which change every time they are touched.
+        Hashes are loaded from the index, e.g. a SqliteHashIndex, and saved to it at commit() and set_state(),
+        so variables restored after a restart are UNCHANGED. Hashes updated between begin() and end()
+        without a commit() are rolled back, so the changes are found again. Forked processes, e.g. of background
+        snapshots, do not save, their state is saved once it is set in the parent
+        """
         super().__init__()
-        self._hashes = dict()
-        self._dispatch = DynamicTypeMapping()
+        self._dispatch = default_hash_functions() if hash_functions is None else hash_functions
+        self._sample_dispatch = sample_functions
+        self._changed_blocks = dict()
+        self._index = index
+        self._pid = os.getpid()
+        # keys updated and removed since the last save
+        self._unsaved = set()
+        self._removed = set()
+        self._hashes = index.load() if index is not None else dict()
+        # hashes and unsaved keys as of begin(), until commit()
+        self._begun = None
 
     def reset(self):
+        self._removed.update(self._hashes)
+        self._unsaved.clear()
         self._hashes = dict()
         self._raw_cache = dict()
+        self._changed_blocks = dict()
 
     def reset_raw_cache(self):
         self._raw_cache = dict()
 
+    def state(self) -> object:
+        return dict(self._hashes)
+
+    def set_state(self, state: object) -> None:
+        hashes = dict(state)
+        self._removed.update(key for key in self._hashes if key not in hashes)
+        self._unsaved.update(key for key, value in hashes.items() if self._hashes.get(key, self) != value)
+        self._hashes = hashes
+        self.save()
+
     def begin(self):
         self.reset_raw_cache()
+        self._begun = (dict(self._hashes), set(self._unsaved), set(self._removed))
+
+    def commit(self):
+        self._begun = None
+        self.save()
 
     def end(self):
         self.reset_raw_cache()
+        if self._begun is not None:
+            self._hashes, self._unsaved, self._removed = self._begun
+            self._begun = None
+            self._changed_blocks = dict()
+
+    def save(self) -> None:
+        if self._index is None or os.getpid() != self._pid:
+            return
+        if self._unsaved or self._removed:
+            self._index.save({key: self._hashes[key] for key in self._unsaved if key in self._hashes},
+                             self._removed - self._hashes.keys())
+        self._unsaved.clear()
+        self._removed.clear()
+
+    def changed_blocks(self, stage: ChangeStage, name: str) -> Optional[List[Hashable]]:
+        """
+        Blocks of a value hashed by blocks which changed at its last update, e.g. (column, row group) pairs
+        of a DataFrame; None if it was not CHANGED or if it changed as a whole, e.g. its shape did
+        """
+        return self._changed_blocks.get(str(stage) + "/" + name)
+
+    def _obviously_changed(self, hash0: object, value: object) -> bool:
+        sample_fun = self._sample_dispatch.get(type(value)) if self._sample_dispatch is not None else None
+        if sample_fun is None or not isinstance(hash0, BlockHashes) or hash0.samples() is None:
+            return False
+        samples = sample_fun(value)
+        return samples is not None and samples != (hash0.header(), hash0.samples())
 
     def _update(self, stage: ChangeStage, name: str, value: object) -> ChangedState:
         try:
@@ -65,16 +152,32 @@ class HashChangeDetector(ChangeDetector):
                 return ChangedState.UNKNOWN
 
             key = str(stage) + "/" + name
+            self._changed_blocks.pop(key, None)
+            hash0 = self._hashes.get(key)
+            if self._obviously_changed(hash0, value):
+                self._hashes[key] = None
+                self._unsaved.add(key)
+                return ChangedState.CHANGED
+
             hash1 = hash_fun(value)
 
             if key not in self._hashes:
                 self._hashes[key] = hash1
+                self._unsaved.add(key)
                 return ChangedState.NEW
 
-            hash0 = self._hashes[key]
             self._hashes[key] = hash1
+            if hash0 != hash1:
+                self._unsaved.add(key)
 
-            return ChangedState.UNCHANGED if (hash0 == hash1) else ChangedState.CHANGED
+            if hash0 is None:
+                # pre-checked, nothing to compare to
+                return ChangedState.UNKNOWN
+            if hash0 == hash1:
+                return ChangedState.UNCHANGED
+            if isinstance(hash0, BlockHashes) and isinstance(hash1, BlockHashes):
+                self._changed_blocks[key] = hash1.changed_blocks(hash0)
+            return ChangedState.CHANGED
         except Exception as e:
             # TODO log error
             return ChangedState.UNKNOWN
@@ -0,0 +1,253 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import weakref
+from abc import abstractmethod
+from typing import BinaryIO, Dict, Iterable
+
+from ipystate.impl.memo import ChunkView
+from ipystate.utils import StreamingUtils
+
+DIGEST_SIZE = 32
+
+
+def chunk_digest(payload: BinaryIO) -> str:
+    """
+    Digest of the whole payload, whatever its position is
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for buffer in StreamingUtils.buffers(payload):
+        h.update(buffer)
+    return h.hexdigest()
+
+
+class ChunkRef(ChunkView):
+    """
+    Chunk in a ChunkStore, read lazily. Pickled as the store and the digest, not as the bytes
+    """
+
+    def __init__(self, store: 'ChunkStore', digest: str, nbytes: int):
+        super().__init__(nbytes)
+        self._store = store
+        self._digest = digest
+
+    def digest(self) -> str:
+        return self._digest
+
+    def __reduce__(self):
+        return ChunkRef, (self._store, self._digest, self._nbytes)
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        return self._store.read(self._digest, offset, size)
+
+
+class ChunkStore:
+    """
+    Content-addressed storage of chunks, e.g. of pickled variables, keyed by digests of their bytes.
+    A chunk is written once however many times it is put. Chunks are reference counted:
+    collect() removes the chunks released by the last holder, unless they are retained again,
+    and saves the reference counts changed since the previous collect(); they are loaded on first use.
+    Backends implement the storage methods
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refcounts = None
+        self._released = set()
+        # digests which reference counts changed since they were saved
+        self._changed = set()
+
+    @abstractmethod
+    def _contains(self, digest: str) -> bool:
+        pass
+
+    @abstractmethod
+    def _write(self, digest: str, payload: BinaryIO) -> None:
+        """
+        Writes the payload from its start, atomically: readers see either no chunk or the whole of it
+        """
+        pass
+
+    @abstractmethod
+    def _read(self, digest: str, offset: int, size: int) -> bytes:
+        pass
+
+    @abstractmethod
+    def _remove(self, digest: str) -> None:
+        pass
+
+    def _load_refcounts(self) -> Dict[str, int]:
+        return dict()
+
+    def _save_refcounts(self, refcounts: Dict[str, int], changed: Dict[str, int]) -> None:
+        """
+        Saves the changed reference counts, zero for removed ones, out of all the refcounts
+        """
+        pass
+
+    def _counts(self) -> Dict[str, int]:
+        if self._refcounts is None:
+            self._refcounts = self._load_refcounts()
+        return self._refcounts
+
+    def put(self, payload: BinaryIO) -> ChunkRef:
+        digest = chunk_digest(payload)
+        if not self._contains(digest):
+            payload.seek(0)
+            self._write(digest, payload)
+        return ChunkRef(self, digest, payload.seek(0, io.SEEK_END))
+
+    def read(self, digest: str, offset: int, size: int) -> bytes:
+        return self._read(digest, offset, size)
+
+    def refcount(self, digest: str) -> int:
+        with self._lock:
+            return self._counts().get(digest, 0)
+
+    def retain(self, digests: Iterable[str]) -> None:
+        with self._lock:
+            refcounts = self._counts()
+            for digest in digests:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+                self._released.discard(digest)
+                self._changed.add(digest)
+
+    def release(self, digests: Iterable[str]) -> None:
+        with self._lock:
+            refcounts = self._counts()
+            for digest in digests:
+                count = refcounts.get(digest, 0) - 1
+                if count > 0:
+                    refcounts[digest] = count
+                else:
+                    refcounts.pop(digest, None)
+                    self._released.add(digest)
+                self._changed.add(digest)
+
+    def collect(self) -> int:
+        """
+        Removes released chunks, returns how many. Chunks which were put but never retained are kept,
+        e.g. they may be written by a background snapshot not applied yet
+        """
+        with self._lock:
+            released = self._released
+            self._released = set()
+            for digest in released:
+                self._remove(digest)
+            if self._changed:
+                refcounts = self._counts()
+                self._save_refcounts(refcounts, {digest: refcounts.get(digest, 0) for digest in self._changed})
+                self._changed = set()
+        return len(released)
+
+
+# local stores by their roots, so that unpickled chunk references share them and their reference counts
+_local_stores = weakref.WeakValueDictionary()
+_local_stores_lock = threading.Lock()
+
+
+def _local_chunk_store(root: str) -> 'LocalChunkStore':
+    with _local_stores_lock:
+        store = _local_stores.get(os.path.abspath(root))
+    return store if store is not None else LocalChunkStore(root)
+
+
+class LocalChunkStore(ChunkStore):
+    """
+    Chunks in files of a local directory, reference counts in a json file next to them
+    and the counts changed since it was written in a journal of json lines, which is merged into the file
+    once it holds more counts than the store has
+    """
+
+    REFCOUNTS_FILE = 'refcounts.json'
+    JOURNAL_FILE = 'refcounts.journal'
+
+    def __init__(self, root: str):
+        self._root = root
+        os.makedirs(root, exist_ok=True)
+        super().__init__()
+        # counts in the journal
+        self._journaled = 0
+        with _local_stores_lock:
+            _local_stores.setdefault(os.path.abspath(root), self)
+
+    def __reduce__(self):
+        return _local_chunk_store, (self._root,)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self._root, digest[:2], digest[2:])
+
+    def _contains(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def _write(self, digest: str, payload: BinaryIO) -> None:
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                StreamingUtils.transfer(payload, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _read(self, digest: str, offset: int, size: int) -> bytes:
+        with open(self._path(digest), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _remove(self, digest: str) -> None:
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _load_refcounts(self) -> Dict[str, int]:
+        try:
+            with open(os.path.join(self._root, self.REFCOUNTS_FILE)) as f:
+                refcounts = json.load(f)
+        except FileNotFoundError:
+            refcounts = dict()
+        truncated = False
+        try:
+            with open(os.path.join(self._root, self.JOURNAL_FILE)) as f:
+                for line in f:
+                    try:
+                        changed = json.loads(line)
+                    except ValueError:
+                        # the line was not written to the end
+                        truncated = True
+                        break
+                    self._journaled += len(changed)
+                    refcounts.update(changed)
+        except FileNotFoundError:
+            pass
+        refcounts = {digest: count for digest, count in refcounts.items() if count > 0}
+        if truncated:
+            # lines appended after the truncated one would not be read
+            self._merge_journal(refcounts)
+        return refcounts
+
+    def _save_refcounts(self, refcounts: Dict[str, int], changed: Dict[str, int]) -> None:
+        if self._journaled + len(changed) > len(refcounts):
+            self._merge_journal(refcounts)
+            return
+        with open(os.path.join(self._root, self.JOURNAL_FILE), 'a') as f:
+            f.write(json.dumps(changed) + '\n')
+        self._journaled += len(changed)
+
+    def _merge_journal(self, refcounts: Dict[str, int]) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self._root)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(refcounts, f)
+        os.replace(tmp_path, os.path.join(self._root, self.REFCOUNTS_FILE))
+        # counts are absolute, the journal may be merged again if it is not removed
+        try:
+            os.remove(os.path.join(self._root, self.JOURNAL_FILE))
+        except FileNotFoundError:
+            pass
+        self._journaled = 0
@@ -0,0 +1,311 @@
+import bz2
+import io
+import lzma
+import time
+import zlib
+from abc import abstractmethod
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from ipystate.impl.memo import MemoryChunk
+from ipystate.utils import StreamingUtils
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# payloads smaller than this are not compressed
+COMPRESSION_MIN_SIZE = 4096
+# bytes of a payload every codec compresses to choose one, taken in a few pieces across the payload
+COMPRESSION_SAMPLE_SIZE = 256 * 1024
+COMPRESSION_SAMPLE_PIECES = 4
+# payloads compressed less than this are kept as is, e.g. parquet files which are compressed already
+COMPRESSION_MIN_RATIO = 1.1
+# bytes per second payloads are assumed to be written or sent with, e.g. to a remote storage: codecs are chosen
+# by the time it takes to compress a payload and then write it, slow codecs pay off only on slow links
+COMPRESSION_BANDWIDTH = 32 * 1024 * 1024
+# a codec chosen for a type and a size class is probed again after this many payloads, the data changes
+COMPRESSION_PROBE_INTERVAL = 32
+# compressed bytes fed to a decompressor at once, bounds the memory a stream holds
+DECOMPRESSION_READ_SIZE = 64 * 1024
+# stats key of payloads kept uncompressed
+NO_CODEC = 'none'
+
+
+class Codec:
+    """
+    Streaming compression format
+    """
+
+    name = None
+
+    @abstractmethod
+    def compressor(self) -> Any:
+        """
+        Object with compress(data) -> bytes and flush() -> bytes
+        """
+        pass
+
+    @abstractmethod
+    def decompressor(self) -> Any:
+        """
+        Object with decompress(data) -> bytes
+        """
+        pass
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+
+    def __init__(self, level: int = 1):
+        self._level = level
+
+    def compressor(self) -> Any:
+        return zlib.compressobj(self._level)
+
+    def decompressor(self) -> Any:
+        return zlib.decompressobj()
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+
+    def __init__(self, preset: int = 1):
+        self._preset = preset
+
+    def compressor(self) -> Any:
+        return lzma.LZMACompressor(preset=self._preset)
+
+    def decompressor(self) -> Any:
+        return lzma.LZMADecompressor()
+
+
+class Bz2Codec(Codec):
+    name = 'bz2'
+
+    def __init__(self, level: int = 9):
+        self._level = level
+
+    def compressor(self) -> Any:
+        return bz2.BZ2Compressor(self._level)
+
+    def decompressor(self) -> Any:
+        return bz2.BZ2Decompressor()
+
+
+class _Lz4FrameCompressor:
+    def __init__(self, level: int):
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data) -> bytes:
+        header, self._header = self._header, b''
+        return header + self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        header, self._header = self._header, b''
+        return header + self._compressor.flush()
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+
+    def __init__(self, level: int = 0):
+        self._level = level
+
+    def compressor(self) -> Any:
+        return _Lz4FrameCompressor(self._level)
+
+    def decompressor(self) -> Any:
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+
+    def __init__(self, level: int = 3):
+        self._level = level
+
+    def compressor(self) -> Any:
+        return zstandard.ZstdCompressor(level=self._level).compressobj()
+
+    def decompressor(self) -> Any:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+# codecs by name, lz4 and zstd if they are installed
+CODECS = {codec.name: codec for codec in (ZlibCodec(), LzmaCodec(), Bz2Codec())}
+if lz4 is not None:
+    CODECS[Lz4Codec.name] = Lz4Codec()
+if zstandard is not None:
+    CODECS[ZstdCodec.name] = ZstdCodec()
+
+
+def register_codec(codec: Codec) -> None:
+    """
+    Makes the codec available to Compressors and to decompression by its name
+    """
+    CODECS[codec.name] = codec
+
+
+def compress(codec: Codec, buffers: Iterable) -> MemoryChunk:
+    compressor = codec.compressor()
+    parts = [compressor.compress(buffer) for buffer in buffers]
+    parts.append(compressor.flush())
+    return MemoryChunk([part for part in parts if part])
+
+
+class _DecompressingReader(io.RawIOBase):
+    def __init__(self, codec: Codec, payload: BinaryIO):
+        super().__init__()
+        self._decompressor = codec.decompressor()
+        self._payload = payload
+        self._payload.seek(0)
+        self._pending = memoryview(b'')
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._pending and not self._eof:
+            data = self._payload.read(DECOMPRESSION_READ_SIZE)
+            if data:
+                self._pending = memoryview(self._decompressor.decompress(data))
+            else:
+                self._eof = True
+                flush = getattr(self._decompressor, 'flush', None)
+                if flush is not None:
+                    self._pending = memoryview(flush())
+        n = min(len(b), len(self._pending))
+        memoryview(b).cast('B')[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def decompressed(payload: BinaryIO, codec_name: Optional[str]) -> BinaryIO:
+    """
+    Stream of the payload decompressed as it is read, e.g. by an Unpickler; the payload itself without a codec
+    """
+    if codec_name is None:
+        return payload
+    return io.BufferedReader(_DecompressingReader(CODECS[codec_name], payload))
+
+
+class CodecStats:
+    """
+    Payloads compressed by a codec, or kept uncompressed for NO_CODEC
+    """
+
+    def __init__(self):
+        self._payloads = 0
+        self._nbytes = 0
+        self._compressed_nbytes = 0
+        self._seconds = 0.
+
+    def payloads(self) -> int:
+        return self._payloads
+
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def compressed_nbytes(self) -> int:
+        return self._compressed_nbytes
+
+    def seconds(self) -> float:
+        return self._seconds
+
+    def ratio(self) -> float:
+        return self._nbytes / self._compressed_nbytes if self._compressed_nbytes else 1.
+
+    def speed_mbs(self) -> float:
+        return self._nbytes / 2 ** 20 / self._seconds if self._seconds else float('inf')
+
+    def _add(self, nbytes: int, compressed_nbytes: int, seconds: float) -> None:
+        self._payloads += 1
+        self._nbytes += nbytes
+        self._compressed_nbytes += compressed_nbytes
+        self._seconds += seconds
+
+
+class Compressor:
+    """
+    Compresses payloads with codecs chosen per payload type and size class (a power of two):
+    a sample of a payload is compressed by every codec and the one minimizing the time to compress
+    and write the payload at the bandwidth wins, or none if the payload is hardly compressible.
+    Choices are probed again every COMPRESSION_PROBE_INTERVAL payloads and once a choice fails
+    """
+
+    def __init__(self, codecs: Iterable[str] = None, bandwidth: float = COMPRESSION_BANDWIDTH,
+                 min_size: int = COMPRESSION_MIN_SIZE):
+        self._codecs = [CODECS[name] for name in (codecs if codecs is not None else CODECS)]
+        self._bandwidth = bandwidth
+        self._min_size = min_size
+        # (type, size class) -> chosen codec or None, and payloads compressed since it was probed
+        self._choices = dict()
+        self._stats = dict()
+
+    def stats(self) -> Dict[str, CodecStats]:
+        return dict(self._stats)
+
+    def _record(self, codec_name: str, nbytes: int, compressed_nbytes: int, seconds: float) -> None:
+        self._stats.setdefault(codec_name, CodecStats())._add(nbytes, compressed_nbytes, seconds)
+
+    def compress(self, typ: str, payload: BinaryIO) -> Tuple[BinaryIO, Optional[str]]:
+        """
+        Returns the payload, compressed or not, and the name of its codec if it is
+        """
+        nbytes = len(payload)
+        if nbytes < self._min_size:
+            self._record(NO_CODEC, nbytes, nbytes, 0.)
+            return payload, None
+        key = (typ, nbytes.bit_length())
+        codec, used = self._choices.get(key, (None, COMPRESSION_PROBE_INTERVAL))
+        if used >= COMPRESSION_PROBE_INTERVAL:
+            codec = self._probe(payload)
+            used = 0
+        self._choices[key] = (codec, used + 1)
+        if codec is None:
+            self._record(NO_CODEC, nbytes, nbytes, 0.)
+            return payload, None
+
+        start = time.perf_counter()
+        compressed = compress(codec, StreamingUtils.buffers(payload))
+        seconds = time.perf_counter() - start
+        if len(compressed) * COMPRESSION_MIN_RATIO > nbytes:
+            # the sample misled, the next payload probes again
+            self._choices[key] = (None, COMPRESSION_PROBE_INTERVAL)
+            self._record(NO_CODEC, nbytes, nbytes, seconds)
+            return payload, None
+        self._record(codec.name, nbytes, len(compressed), seconds)
+        return compressed, codec.name
+
+    def _probe(self, payload: BinaryIO) -> Optional[Codec]:
+        sample = _sample(payload)
+        best = None
+        best_cost = len(sample) / self._bandwidth
+        for codec in self._codecs:
+            start = time.perf_counter()
+            size = len(compress(codec, [sample]))
+            cost = time.perf_counter() - start + size / self._bandwidth
+            if size * COMPRESSION_MIN_RATIO <= len(sample) and cost < best_cost:
+                best, best_cost = codec, cost
+        return best
+
+
+def _sample(payload: BinaryIO) -> bytes:
+    nbytes = len(payload)
+    if nbytes <= COMPRESSION_SAMPLE_SIZE:
+        return StreamingUtils.to_bytes(payload)
+    piece = COMPRESSION_SAMPLE_SIZE // COMPRESSION_SAMPLE_PIECES
+    parts: List[bytes] = []
+    for i in range(COMPRESSION_SAMPLE_PIECES):
+        payload.seek((nbytes - piece) * i // (COMPRESSION_SAMPLE_PIECES - 1))
+        parts.append(payload.read(piece))
+    payload.seek(0)
+    return b''.join(parts)
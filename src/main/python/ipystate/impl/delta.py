@@ -0,0 +1,149 @@
+import mmap
+import struct
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional
+
+from ipystate.utils import StreamingUtils
+
+# payloads smaller than this are always sent in full
+DELTA_MIN_SIZE = 1024 * 1024
+# deltas in a row before a payload is sent in full again
+DELTA_MAX_CHAIN = 8
+# deltas larger than this part of the payload are not worth it
+DELTA_MAX_RATIO = 0.5
+# base is indexed by blocks of this size, shorter matches are sent as literals
+DELTA_BLOCK_SIZE = 64
+
+_MAGIC = b'IPYD1'
+_COPY = b'C'
+_LITERAL = b'L'
+_COPY_OP = struct.Struct('>QQ')
+_LITERAL_OP = struct.Struct('>Q')
+
+
+def _common_prefix(a: bytes, i: int, b: bytes, j: int) -> int:
+    """
+    Length of the common prefix of a[i:] and b[j:], compared in growing steps at C speed
+    """
+    length = 0
+    step = DELTA_BLOCK_SIZE
+    while step > 0:
+        if i + length + step <= len(a) and j + length + step <= len(b) and \
+                a[i + length:i + length + step] == b[j + length:j + length + step]:
+            length += step
+            step *= 2
+        else:
+            step //= 2
+    while i + length < len(a) and j + length < len(b) and a[i + length] == b[j + length]:
+        length += 1
+    return length
+
+
+def encode_delta(base, data, max_size: Optional[int] = None) -> Optional[bytes]:
+    """
+    Patch turning base into data, as in rsync: blocks of base are indexed, data is scanned for them
+    and matches are extended both ways. Unchanged runs of data cost a few comparisons, only changed bytes
+    are looked up one by one. Returns None as soon as the patch would be larger than max_size.
+    Bytes and mmaps are sliced as they are, other buffers are copied
+    """
+    if not isinstance(base, (bytes, mmap.mmap)):
+        base = bytes(base)
+    if not isinstance(data, (bytes, mmap.mmap)):
+        data = bytes(data)
+    if max_size is None:
+        max_size = len(data) + len(_MAGIC) + _LITERAL_OP.size + 1
+    index = dict()
+    for offset in range(len(base) - DELTA_BLOCK_SIZE, -1, -DELTA_BLOCK_SIZE):
+        index[base[offset:offset + DELTA_BLOCK_SIZE]] = offset
+
+    patch = bytearray(_MAGIC)
+    literal_start = 0
+    pos = 0
+    # base offset expected to match data at pos: data is base with a few changes, usually
+    expected = 0
+    last = len(data) - DELTA_BLOCK_SIZE
+    while pos < len(data):
+        length = _common_prefix(base, expected, data, pos) if expected < len(base) else 0
+        if length < DELTA_BLOCK_SIZE:
+            offset = None
+            while pos <= last:
+                offset = index.get(data[pos:pos + DELTA_BLOCK_SIZE])
+                if offset is not None:
+                    break
+                pos += 1
+                if pos - literal_start + len(patch) > max_size:
+                    return None
+            if offset is None:
+                break
+            # extend the match backwards over the literal
+            while pos > literal_start and offset > 0 and data[pos - 1] == base[offset - 1]:
+                pos -= 1
+                offset -= 1
+            expected = offset
+            length = _common_prefix(base, expected, data, pos)
+
+        if pos > literal_start:
+            patch.extend(_LITERAL + _LITERAL_OP.pack(pos - literal_start))
+            patch.extend(data[literal_start:pos])
+        patch.extend(_COPY + _COPY_OP.pack(expected, length))
+        if len(patch) > max_size:
+            return None
+        pos += length
+        expected += length
+        literal_start = pos
+
+    if literal_start < len(data):
+        patch.extend(_LITERAL + _LITERAL_OP.pack(len(data) - literal_start))
+        patch.extend(data[literal_start:])
+    return bytes(patch) if len(patch) <= max_size else None
+
+
+class DeltaBase:
+    """
+    Payload the next delta of a variable is encoded against, kept in a temporary file rather than in memory
+    """
+
+    def __init__(self, payload: BinaryIO, digest: str, chain: int = 0):
+        # digest of the payload and deltas in a row up to it
+        self.digest = digest
+        self.chain = chain
+        self._file = tempfile.TemporaryFile()
+        payload.seek(0)
+        StreamingUtils.transfer(payload, self._file)
+        payload.seek(0)
+        self._file.flush()
+
+    @contextmanager
+    def mapped(self) -> Iterator[mmap.mmap]:
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            yield view
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def apply_delta(base, patch) -> bytes:
+    base = memoryview(base).cast('B')
+    patch = memoryview(patch).cast('B')
+    if patch[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('Not a delta')
+    parts: List[memoryview] = []
+    pos = len(_MAGIC)
+    while pos < len(patch):
+        op = patch[pos:pos + 1]
+        pos += 1
+        if op == _COPY:
+            offset, length = _COPY_OP.unpack_from(patch, pos)
+            pos += _COPY_OP.size
+            if offset + length > len(base):
+                raise ValueError('Delta does not match its base')
+            parts.append(base[offset:offset + length])
+        elif op == _LITERAL:
+            length, = _LITERAL_OP.unpack_from(patch, pos)
+            pos += _LITERAL_OP.size
+            parts.append(patch[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError('Corrupted delta')
+    return b''.join(parts)
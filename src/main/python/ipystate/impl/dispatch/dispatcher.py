@@ -1,11 +1,32 @@
+import pickle
 from abc import abstractmethod
 
 
+class OutOfBandBuffer:
+    """
+    Buffer in reduce results of dispatchers: pickled as a PickleBuffer with protocol 5,
+    so it may go out-of-band, and as bytes with older protocols; loaded as a memoryview.
+    Not needed for buffers pickled this way already, e.g. pyarrow.Buffer
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return memoryview, (pickle.PickleBuffer(self._buffer),)
+        return memoryview, (bytes(memoryview(self._buffer)),)
+
+
 class Dispatcher:
     @staticmethod
     def _reduce_without_args(_type):
         return lambda _: (_type, ())
 
+    @staticmethod
+    def _out_of_band(buffer) -> OutOfBandBuffer:
+        return OutOfBandBuffer(buffer)
+
     @abstractmethod
     def register(self, dispatch):
         pass
@@ -0,0 +1,73 @@
+import pickle
+import sqlite3
+import threading
+from abc import abstractmethod
+from typing import Dict, Iterable
+
+# protocol of the pickled hashes, readable by all supported Python versions
+HASH_INDEX_PICKLE_PROTOCOL = 4
+
+
+class HashIndex:
+    """
+    Persistent hashes of a HashChangeDetector by key, so that variables restored after a restart are not NEW.
+    Backends implement the storage methods
+    """
+
+    @abstractmethod
+    def load(self) -> Dict[str, object]:
+        """
+        Hashes saved before; hashes which cannot be read, e.g. written by another version, are skipped
+        """
+        pass
+
+    @abstractmethod
+    def save(self, updated: Dict[str, object], removed: Iterable[str]) -> None:
+        """
+        Writes the updated hashes and removes the removed ones atomically
+        """
+        pass
+
+
+class SqliteHashIndex(HashIndex):
+    """
+    Hashes in a sqlite table, pickled; a save is a single transaction
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+
+    def __reduce__(self):
+        return SqliteHashIndex, (self._path,)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path)
+            connection.execute('CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, hash BLOB NOT NULL)')
+            self._local.connection = connection
+        return connection
+
+    def load(self) -> Dict[str, object]:
+        hashes = dict()
+        for key, blob in self._connection().execute('SELECT key, hash FROM hashes'):
+            try:
+                hashes[key] = pickle.loads(blob)
+            except Exception:
+                pass
+        return hashes
+
+    def save(self, updated: Dict[str, object], removed: Iterable[str]) -> None:
+        connection = self._connection()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO hashes (key, hash) VALUES (?, ?)',
+                                   ((key, pickle.dumps(value, protocol=HASH_INDEX_PICKLE_PROTOCOL))
+                                    for key, value in updated.items()))
+            connection.executemany('DELETE FROM hashes WHERE key = ?', ((key,) for key in removed))
+
+    def close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,439 @@
+import hashlib
+import io
+from typing import Any, Hashable, Iterable, List, Optional, Tuple
+
+from ipystate.dynamic_type_mapping import DynamicTypeMapping
+from ipystate.utils import StreamingUtils
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# buffers are hashed by blocks of this size, changes are localized to blocks
+MERKLE_BLOCK_SIZE = 4 * 1024 * 1024
+# DataFrames are hashed by columns and groups of this many rows
+MERKLE_ROW_GROUP_SIZE = 64 * 1024
+# bytes pre-checks sample at the start, in the middle and at the end of every buffer block
+MERKLE_SAMPLE_SIZE = 64
+# elements of containers hashed by value, larger containers are left to the pickled stage
+CONTAINER_HASH_MAX_SIZE = 10000
+# primitives containers of which are hashed by value; exact types, subclasses may carry state
+_PRIMITIVE_TYPES = frozenset((type(None), bool, int, float, complex, str, bytes))
+_CONTAINER_TYPES = frozenset((list, tuple, dict, set, frozenset))
+
+# flat arrow arrays, which buffers hold all of their data
+_ARROW_ARRAYS = (
+    'NullArray', 'BooleanArray', 'Int8Array', 'Int16Array', 'Int32Array', 'Int64Array', 'UInt8Array', 'UInt16Array',
+    'UInt32Array', 'UInt64Array', 'HalfFloatArray', 'FloatArray', 'DoubleArray', 'Decimal128Array', 'Decimal256Array',
+    'Date32Array', 'Date64Array', 'TimestampArray', 'Time32Array', 'Time64Array', 'DurationArray',
+    'MonthDayNanoIntervalArray', 'BinaryArray', 'LargeBinaryArray', 'FixedSizeBinaryArray', 'StringArray',
+    'LargeStringArray', 'BinaryViewArray', 'StringViewArray',
+)
+# pandas types are public in the pandas module since 2.x, they were in submodules before
+_PANDAS_TYPES = {
+    'DataFrame': 'pandas.core.frame',
+    'Series': 'pandas.core.series',
+    'Index': 'pandas.core.indexes.base',
+    'RangeIndex': 'pandas.core.indexes.range',
+    'MultiIndex': 'pandas.core.indexes.multi',
+    'DatetimeIndex': 'pandas.core.indexes.datetimes',
+    'CategoricalIndex': 'pandas.core.indexes.category',
+}
+
+
+def new_hash() -> Any:
+    """
+    xxh3 if xxhash is installed, blake2b otherwise; both release the GIL on large buffers
+    """
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+
+class BlockHashes:
+    """
+    Merkle fingerprint of a value: hashes of its blocks, e.g. fixed-size parts of a buffer or row groups
+    of DataFrame columns, under a header, e.g. a dtype and a shape. Fingerprints are equal if their roots are.
+    Samples are hashes of a few bytes or rows of every block, which pre-checks compare without hashing blocks
+    """
+
+    def __init__(self, header: bytes, blocks: List[Tuple[Hashable, bytes]], samples: Optional[List[bytes]] = None):
+        self._header = header
+        self._blocks = blocks
+        self._samples = samples
+        self._root = None
+
+    def header(self) -> bytes:
+        return self._header
+
+    def blocks(self) -> List[Hashable]:
+        return [block for block, _ in self._blocks]
+
+    def samples(self) -> Optional[List[bytes]]:
+        return self._samples
+
+    def root(self) -> bytes:
+        if self._root is None:
+            h = new_hash()
+            h.update(self._header)
+            for block, digest in self._blocks:
+                h.update(repr(block).encode())
+                h.update(digest)
+            self._root = h.digest()
+        return self._root
+
+    def changed_blocks(self, previous: 'BlockHashes') -> Optional[List[Hashable]]:
+        """
+        Blocks which hashes differ from the previous ones, or which only one of the fingerprints has;
+        None if the headers differ, i.e. the whole value changed
+        """
+        if self._header != previous._header:
+            return None
+        previous_blocks = dict(previous._blocks)
+        changed = [block for block, digest in self._blocks if previous_blocks.pop(block, None) != digest]
+        changed.extend(previous_blocks)
+        return changed
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BlockHashes) and self.root() == other.root()
+
+    def __hash__(self) -> int:
+        return hash(self.root())
+
+    def __getstate__(self):
+        return self._header, self._blocks, self._samples
+
+    def __setstate__(self, state):
+        self._header, self._blocks, self._samples = state
+        self._root = None
+
+
+def _sample_digest(view: memoryview, start: int, end: int) -> bytes:
+    h = new_hash()
+    for offset in (start, (start + end - MERKLE_SAMPLE_SIZE) // 2, end - MERKLE_SAMPLE_SIZE):
+        offset = max(offset, start)
+        h.update(view[offset:min(offset + MERKLE_SAMPLE_SIZE, end)])
+    return h.digest()
+
+
+def _block_bounds(nbytes: int) -> Iterable[Tuple[int, int]]:
+    return ((start, min(start + MERKLE_BLOCK_SIZE, nbytes)) for start in range(0, nbytes, MERKLE_BLOCK_SIZE))
+
+
+def _buffer_blocks(view: memoryview, header: bytes) -> BlockHashes:
+    blocks = []
+    samples = []
+    for i, (start, end) in enumerate(_block_bounds(view.nbytes)):
+        h = new_hash()
+        h.update(view[start:end])
+        blocks.append((i, h.digest()))
+        samples.append(_sample_digest(view, start, end))
+    return BlockHashes(header, blocks, samples)
+
+
+def _buffer_samples(view: memoryview, header: bytes) -> Tuple[bytes, List[bytes]]:
+    return header, [_sample_digest(view, start, end) for start, end in _block_bounds(view.nbytes)]
+
+
+def _bytes_view(value: Any) -> Tuple[memoryview, bytes]:
+    view = memoryview(value)
+    header = f'{view.format}{view.shape}'.encode()
+    return (view if view.c_contiguous else memoryview(view.tobytes())).cast('B'), header
+
+
+def hash_buffer(value: Any) -> BlockHashes:
+    """
+    Hash of bytes, bytearray, memoryview or another object supporting the buffer protocol
+    """
+    return _buffer_blocks(*_bytes_view(value))
+
+
+def sample_buffer(value: Any) -> Tuple[bytes, List[bytes]]:
+    return _buffer_samples(*_bytes_view(value))
+
+
+class ChunkHasher:
+    """
+    Hash of a payload written in pieces, the same as hash_chunk of the whole payload
+    """
+
+    def __init__(self):
+        self._blocks = []
+        self._hash = new_hash()
+        self._filled = 0
+
+    def update(self, buffer: Any) -> None:
+        view = memoryview(buffer).cast('B')
+        while view.nbytes:
+            n = min(view.nbytes, MERKLE_BLOCK_SIZE - self._filled)
+            self._hash.update(view[:n])
+            self._filled += n
+            view = view[n:]
+            if self._filled == MERKLE_BLOCK_SIZE:
+                self._blocks.append((len(self._blocks), self._hash.digest()))
+                self._hash = new_hash()
+                self._filled = 0
+
+    def result(self) -> BlockHashes:
+        blocks = list(self._blocks)
+        if self._filled:
+            blocks.append((len(blocks), self._hash.digest()))
+        return BlockHashes(b'', blocks)
+
+
+def hash_chunk(value: Any) -> BlockHashes:
+    """
+    Hash of a file-like payload, e.g. a pickled variable, read in blocks.
+    Payloads hashed as they were written, e.g. chunks of a ChunkedFile, are not read again
+    """
+    block_hashes = getattr(value, 'block_hashes', None)
+    hashes = block_hashes() if block_hashes is not None else None
+    if hashes is not None:
+        return hashes
+    hasher = ChunkHasher()
+    for buffer in StreamingUtils.buffers(value):
+        hasher.update(buffer)
+    return hasher.result()
+
+
+def _ndarray_view(value: Any, copy: bool = True) -> Tuple[Optional[memoryview], bytes]:
+    if value.dtype.hasobject:
+        raise TypeError('Arrays of objects are not hashed by value')
+    header = f'{value.dtype.str}{value.dtype.descr}{value.shape}{value.strides}'.encode()
+    if value.flags.c_contiguous:
+        data = value
+    elif value.flags.f_contiguous:
+        data = value.T
+    elif copy:
+        data = value.copy()
+    else:
+        return None, header
+    # viewed as bytes, so that dtypes without a buffer format, e.g. datetime64, are hashed too
+    return memoryview(data.reshape(-1).view('B') if data.size else b''), header
+
+
+def hash_ndarray(value: Any) -> BlockHashes:
+    return _buffer_blocks(*_ndarray_view(value))
+
+
+def sample_ndarray(value: Any) -> Optional[Tuple[bytes, List[bytes]]]:
+    view, header = _ndarray_view(value, copy=False)
+    return None if view is None else _buffer_samples(view, header)
+
+
+def _update_arrow_array(h: Any, value: Any) -> None:
+    h.update(f'{value.type}/{value.offset}/{len(value)}'.encode())
+    for buffer in value.buffers():
+        if buffer is None:
+            h.update(b'-')
+        else:
+            h.update(f'{buffer.size}'.encode())
+            h.update(buffer)
+
+
+def _arrow_array_digest(value: Any) -> bytes:
+    import pyarrow as pa
+
+    h = new_hash()
+    if isinstance(value, pa.DictionaryArray):
+        h.update(_arrow_array_digest(value.indices))
+        h.update(_arrow_array_digest(value.dictionary))
+    elif type(value).__name__ in _ARROW_ARRAYS:
+        _update_arrow_array(h, value)
+    else:
+        raise TypeError(f'Arrays of {value.type} are not hashed by value')
+    return h.digest()
+
+
+def hash_arrow(value: Any) -> BlockHashes:
+    """
+    Hash of a pyarrow Buffer, by blocks, of a flat or dictionary array, of a chunked array by chunks
+    or of a table or a record batch by columns and chunks
+    """
+    import pyarrow as pa
+
+    if isinstance(value, pa.Buffer):
+        return hash_buffer(value)
+    if isinstance(value, pa.Array):
+        return BlockHashes(b'', [(0, _arrow_array_digest(value))])
+    if isinstance(value, pa.ChunkedArray):
+        return BlockHashes(f'{value.type}'.encode(),
+                           [(i, _arrow_array_digest(chunk)) for i, chunk in enumerate(value.chunks)])
+    if isinstance(value, (pa.Table, pa.RecordBatch)):
+        blocks = []
+        for i, column in enumerate(value.columns):
+            chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+            blocks.extend(((i, j), _arrow_array_digest(chunk)) for j, chunk in enumerate(chunks))
+        return BlockHashes(f'{value.schema}/{value.schema.metadata}'.encode(), blocks)
+    raise TypeError(type(value))
+
+
+def _check_hashable_values(values: Any) -> None:
+    """
+    hash_pandas_object hashes objects by their str, which does not follow changes of arbitrary objects
+    """
+    import pandas as pd
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        _check_hashable_values(values.cat.categories if hasattr(values, 'cat') else values.categories)
+    elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty'):
+        raise TypeError('Objects are not hashed by value')
+
+
+def _index_header(index: Any) -> str:
+    """
+    Type, dtypes and names of an Index, which row hashes of pandas do not follow
+    """
+    import pandas as pd
+
+    dtypes = [level.dtype for level in index.levels] if isinstance(index, pd.MultiIndex) else [index.dtype]
+    return f'{type(index).__name__}/{len(index)}/{dtypes}/{index.names!r}/{getattr(index, "freq", None)!r}'
+
+
+def _pandas_columns(value: Any) -> Tuple[bytes, List[Tuple[Hashable, Any]]]:
+    """
+    Header of a DataFrame, Series or Index, and its columns and index hashed by row groups
+    """
+    import pandas as pd
+
+    if isinstance(value, pd.DataFrame):
+        columns = [(i, value.iloc[:, i]) for i in range(value.shape[1])]
+        header = f'DataFrame/{value.shape}/{list(value.dtypes.items())!r}/{value.attrs!r}/' \
+                 f'{_index_header(value.index)}'.encode() + hash_pandas(value.columns).root()
+        columns.append(('index', value.index))
+    elif isinstance(value, pd.Series):
+        columns = [(0, value), ('index', value.index)]
+        header = f'Series/{len(value)}/{value.dtype}/{value.name!r}/{value.attrs!r}/' \
+                 f'{_index_header(value.index)}'.encode()
+    else:
+        columns = [(0, value)]
+        header = _index_header(value).encode()
+    for _, column in columns:
+        for values in column.levels if isinstance(column, pd.MultiIndex) else [column]:
+            _check_hashable_values(values)
+    return header, columns
+
+
+def _row_groups(nrows: int) -> Tuple[List[Tuple[int, int]], Any]:
+    """
+    Bounds of row groups and positions of the first, the middle and the last rows of them, sampled by pre-checks
+    """
+    import numpy as np
+
+    groups = [(start, min(start + MERKLE_ROW_GROUP_SIZE, nrows)) for start in range(0, nrows, MERKLE_ROW_GROUP_SIZE)]
+    positions = np.array([(start, (start + end) // 2, end - 1) for start, end in groups], dtype=np.int64)
+    return groups, positions.reshape(-1)
+
+
+def _sample_digests(row_hashes: Any) -> List[bytes]:
+    digests = []
+    for i in range(0, len(row_hashes), 3):
+        h = new_hash()
+        h.update(row_hashes[i:i + 3].tobytes())
+        digests.append(h.digest())
+    return digests
+
+
+def hash_pandas(value: Any) -> BlockHashes:
+    """
+    Hash of a DataFrame, Series or Index by columns and row groups, with row hashes of pandas, dtypes and labels
+    """
+    import pandas as pd
+
+    header, columns = _pandas_columns(value)
+    groups, positions = _row_groups(len(value))
+    blocks = []
+    samples = []
+    for column_id, column in columns:
+        row_hashes = pd.util.hash_pandas_object(column, index=False).values
+        for i, (start, end) in enumerate(groups):
+            h = new_hash()
+            h.update(row_hashes[start:end])
+            blocks.append(((column_id, i), h.digest()))
+        samples.extend(_sample_digests(row_hashes[positions]))
+    return BlockHashes(header, blocks, samples)
+
+
+def sample_pandas(value: Any) -> Tuple[bytes, List[bytes]]:
+    import pandas as pd
+
+    header, columns = _pandas_columns(value)
+    _, positions = _row_groups(len(value))
+    samples = []
+    for _, column in columns:
+        samples.extend(_sample_digests(pd.util.hash_pandas_object(column.take(positions), index=False).values))
+    return header, samples
+
+
+def _update_primitives(h: Any, value: Any, budget: int) -> int:
+    typ = type(value)
+    if typ is str:
+        value = value.encode('utf-8', 'surrogatepass')
+        h.update(b's%d:' % len(value))
+        h.update(value)
+    elif typ is bytes:
+        h.update(b'b%d:' % len(value))
+        h.update(value)
+    elif typ in _PRIMITIVE_TYPES:
+        h.update(f'{typ.__name__}:{value!r};'.encode())
+    elif typ in _CONTAINER_TYPES:
+        budget -= len(value)
+        if budget < 0:
+            raise TypeError('Container is too large to be hashed by value')
+        h.update(f'{typ.__name__}{len(value)}('.encode())
+        for item in value.items() if typ is dict else value:
+            if typ is dict:
+                budget = _update_primitives(h, item[0], budget)
+                budget = _update_primitives(h, item[1], budget)
+            else:
+                budget = _update_primitives(h, item, budget)
+        h.update(b')')
+    else:
+        raise TypeError(f'{typ} is not hashed by value')
+    return budget
+
+
+def hash_primitives(value: Any) -> bytes:
+    """
+    Hash of a primitive or of containers of at most CONTAINER_HASH_MAX_SIZE primitives and containers in total.
+    Sets are hashed in iteration order, equal sets may differ
+    """
+    h = new_hash()
+    _update_primitives(h, value, CONTAINER_HASH_MAX_SIZE)
+    return h.digest()
+
+
+def default_sample_functions() -> DynamicTypeMapping:
+    """
+    Bundled functions sampling the blocks default_hash_functions() hash, for pre-checks
+    """
+    functions = DynamicTypeMapping()
+    for typ in (bytearray, memoryview):
+        functions[typ] = sample_buffer
+    functions[('numpy', 'ndarray')] = sample_ndarray
+    for name, module in _PANDAS_TYPES.items():
+        functions[('pandas', name)] = sample_pandas
+        functions[(module, name)] = sample_pandas
+    return functions
+
+
+def default_hash_functions() -> DynamicTypeMapping:
+    """
+    Bundled hash functions by type; types are matched by module and name, their modules are not imported.
+    Large values, e.g. buffers, arrays, DataFrames and tables, are hashed by blocks
+    """
+    functions = DynamicTypeMapping()
+    for typ in (bytearray, memoryview):
+        functions[typ] = hash_buffer
+    for typ in _PRIMITIVE_TYPES | _CONTAINER_TYPES:
+        functions[typ] = hash_primitives
+    for typ in (io.BytesIO, ('ipystate.impl.memo', 'MemoryChunk'), ('ipystate.impl.memo', 'FileChunk')):
+        functions[typ] = hash_chunk
+    functions[('numpy', 'ndarray')] = hash_ndarray
+    for name in ('Buffer', 'ChunkedArray', 'Table', 'RecordBatch', 'DictionaryArray') + _ARROW_ARRAYS:
+        functions[('pyarrow.lib', name)] = hash_arrow
+    for name, module in _PANDAS_TYPES.items():
+        functions[('pandas', name)] = hash_pandas
+        functions[(module, name)] = hash_pandas
+    return functions
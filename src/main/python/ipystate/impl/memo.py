@@ -1,12 +1,268 @@
+import io
+import os
+import tempfile
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+from typing import List, Optional
+
+from ipystate.impl.hashing import BlockHashes, ChunkHasher
+
+# bytes a ChunkedFile keeps in memory before spilling to a temporary file
+CHUNK_SPILL_THRESHOLD = 64 * 1024 * 1024
+# writes of immutable buffers at least this large are kept by reference instead of being copied
+ZERO_COPY_MIN_SIZE = 4096
+# size of the arena blocks small writes are copied to
+ARENA_BLOCK_SIZE = 1024 * 1024
+
+
+def _readonly_view(buffer) -> memoryview:
+    if type(buffer) is bytes:
+        return memoryview(buffer)
+    if isinstance(buffer, memoryview) and buffer.readonly and buffer.format == 'B' and buffer.ndim == 1:
+        return buffer
+    return memoryview(buffer).cast('B').toreadonly()
+
+
+class ChunkView(io.RawIOBase):
+    """
+    Read-only file-like view of a chunk. Pickled as the bytes it holds
+    """
+
+    def __init__(self, nbytes: int):
+        super().__init__()
+        self._nbytes = nbytes
+        self._pos = 0
+        self._block_hashes = None
+
+    def __len__(self) -> int:
+        return self._nbytes
+
+    def __bytes__(self) -> bytes:
+        return self._read_at(0, self._nbytes)
+
+    def __reduce__(self):
+        return MemoryChunk, ([bytes(self)],), {'_block_hashes': self._block_hashes}
+
+    def block_hashes(self) -> Optional[BlockHashes]:
+        """
+        Hashes of the chunk computed as it was written, None unless its ChunkedFile hashed chunks
+        """
+        return self._block_hashes
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._nbytes
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({}, should be 0, 1 or 2)'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b) -> int:
+        data = self._read_at(self._pos, min(len(b), max(self._nbytes - self._pos, 0)))
+        n = len(data)
+        memoryview(b).cast('B')[:n] = data
+        self._pos += n
+        return n
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        raise NotImplementedError
+
+
+class MemoryChunk(ChunkView):
+    """
+    Chunk made of in-memory buffers which are referenced, not copied
+    """
+
+    def __init__(self, buffers: List, nbytes: Optional[int] = None):
+        """
+        nbytes is passed only with buffers that are read-only memoryviews of bytes already
+        """
+        if nbytes is None:
+            buffers = [_readonly_view(buffer) for buffer in buffers]
+            nbytes = sum(buffer.nbytes for buffer in buffers)
+        self._buffers = buffers
+        self._offsets = None
+        self._joined = None
+        super().__init__(nbytes)
+
+    def buffers(self) -> List[memoryview]:
+        """
+        Read-only views of the buffers the chunk consists of
+        """
+        return list(self._buffers)
+
+    def getbuffer(self) -> memoryview:
+        if len(self._buffers) == 1:
+            return self._buffers[0]
+        if self._joined is None:
+            # the only copy made for a chunk of several buffers
+            self._joined = memoryview(b''.join(self._buffers)).toreadonly()
+        return self._joined
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        if self._joined is not None or len(self._buffers) == 1:
+            return self.getbuffer()[offset:offset + size].tobytes()
+        if self._offsets is None:
+            self._offsets = [0] + list(accumulate(buffer.nbytes for buffer in self._buffers))
+        end = min(offset + size, self._nbytes)
+        parts = []
+        i = bisect_right(self._offsets, offset) - 1
+        while offset < end:
+            start = offset - self._offsets[i]
+            n = min(end - offset, self._buffers[i].nbytes - start)
+            parts.append(self._buffers[i][start:start + n])
+            offset += n
+            i += 1
+        return b''.join(parts)
+
+
+class FileChunk(ChunkView):
+    """
+    Region of a temporary file shared by several chunks; reads are positional, so views are independent
+    """
+
+    def __init__(self, file, lock: threading.Lock, offset: int, nbytes: int):
+        super().__init__(nbytes)
+        self._file = file
+        self._lock = lock
+        self._offset = offset
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        offset += self._offset
+        if hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), size, offset)
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+
 class ChunkedFile:
-    def __init__(self):
-        self._ba = bytearray()
+    """
+    Write-only file split into chunks, e.g. a chunk per pickled variable.
+    Chunks are kept in memory until spill_threshold bytes are written in total,
+    later chunks are written to a single temporary file in tmp_dir.
+    In memory, large immutable writes, e.g. pickler frames, are kept by reference and
+    small ones are copied to shared arena blocks, so chunk boundaries cost no copies.
+    With hash_chunks, chunks are hashed as they are written and tell their block_hashes(),
+    so that they are not read again to be compared
+    """
+
+    def __init__(self, spill_threshold: int = CHUNK_SPILL_THRESHOLD, tmp_dir: str = None, hash_chunks: bool = False):
+        self._spill_threshold = spill_threshold
+        self._tmp_dir = tmp_dir
+        self._hash_chunks = hash_chunks
+        self._hasher = ChunkHasher() if hash_chunks else None
+        # buffers of the current chunk
+        self._buffers = []
+        self._nbytes = 0
+        self._in_memory = 0
+        # the current arena block and the start of its part not yet added to self._buffers
+        self._block = None
+        self._block_view = None
+        self._block_start = 0
+        self._block_end = 0
+        self._spill = None
+        self._spill_lock = threading.Lock()
+        self._start = 0
+        self._end = 0
+
+    def write(self, inp) -> int:
+        view = inp if type(inp) is bytes else _readonly_view(inp)
+        n = len(view) if view is inp else view.nbytes
+        if self._hasher is not None:
+            self._hasher.update(view)
+        if self._spill is None and self._in_memory + self._nbytes + n > self._spill_threshold:
+            self._spill = tempfile.TemporaryFile(dir=self._tmp_dir)
+            self._start = self._end = 0
+            for buffer in self._take_buffers():
+                self._write_spilled(buffer)
+        if self._spill is not None:
+            self._write_spilled(view)
+        elif n >= ZERO_COPY_MIN_SIZE:
+            self._flush_block()
+            if view is inp:
+                view = memoryview(inp)
+            elif type(view.obj) is not bytes:
+                # mutable buffers may change before the chunk is consumed
+                view = memoryview(view.tobytes())
+            self._buffers.append(view)
+        else:
+            self._write_block(view)
+        self._nbytes += n
+        return n
+
+    def _write_block(self, view) -> None:
+        end = self._block_end + len(view) if type(view) is bytes else -1
+        if self._block is not None and 0 <= end <= len(self._block):
+            self._block[self._block_end:end] = view
+            self._block_end = end
+            return
+        view = _readonly_view(view)
+        while view:
+            if self._block is None or self._block_end == len(self._block):
+                self._flush_block()
+                self._block = bytearray(max(ARENA_BLOCK_SIZE, ZERO_COPY_MIN_SIZE))
+                self._block_view = memoryview(self._block).toreadonly()
+                self._block_start = self._block_end = 0
+            n = min(view.nbytes, len(self._block) - self._block_end)
+            self._block[self._block_end:self._block_end + n] = view[:n]
+            self._block_end += n
+            view = view[n:]
+
+    def _flush_block(self) -> None:
+        if self._block_end > self._block_start:
+            self._buffers.append(self._block_view[self._block_start:self._block_end])
+            self._block_start = self._block_end
+
+    def _take_buffers(self) -> List:
+        self._flush_block()
+        buffers = self._buffers
+        self._buffers = []
+        return buffers
+
+    def _write_spilled(self, inp) -> None:
+        with self._spill_lock:
+            self._spill.seek(self._end)
+            self._spill.write(inp)
+            self._end = self._spill.tell()
 
-    def write(self, inp: bytes):
-        self._ba.extend(inp)
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
 
-    def current_chunk(self) -> bytearray:
-        return self._ba
+    def current_chunk(self) -> ChunkView:
+        if self._spill is None:
+            self._flush_block()
+            self._in_memory += self._nbytes
+            chunk = MemoryChunk(self._buffers[:], self._nbytes)
+        else:
+            with self._spill_lock:
+                self._spill.flush()
+            chunk = FileChunk(self._spill, self._spill_lock, self._start, self._end - self._start)
+        if self._hasher is not None:
+            chunk._block_hashes = self._hasher.result()
+        return chunk
 
     def reset(self) -> None:
-        self._ba = bytearray()
+        """
+        Starts the next chunk, chunks returned before stay valid
+        """
+        self._take_buffers()
+        self._nbytes = 0
+        self._start = self._end
+        if self._hash_chunks:
+            self._hasher = ChunkHasher()
@@ -0,0 +1,206 @@
+import os
+import pickle
+import select
+import signal
+import tempfile
+import time
+import traceback
+from collections import deque
+from typing import Any, BinaryIO, Callable, Iterable, Optional
+
+# messages sent by the child process
+_CHANGE = 0
+_DONE = 1
+_ERROR = 2
+
+_HEADER_SIZE = 8
+_READ_SIZE = 1 << 16
+
+
+class SnapshotFailedError(Exception):
+    pass
+
+
+class _FrameWriter:
+    """
+    Appends length-prefixed pickles to a file and wakes the reader up by a byte written to a pipe.
+    The pipe is non-blocking and wake-ups are dropped while it is full, so a reader which does not read
+    never blocks the writer
+    """
+
+    def __init__(self, fd: int, wakeup_fd: int):
+        self._fd = fd
+        self._wakeup_fd = wakeup_fd
+        os.set_blocking(wakeup_fd, False)
+
+    def send(self, message: Any) -> None:
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        view = memoryview(len(data).to_bytes(_HEADER_SIZE, 'big') + data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+        try:
+            os.write(self._wakeup_fd, b'\0')
+        except BlockingIOError:
+            pass
+
+
+class BackgroundSnapshot:
+    """
+    Changes of a commit, computed by a forked child process from the copy-on-write image of the kernel
+    and streamed back through an unlinked temporary file, the pipe only signals new messages and the exit
+    of the child. Changes are read lazily by changes() or buffered by wait().
+    The result of a successful child is passed to on_success after the predecessor snapshot is finished,
+    so results are applied in the order snapshots were started
+    """
+
+    def __init__(self, pid: int, fd: int, file: BinaryIO, on_success: Callable[[Any], None],
+                 predecessor: Optional['BackgroundSnapshot'] = None):
+        self._pid = pid
+        self._fd = fd
+        self._file = file
+        self._on_success = on_success
+        self._predecessor = predecessor
+        # position of the next message in the file; the file offset is shared with the child, so it is not used
+        self._offset = 0
+        self._exited = False
+        self._changes = deque()
+        self._finished = False
+        self._error = None
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    @property
+    def failed(self) -> bool:
+        return self._error is not None
+
+    @property
+    def error(self) -> Optional[str]:
+        return self._error
+
+    def changes(self) -> Iterable[Any]:
+        """
+        Yields changes as the child produces them, raises SnapshotFailedError if the child fails
+        """
+        while True:
+            while self._changes:
+                yield self._changes.popleft()
+            if self._finished:
+                break
+            self._receive(None)
+        if self._error is not None:
+            raise SnapshotFailedError(self._error)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Buffers changes until the child is finished, returns whether it is
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._finished:
+            if not self._receive(deadline):
+                break
+        return self._finished
+
+    def cancel(self) -> None:
+        if self._finished:
+            return
+        try:
+            os.kill(self._pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._finish('cancelled')
+
+    def _receive(self, deadline: Optional[float]) -> bool:
+        """
+        Reads a single message, returns False on timeout
+        """
+        while True:
+            header = self._read(self._offset, _HEADER_SIZE)
+            if header is not None:
+                size = int.from_bytes(header, 'big')
+                data = self._read(self._offset + _HEADER_SIZE, size)
+                if data is not None:
+                    self._offset += _HEADER_SIZE + size
+                    self._handle(pickle.loads(data))
+                    return True
+            if self._exited:
+                # the child exited without a complete last message
+                self._finish('snapshot process exited with status {}'.format(self._reap()))
+                return True
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self._fd], [], [], remaining)[0]:
+                    return False
+            # wake-ups carry no data; the end of the pipe means that everything the child wrote is in the file
+            if not os.read(self._fd, _READ_SIZE):
+                self._exited = True
+
+    def _read(self, offset: int, size: int) -> Optional[bytes]:
+        """
+        None unless the file has size bytes at the offset yet
+        """
+        chunks = []
+        while size > 0:
+            chunk = os.pread(self._file.fileno(), size, offset)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _handle(self, message: Any) -> None:
+        kind, payload = message
+        if kind == _CHANGE:
+            self._changes.append(payload)
+        elif kind == _DONE:
+            self._finish(None)
+            if self._predecessor is not None:
+                self._predecessor.wait()
+            self._on_success(payload)
+        else:
+            self._finish(payload)
+
+    def _reap(self) -> int:
+        if self._pid is None:
+            return 0
+        _, status = os.waitpid(self._pid, 0)
+        self._pid = None
+        return os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+
+    def _finish(self, error: Optional[str]) -> None:
+        self._finished = True
+        self._error = error
+        os.close(self._fd)
+        self._file.close()
+        self._reap()
+
+
+def fork_snapshot(run: Callable[[Callable[[Any], None]], Any], on_success: Callable[[Any], None],
+                  predecessor: Optional[BackgroundSnapshot] = None) -> BackgroundSnapshot:
+    """
+    Forks a child that calls run with a function sending a single change to the parent;
+    the result of run is passed to on_success in the parent
+    """
+    file = tempfile.TemporaryFile()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child: never returns to the caller and skips the parent's exit handlers
+        status = 1
+        try:
+            os.close(r)
+            writer = _FrameWriter(file.fileno(), w)
+            try:
+                result = run(lambda change: writer.send((_CHANGE, change)))
+                writer.send((_DONE, result))
+                status = 0
+            except BaseException:
+                writer.send((_ERROR, traceback.format_exc()))
+        finally:
+            os._exit(status)
+    os.close(w)
+    return BackgroundSnapshot(pid, r, file, on_success, predecessor)
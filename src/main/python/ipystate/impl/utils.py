@@ -51,9 +51,10 @@ def _which_module(obj: Any, name: str) -> str:
     module_name = getattr(obj, '__module__', None)
     if module_name is not None:
         return module_name
-    # Protect the iteration by using a list copy of sys.modules against dynamic
-    # modules that trigger imports of other modules upon calls to getattr.
-    for module_name, module in list(sys.modules.items()):
+    # Protect the iteration by using a copy of sys.modules against dynamic
+    # modules that trigger imports of other modules upon calls to getattr
+    # and against imports in other threads; dict.copy() is atomic.
+    for module_name, module in sys.modules.copy().items():
         if module_name == '__main__' or module is None:
             continue
 
@@ -84,14 +85,14 @@ def check_object_importable_by_name(obj: Any, name: Optional[str] = None) -> Opt
     return name, module_name, module, parent
 
 
-def _type_needs_to_be_saved_as_local(type_: type) -> bool:
+def type_needs_to_be_saved_as_local(type_: type) -> bool:
     return (is_local_object(type_)
             or type_.__module__ in ('builtins', '__main__') and type_.__name__ not in vars(builtins)
             or not check_object_importable_by_name(type_))
 
 
 def reduce_type(type_: type) -> Union[Tuple, type(SAVE_GLOBAL)]:
-    if _type_needs_to_be_saved_as_local(type_):
+    if type_needs_to_be_saved_as_local(type_):
         tdict = dict(type_.__dict__)
         tdict.pop('__weakref__', None)
         tdict.pop('__dict__', None)
@@ -1,140 +1,1020 @@
+# distutils: language = c++
+# cython: language_level=3, boundscheck=False, wraparound=False
+
 import copyreg
-import sys
-from itertools import groupby
+import pickle
+
+import cloudpickle
+import threading
+from collections import OrderedDict
 from itertools import islice
+from time import perf_counter
 from types import ModuleType
-from typing import Tuple, Dict, Iterable, Callable, Set
-
-from ipystate.impl.utils import check_object_importable_by_name, SAVE_GLOBAL, reduce_type
+from typing import Tuple, Dict, Iterable, Callable, Set, Optional, Hashable
+
+cimport cython
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize, PyBytes_GET_SIZE
+from cpython.dict cimport PyDict_Next
+from cpython.float cimport PyFloat_AS_DOUBLE
+from cpython.list cimport PyList_GET_ITEM, PyList_GET_SIZE
+from cpython.long cimport PyLong_AsLongLongAndOverflow
+from cpython.mem cimport PyMem_Free, PyMem_Malloc
+from cpython.object cimport PyObject
+from cpython.ref cimport Py_DECREF, Py_INCREF, Py_REFCNT
+from cpython.tuple cimport PyTuple_GET_ITEM, PyTuple_GET_SIZE
+from cpython.unicode cimport PyUnicode_DATA, PyUnicode_GET_LENGTH, PyUnicode_KIND
+from libc.stdint cimport int64_t, uint64_t, uintptr_t
+from libc.string cimport memcpy, memset
+from libcpp.vector cimport vector
+
+from ipystate.dynamic_type_mapping import DynamicTypeMapping
+from ipystate.impl.hashing import BlockHashes, default_hash_functions, new_hash
+from ipystate.impl.utils import check_object_importable_by_name, SAVE_GLOBAL, reduce_type, \
+    type_needs_to_be_saved_as_local
 from ipystate.logger import Logger
 
+# objects walked per variable
 WALK_SUBTREE_LIMIT = 10000
+# larger collections are sampled
 WALK_COLLECTION_LIMIT = 1000
+# seconds per walk
+WALK_TIME_LIMIT = 1.0
+# objects walked between deadline checks, power of 2
+DEADLINE_CHECK_PERIOD = 1024
+FULL_REWALK_PERIOD = 100
+CONSTANT_CACHE_SIZE = 1024
+# smaller tuples and frozensets are cheap to re-check
+CONSTANT_CACHE_MIN_LENGTH = 64
+# power of 2
+ID_TABLE_MIN_CAPACITY = 64
+# bytes of fingerprint tokens hashed at once
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+# work stack operations
+cdef enum:
+    _SAVE = 0
+    _ITEMS = 1
+    _PAIRS = 2
+    _MEMOIZE = 3
+    _END_IMMUTABLE = 4
+    _TUPLE_ITEMS = 5
+    _LIST_ITEMS = 6
+    _DICT_ITEMS = 7
+
+# results of saving a single object
+cdef enum:
+    _RESULT_NONE = 0
+    _RESULT_CONSTANT = 1
+    # known only after the subtree is walked through
+    _RESULT_DEFERRED = 2
+
+# dispatch actions
+cdef enum:
+    _DISPATCH_REDUCE = 0
+    _DISPATCH_CONSTANT = 1
+    _DISPATCH_IGNORE = 2
+    _DISPATCH_TUPLE = 3
+    _DISPATCH_LIST = 4
+    _DISPATCH_DICT = 5
+    _DISPATCH_SET = 6
+    _DISPATCH_FROZENSET = 7
+
+cdef object _NoneType = type(None)
+cdef object _NotImplementedType = type(NotImplemented)
+cdef object _EllipsisType = type(...)
+
+# leaf type actions
+# instances are labelled, but not walked through
+LEAF = _DISPATCH_IGNORE
+# instances are neither labelled nor walked through
+CONSTANT = _DISPATCH_CONSTANT
+
+# types are matched by module and name, so they apply once the module is imported
+DEFAULT_LEAF_TYPES = {
+    _NoneType: CONSTANT,
+    ModuleType: CONSTANT,
+    bytes: LEAF,
+    bytearray: LEAF,
+    ('numpy', 'ndarray'): LEAF,
+    ('numpy', 'dtype'): LEAF,
+    ('numpy', 'generic'): CONSTANT,
+    # pandas>=2.1 reports its public module
+    ('pandas', 'DataFrame'): LEAF,
+    ('pandas', 'Series'): LEAF,
+    ('pandas', 'Index'): LEAF,
+    ('pandas.core.frame', 'DataFrame'): LEAF,
+    ('pandas.core.series', 'Series'): LEAF,
+    ('pandas.core.indexes.base', 'Index'): LEAF,
+    ('pyarrow.lib', 'Array'): LEAF,
+    ('pyarrow.lib', 'ChunkedArray'): LEAF,
+    ('pyarrow.lib', 'RecordBatch'): LEAF,
+    ('pyarrow.lib', 'Table'): LEAF,
+    ('pyarrow.lib', 'Buffer'): LEAF,
+    ('pyarrow.lib', 'Scalar'): CONSTANT,
+    ('pyarrow.lib', 'DataType'): CONSTANT,
+    ('torch', 'Tensor'): LEAF,
+}
+
+
+# heap types are the ones defined in Python code
+cdef inline bint _is_trivial(object obj):
+    """
+    Immutable objects without references, which identity does not matter
+    """
+    cdef object t = type(obj)
+    return t is int or t is str or t is float or t is bool or t is bytes or t is complex or obj is None
+
+
+cdef unsigned long _HEAPTYPE_FLAG = 1 << 9
+
+
+cdef object _instance_layout(object t):
+    """
+    Returns slot names of t if its instances are reduced by the default object.__reduce_ex__,
+    so their state can be walked through directly. Returns None otherwise
+    """
+    if t.__reduce_ex__ is not object.__reduce_ex__ or t.__reduce__ is not object.__reduce__:
+        return None
+    if getattr(t, '__getstate__', None) is not getattr(object, '__getstate__', None):
+        return None
+    if hasattr(t, '__getnewargs_ex__') or hasattr(t, '__getnewargs__'):
+        return None
+    # builtin bases like list or dict extend the default reduce with their items
+    for base in t.__mro__:
+        if base is not object and not (base.__flags__ & _HEAPTYPE_FLAG):
+            return None
+    # noinspection PyProtectedMember
+    return tuple(copyreg._slotnames(t))
+
+
+cdef struct _Task:
+    int op
+    PyObject *item
+    PyObject *frame
+    Py_ssize_t pos
+
+
+@cython.final
+cdef class _ImmutableFrame:
+    cdef _ImmutableFrame parent
+    cdef bint all_constants
+
+    def __cinit__(self, _ImmutableFrame parent):
+        self.parent = parent
+        self.all_constants = True
+
+
+@cython.final
+cdef class ConstantCache:
+    """
+    Bounded LRU cache of tuples and frozensets known to hold constants only, shared between walks.
+    Entries are strong references, so a cached address can not be reused by another object;
+    entries referenced by nothing but the cache are dropped by sweep(). Shared by concurrent walks
+    """
+    cdef object _entries
+    # address -> digest of the pickle of the entry, computed on demand for fingerprints
+    cdef dict _digests
+    cdef object _lock
+    cdef Py_ssize_t _max_size
+    cdef Py_ssize_t _min_length
+
+    def __init__(self, max_size: int = CONSTANT_CACHE_SIZE, min_length: int = CONSTANT_CACHE_MIN_LENGTH):
+        self._entries = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._min_length = min_length
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    cpdef bint contains(self, object obj) except -1:
+        if len(obj) < self._min_length:
+            return False
+        key = <uintptr_t> <PyObject *> obj
+        with self._lock:
+            if self._entries.get(key) is obj:
+                self._entries.move_to_end(key)
+                return True
+        return False
 
-
-class Walker:
-    def __init__(self, logger: Logger = None, dispatch_table=None):
+    cpdef int add(self, object obj) except -1:
+        if len(obj) < self._min_length or self._max_size <= 0:
+            return 0
+        key = <uintptr_t> <PyObject *> obj
+        with self._lock:
+            self._entries[key] = obj
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._digests.pop(self._entries.popitem(last=False)[0], None)
+        return 0
+
+    cpdef bytes digest(self, object obj):
+        """
+        Digest of the pickle of a cached entry, None if obj is not cached or could not be pickled
+        """
+        key = <uintptr_t> <PyObject *> obj
+        with self._lock:
+            if self._entries.get(key) is not obj:
+                return None
+            digest = self._digests.get(key)
+        if digest is not None:
+            return digest
+        try:
+            h = new_hash()
+            h.update(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return None
+        digest = h.digest()
+        with self._lock:
+            if self._entries.get(key) is obj:
+                self._digests[key] = digest
+        return digest
+
+    cpdef int sweep(self) except -1:
+        cdef object obj
+        with self._lock:
+            for key in list(self._entries.keys()):
+                obj = self._entries[key]
+                # referenced by the cache and obj only
+                if Py_REFCNT(obj) <= 2:
+                    del self._entries[key]
+                    self._digests.pop(key, None)
+        return 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+
+
+@cython.final
+cdef class LeafTypeRegistry:
+    """
+    Types which instances the walker does not walk through.
+    A type is resolved against its MRO on the first lookup, so subclasses of registered types are leafs too
+    """
+    cdef object _types
+    cdef dict _resolved
+
+    def __init__(self, types: Dict[DynamicTypeMapping.Key, int] = None):
+        self._types = DynamicTypeMapping(DEFAULT_LEAF_TYPES if types is None else types)
+        self._resolved = {}
+
+    def register(self, key: DynamicTypeMapping.Key, action: int = LEAF) -> None:
+        self._types[key] = action
+        self._resolved = {}
+
+    def unregister(self, key: DynamicTypeMapping.Key) -> None:
+        del self._types[key]
+        self._resolved = {}
+
+    def snapshot(self) -> LeafTypeRegistry:
+        """
+        Copy for a single walk, not affected by later registrations
+        """
+        registry = LeafTypeRegistry(dict(self._types))
+        registry._resolved = self._resolved.copy()
+        return registry
+
+    cpdef int action(self, object t) except -1:
+        action = self._resolved.get(t)
+        if action is None:
+            action = self._resolved[t] = self._resolve(t)
+        return action
+
+    cdef int _resolve(self, object t) except -1:
+        for base in t.__mro__:
+            action = self._types.get(base)
+            if action is not None:
+                return action
+        return _DISPATCH_REDUCE
+
+
+@cython.final
+cdef class DisjointSet:
+    """
+    Union-find over dense integer ids with path halving and union by size
+    """
+    cdef vector[int] _parent
+    cdef vector[int] _size
+
+    def __init__(self, int size = 0):
+        self.grow(size)
+
+    def __len__(self) -> int:
+        return self._parent.size()
+
+    cpdef void grow(self, int size):
+        cdef int i
+        for i in range(self._parent.size(), size):
+            self._parent.push_back(i)
+            self._size.push_back(1)
+
+    cpdef int find(self, int x):
+        while self._parent[x] != x:
+            self._parent[x] = self._parent[self._parent[x]]
+            x = self._parent[x]
+        return x
+
+    cpdef int union(self, int x, int y):
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return x
+        if self._size[x] < self._size[y]:
+            x, y = y, x
+        self._parent[y] = x
+        self._size[x] += self._size[y]
+        return x
+
+
+@cython.final
+cdef class IdTable:
+    """
+    Linear probing hash table of object ids, at most half full. An entry holds a label, -1 if none,
+    and a mark, which costs 13 bytes per slot. Allocated with PyMem, so it is seen by tracemalloc
+    """
+    cdef uintptr_t *_keys
+    cdef int *_labels
+    cdef char *_marks
+    cdef Py_ssize_t _capacity
+    cdef Py_ssize_t _size
+    cdef Py_ssize_t _marked
+    cdef int _shift
+
+    def __cinit__(self):
+        self._keys = NULL
+        self._labels = NULL
+        self._marks = NULL
+        self._capacity = 0
+        self._size = 0
+        self._marked = 0
+        self._rehash(ID_TABLE_MIN_CAPACITY)
+
+    def __dealloc__(self):
+        self._free()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        return self._capacity * (sizeof(uintptr_t) + sizeof(int) + sizeof(char))
+
+    cdef void _free(self):
+        PyMem_Free(self._keys)
+        PyMem_Free(self._labels)
+        PyMem_Free(self._marks)
+        self._keys = NULL
+        self._labels = NULL
+        self._marks = NULL
+        self._capacity = 0
+
+    cdef inline Py_ssize_t _home(self, uintptr_t key):
+        # Fibonacci hashing, object addresses are aligned
+        return <Py_ssize_t> ((<uint64_t> key * 0x9E3779B97F4A7C15ULL) >> self._shift)
+
+    cdef inline Py_ssize_t _probe(self, uintptr_t key):
+        """
+        Returns the slot holding key or the empty slot it would be inserted to
+        """
+        cdef Py_ssize_t mask = self._capacity - 1
+        cdef Py_ssize_t i = self._home(key)
+        while self._keys[i] != 0 and self._keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    cdef int _rehash(self, Py_ssize_t capacity) except -1:
+        """
+        Moves entries to new arrays of the given capacity
+        """
+        cdef uintptr_t *keys = self._keys
+        cdef int *labels = self._labels
+        cdef char *marks = self._marks
+        cdef Py_ssize_t old_capacity = self._capacity
+        cdef Py_ssize_t i, j
+        cdef int shift = 64
+        while (<Py_ssize_t> 1 << (64 - shift)) < capacity:
+            shift -= 1
+
+        self._keys = <uintptr_t *> PyMem_Malloc(capacity * sizeof(uintptr_t))
+        self._labels = <int *> PyMem_Malloc(capacity * sizeof(int))
+        self._marks = <char *> PyMem_Malloc(capacity * sizeof(char))
+        if self._keys == NULL or self._labels == NULL or self._marks == NULL:
+            self._free()
+            self._keys = keys
+            self._labels = labels
+            self._marks = marks
+            self._capacity = old_capacity
+            raise MemoryError()
+        memset(self._keys, 0, capacity * sizeof(uintptr_t))
+        self._capacity = capacity
+        self._shift = shift
+
+        for i in range(old_capacity):
+            if keys[i] != 0:
+                j = self._probe(keys[i])
+                self._keys[j] = keys[i]
+                self._labels[j] = labels[i]
+                self._marks[j] = marks[i]
+        PyMem_Free(keys)
+        PyMem_Free(labels)
+        PyMem_Free(marks)
+        return 0
+
+    cdef inline Py_ssize_t find(self, uintptr_t key):
+        """
+        Returns the slot of key or -1
+        """
+        cdef Py_ssize_t i = self._probe(key)
+        return i if self._keys[i] != 0 else -1
+
+    cdef inline Py_ssize_t insert(self, uintptr_t key) except -1:
+        """
+        Returns the slot of key, a new entry has no label and no mark
+        """
+        cdef Py_ssize_t i
+        if (self._size + 1) * 2 > self._capacity:
+            self._rehash(self._capacity * 2)
+        i = self._probe(key)
+        if self._keys[i] == 0:
+            self._keys[i] = key
+            self._labels[i] = -1
+            self._marks[i] = 0
+            self._size += 1
+        return i
+
+    cdef inline void mark(self, Py_ssize_t i):
+        if not self._marks[i]:
+            self._marks[i] = 1
+            self._marked += 1
+
+    cdef void erase(self, Py_ssize_t i):
+        cdef Py_ssize_t mask = self._capacity - 1
+        cdef Py_ssize_t j = i
+        cdef Py_ssize_t k
+        self._marked -= self._marks[i]
+        # backward shift deletion, no tombstones
+        while True:
+            j = (j + 1) & mask
+            if self._keys[j] == 0:
+                break
+            k = self._home(self._keys[j])
+            # entry at j stays if its home slot is cyclically in (i, j]
+            if (i < k <= j) if i <= j else (i < k or k <= j):
+                continue
+            self._keys[i] = self._keys[j]
+            self._labels[i] = self._labels[j]
+            self._marks[i] = self._marks[j]
+            i = j
+        self._keys[i] = 0
+        self._size -= 1
+
+    cdef int drop_labels(self, vector[char] &dropped) except -1:
+        """
+        Removes entries with the labels marked in dropped, in place
+        """
+        cdef Py_ssize_t i = 0
+        cdef Py_ssize_t size = dropped.size()
+        cdef int label
+        while i < self._capacity:
+            label = self._labels[i]
+            if self._keys[i] != 0 and 0 <= label < size and dropped[label]:
+                # the slot is refilled by the backward shift
+                self.erase(i)
+            else:
+                i += 1
+        return 0
+
+    cdef int clear_marks(self) except -1:
+        """
+        Removes all the marks and the entries without a label, in place
+        """
+        cdef Py_ssize_t i = 0
+        if not self._marked:
+            return 0
+        while i < self._capacity:
+            if self._keys[i] != 0 and self._labels[i] < 0:
+                self.erase(i)
+            else:
+                i += 1
+        memset(self._marks, 0, self._capacity * sizeof(char))
+        self._marked = 0
+        return 0
+
+    def clear(self):
+        self._free()
+        self._size = 0
+        self._marked = 0
+        self._rehash(ID_TABLE_MIN_CAPACITY)
+
+
+@cython.final
+cdef class _WalkContext:
+    """
+    State of walks through a single namespace: the state of the walk in progress
+    and what incremental walks continue with. Used by one thread at a time, under its lock
+    """
+    cdef object _lock
+    cdef object _logger
+
+    # interned variable names: label id -> name and back
+    cdef list _labels
+    cdef dict _label_ids
+    # object id -> id of the label that reached it first, kept between walks to allow incremental re-walks;
+    # objects memoized during a walk are marked
+    cdef IdTable _objects
+    cdef set _walked
+    cdef list _components
+    # names walked partially or not walked at all because of the budget
+    cdef set _inexact
+    # names which may share objects with other variables
+    cdef set _mutable
+    # name -> structural fingerprint of the variable, None if it could not be computed; None if disabled
+    cdef dict _fingerprints
+    # hash functions of leaf objects
+    cdef object _hash_functions
+    # type -> token of the type in fingerprints, empty if the type can not be fingerprinted
+    cdef dict _type_tokens
+    # label id -> object id -> position of the object among the ones the variable reached first,
+    # back-references are fingerprinted by positions instead of addresses; None if fingerprints are disabled
+    cdef dict _ordinals
+    cdef dict _current_ordinals
+    # fingerprint of the variable walked, None if it can not be computed
+    cdef object _fingerprint
+    # tokens not hashed yet, hashed in blocks as calls of the hash are expensive
+    cdef vector[char] _tokens
+    cdef size_t _tokens_block_size
+
+    # the memo holds no references: objects reachable from the namespace through containers and instance state
+    # are kept alive by the namespace itself, transient results of reduce are kept alive in _keepalive
+    # as long as the label that reached them, so that their ids are not reused while the table holds them
+    cdef dict _keepalive
+    cdef list _current_keepalive
+
+    # shared between walks
+    cdef ConstantCache _constants
+    # type -> slot names for instances walked without reduce, or None
+    cdef dict _instance_layouts
+
+    cdef DisjointSet _labels_found
+    # label id -> kept component of an incremental walk, which is not walked through again;
+    # labels of kept components reached by the walk
+    cdef dict _kept
+    cdef set _reached
+    cdef int _current_label
+    cdef vector[_Task] _stack
+    cdef _ImmutableFrame _frame
+    cdef bint _full_walk
+    cdef Py_ssize_t _current_subtree_size
+    cdef bint _current_inexact
+
+    # budget
+    cdef Py_ssize_t _subtree_limit
+    cdef Py_ssize_t _collection_limit
+    cdef object _time_limit
+    cdef double _deadline
+    cdef Py_ssize_t _objects_walked
+    cdef bint _exhausted
+    cdef bint _out_of_time
+
+    # snapshots
+    cdef dict _dispatch_table
+    cdef LeafTypeRegistry _leaf_types
+
+    def __init__(self, logger: Logger, dict dispatch_table, LeafTypeRegistry leaf_types, ConstantCache constants,
+                 bint full_walk, time_limit: Optional[float], Py_ssize_t subtree_limit, Py_ssize_t collection_limit,
+                 hash_functions: Optional[DynamicTypeMapping] = None):
+        self._lock = threading.Lock()
         self._logger = logger
-        self._constant = object()
 
-        self._object_labels = None
-        self._memo = None
+        self._labels = []
+        self._label_ids = {}
+        self._walked = set()
+        self._components = None
+        self._inexact = set()
+        self._mutable = set()
+        self._objects = IdTable()
+        self._keepalive = {}
+        self._current_keepalive = None
+        self._fingerprints = None if hash_functions is None else {}
+        self._hash_functions = hash_functions
+        self._type_tokens = {}
+        self._ordinals = None if hash_functions is None else {}
+        self._current_ordinals = None
+        self._fingerprint = None
+        self._tokens_block_size = FINGERPRINT_BLOCK_SIZE
+        self._constants = constants
+        self._instance_layouts = {}
 
         self._labels_found = None
-        self._current_label = None
-        self._full_walk = False
+        self._kept = {}
+        self._reached = set()
+        self._current_label = -1
+        self._frame = None
+        self._full_walk = full_walk
         self._current_subtree_size = 0
+        self._current_inexact = False
 
-        if dispatch_table is None:
-            dispatch_table = copyreg.dispatch_table.copy()
-        self._dispatch_table = dispatch_table
-
-    def enable_full_walk(self):
-        self._full_walk = True
+        self._subtree_limit = subtree_limit
+        self._collection_limit = collection_limit
+        self._time_limit = time_limit
+        self._deadline = 0
+        self._objects_walked = 0
+        self._exhausted = False
+        self._out_of_time = False
 
-    def disable_full_walk(self):
-        self._full_walk = False
-
-    def walk(self, env: Dict[str, object]) -> Iterable[Set[str]]:
-        if 'numpy' in sys.modules:
-            import numpy
-            self.dispatch[numpy.dtype]   = Walker.ignore_subtree
-            self.dispatch[numpy.ndarray] = Walker.ignore_subtree
-
-        if 'pandas' in sys.modules:
-            import pandas
-            self.dispatch[pandas.DataFrame] = Walker.ignore_subtree
-            self.dispatch[pandas.Series]    = Walker.ignore_subtree
-
-        self._object_labels = {}
-        self._memo = {}
+        self._dispatch_table = dispatch_table
+        self._leaf_types = leaf_types
+
+    def __dealloc__(self):
+        self._clear_stack()
+
+    cdef list walk(self, object env):
+        return self._walk(env, list(env.keys()), [])
+
+    cdef list walk_incremental(self, object env, object touched, object deleted):
+        """
+        Re-walks touched and deleted variables together with the components they belonged to
+        during the previous walk, walks through the whole namespace if there was none
+        """
+        if self._components is None:
+            return self.walk(env)
+        known = self._walked
+        dirty = set(touched)
+        dirty.update(deleted)
+        dirty.update(name for name in env.keys() if name not in known)
+        dirty.update(name for name in known if name not in env)
+
+        affected = set(dirty)
+        kept_components = []
+        for component in self._components:
+            if component & dirty:
+                affected.update(component)
+            else:
+                kept_components.append(component)
+
+        self._forget_labels(affected)
+
+        rewalk = [name for name in env.keys() if name in affected]
+        return self._walk(env, rewalk, kept_components)
+
+    cdef int _label_id(self, str name) except -1:
+        label = self._label_ids.get(name)
+        if label is None:
+            label = len(self._labels)
+            self._labels.append(name)
+            self._label_ids[name] = label
+        return label
+
+    cdef int _forget_labels(self, set names) except -1:
+        cdef vector[char] dropped
+        dropped.resize(len(self._labels), 0)
+        for name in names:
+            self._walked.discard(name)
+            self._inexact.discard(name)
+            self._mutable.discard(name)
+            if self._fingerprints is not None:
+                self._fingerprints.pop(name, None)
+            label = self._label_ids.get(name)
+            if label is not None:
+                dropped[label] = 1
+                self._keepalive.pop(label, None)
+                if self._ordinals is not None:
+                    self._ordinals.pop(label, None)
+        # a single pass over the table for all the labels
+        self._objects.drop_labels(dropped)
+        return 0
+
+    cdef list _reached_kept_names(self, object env):
+        """
+        Forgets kept components reached by the walk and returns their names to walk through again: the objects
+        they share may have changed, e.g. through an alias, so the objects they reach may have too
+        """
+        names = set()
+        for label in self._reached:
+            component = self._kept.get(label)
+            if component is not None:
+                for name in component:
+                    del self._kept[self._label_ids[name]]
+                names.update(component)
+        self._reached.clear()
+        if not names:
+            return []
+        self._forget_labels(names)
+        return [name for name in env.keys() if name in names]
+
+    cdef list _walk(self, object env, list names, list kept_components):
+        cdef int first, label
+        cdef Py_ssize_t skipped = 0
+        self._objects_walked = 0
+        self._out_of_time = False
+        if self._time_limit is not None:
+            self._deadline = perf_counter() + self._time_limit
+        self._objects.clear_marks()
 
-        label_sets = []
         for name in env.keys():
-            self._labels_found = {name}
-            self._current_label = name
-            self._current_subtree_size = 0
-            if self._logger:
-                self._logger.info(f"Walking through variable {name}")
-            try:
-                self._save(env[name])
-            except Exception as e:
+            self._label_id(name)
+        self._labels_found = DisjointSet(len(self._labels))
+
+        for component in kept_components:
+            first = -1
+            for name in component:
+                label = self._label_ids[name]
+                self._kept[label] = component
+                if first < 0:
+                    first = label
+                else:
+                    self._labels_found.union(first, label)
+
+        while names:
+            for name in names:
+                obj = env[name]
+                self._walked.add(name)
+                if self._out_of_time:
+                    if not self._is_constant(obj):
+                        self._inexact.add(name)
+                        self._mutable.add(name)
+                        skipped += 1
+                    if self._fingerprints is not None:
+                        self._fingerprints[name] = None
+                    continue
+
+                self._current_label = self._label_ids[name]
+                self._current_keepalive = []
+                self._current_subtree_size = 0
+                self._current_inexact = False
+                self._exhausted = False
+                if self._fingerprints is not None:
+                    self._fingerprint = new_hash()
+                    self._current_ordinals = {}
                 if self._logger:
-                    self._logger.exception(f"Walker: could not walk through variable {name} of type {type(env[name])}", e)
-            finally:
-                if self._logger:
-                    self._logger.info(f"Walked through variable {name}")
-                label_sets.append(self._labels_found)
-
-        # keep names that are presented in env
-        for label_set in label_sets:
-            for label in label_set.copy():
-                if label not in env:
-                    label_set.remove(label)
-
-        # unite components
-        for i, labels in enumerate(label_sets):
-            for j, lab in enumerate(islice(label_sets, 0, i)):
-                if labels & lab:
-                    labels.update(lab)
-                    label_sets[j] = labels
-        clusters = [frozenset(s) for s, _ in groupby(sorted(label_sets, key=id))]
-
-        if self._object_labels is not None:
-            self._object_labels.clear()
-        if self._memo is not None:
-            self._memo.clear()
-        if self._labels_found is not None:
-            self._labels_found.clear()
+                    self._logger.info(f"Walking through variable {name}")
+                try:
+                    if not self._save(obj):
+                        self._mutable.add(name)
+                except Exception as e:
+                    self._current_inexact = True
+                    self._mutable.add(name)
+                    if self._logger:
+                        self._logger.exception(f"Walker: could not walk through variable {name} of type {type(obj)}", e)
+                finally:
+                    if self._logger:
+                        self._logger.info(f"Walked through variable {name}")
+
+                if self._fingerprints is not None:
+                    exact = self._fingerprint is not None and not self._exhausted and not self._current_inexact
+                    if exact:
+                        self._flush_tokens()
+                    self._fingerprints[name] = self._fingerprint.digest() if exact else None
+                    self._fingerprint = None
+                    self._tokens.clear()
+                    self._ordinals[self._current_label] = self._current_ordinals
+                    self._current_ordinals = None
+
+                if self._current_keepalive:
+                    self._keepalive[self._current_label] = self._current_keepalive
+                self._current_keepalive = None
+
+                if self._exhausted or self._current_inexact:
+                    self._inexact.add(name)
+                    if self._logger:
+                        self._logger.warn(f"Walker: variable {name} is walked through partially "
+                                          "and merged with all variables it might share objects with\n"
+                                          "Use %enable_full_walk to serialize all variables correctly")
+
+            # kept components reached through objects changed by the walked variables are stale
+            names = self._reached_kept_names(env)
+
+        if skipped and self._logger:
+            self._logger.warn(f"Walker: out of time, {skipped} variables are not walked through "
+                              "and merged with all variables they might share objects with\n"
+                              "Use %enable_full_walk to serialize all variables correctly")
+
+        # conservative merge: unwalked objects may be reachable from any variable which is not a constant
+        first = -1
+        for name in env.keys():
+            if name in self._inexact:
+                first = self._label_ids[name]
+                break
+        if first >= 0:
+            for name in env.keys():
+                if name in self._mutable:
+                    self._labels_found.union(first, self._label_ids[name])
+
+        # unite components, keeping names that are presented in env
+        clusters = {}
+        for name in env.keys():
+            root = self._labels_found.find(self._label_ids[name])
+            clusters.setdefault(root, set()).add(name)
+        self._components = [frozenset(s) for s in clusters.values()]
+
+        self._objects.clear_marks()
+        self._labels_found = None
+        self._kept.clear()
+        self._current_label = -1
+        self._constants.sweep()
 
         # noinspection PyTypeChecker
-        return clusters
+        return self._components
+
+    cdef bint _is_constant(self, object obj) except -1:
+        cdef object t = type(obj)
+        if t is tuple or t is frozenset:
+            return self._constants.contains(obj)
+        return _is_trivial(obj) or self._leaf_types.action(t) == _DISPATCH_CONSTANT
 
-    def _error(self, msg: str) -> None:
+    cdef void _error(self, str msg):
         if self._logger is not None:
             self._logger.error(msg)
 
-    def _was_visited(self, obj: object) -> bool:
-        return id(obj) in self._object_labels
-
-    def _save(self, obj: object) -> None:
-        if not self._full_walk and self._current_subtree_size > WALK_SUBTREE_LIMIT:
-            if self._logger is not None:
-                message = f"Skipping walk through {str(type(obj))}\n"\
-                          "Walking trough too many objects\n"\
-                          "Use %enable_full_walk to serialize all variables correctly"
-                self._logger.warn(message)
-            raise Exception('walk depth limit exceeded')
-        self._current_subtree_size += 1
+    # Work stack keeps strong references to the task items and frames
 
-        assert self._labels_found is not None
+    cdef inline void _push(self, int op, object item, _ImmutableFrame frame = None, Py_ssize_t pos = 0):
+        cdef _Task task
+        task.op = op
+        task.item = <PyObject *> item
+        Py_INCREF(item)
+        if frame is None:
+            task.frame = NULL
+        else:
+            task.frame = <PyObject *> frame
+            Py_INCREF(frame)
+        task.pos = pos
+        self._stack.push_back(task)
+
+    cdef inline void _pop(self):
+        cdef _Task task = self._stack.back()
+        self._stack.pop_back()
+        Py_DECREF(<object> task.item)
+        if task.frame != NULL:
+            Py_DECREF(<object> task.frame)
+
+    cdef void _clear_stack(self):
+        while not self._stack.empty():
+            self._pop()
+
+    cdef int _save(self, object obj) except -1:
+        """
+        Walks through obj and everything reachable from it, returns whether obj is a constant.
+        Uses an explicit work stack instead of recursion, so graph depth is limited by memory only
+        """
+        cdef _Task task
+        cdef Py_ssize_t top, pos
+        cdef PyObject *key
+        cdef PyObject *value
+        cdef int result
+        cdef _ImmutableFrame frame
+        cdef _ImmutableFrame root = _ImmutableFrame(None)
+
+        self._push(_SAVE, obj, root)
+        try:
+            while not self._stack.empty() and not self._exhausted:
+                top = self._stack.size() - 1
+                task = self._stack[top]
+                item = <object> task.item
+                frame = <_ImmutableFrame> task.frame if task.frame != NULL else None
+
+                if task.op == _TUPLE_ITEMS:
+                    if task.pos < PyTuple_GET_SIZE(item):
+                        self._stack[top].pos += 1
+                        self._push(_SAVE, <object> PyTuple_GET_ITEM(item, task.pos), frame)
+                    else:
+                        self._pop()
+                elif task.op == _LIST_ITEMS:
+                    if task.pos < PyList_GET_SIZE(item):
+                        self._stack[top].pos += 1
+                        self._push(_SAVE, <object> PyList_GET_ITEM(item, task.pos))
+                    else:
+                        self._pop()
+                elif task.op == _DICT_ITEMS:
+                    pos = task.pos
+                    if PyDict_Next(item, &pos, &key, &value):
+                        self._stack[top].pos = pos
+                        self._push(_SAVE, <object> value)
+                        self._push(_SAVE, <object> key)
+                    else:
+                        self._pop()
+                elif task.op == _ITEMS:
+                    for x in item:
+                        self._push(_SAVE, x, frame)
+                        break
+                    else:
+                        self._pop()
+                elif task.op == _PAIRS:
+                    for k, v in item:
+                        self._push(_SAVE, v)
+                        self._push(_SAVE, k)
+                        break
+                    else:
+                        self._pop()
+                else:
+                    self._pop()
+                    if task.op == _SAVE:
+                        self._frame = frame
+                        result = self._save_object(item)
+                        if frame is not None and result == _RESULT_NONE:
+                            frame.all_constants = False
+                    elif task.op == _MEMOIZE:
+                        if not self._is_memoized(item):
+                            self._memoize(item)
+                    elif task.op == _END_IMMUTABLE:
+                        self._end_immutable(item, frame)
+        finally:
+            self._clear_stack()
+            self._frame = None
+        return root.all_constants and not self._exhausted
+
+    cdef int _save_object(self, object obj) except -1:
+        if not self._full_walk:
+            if self._current_subtree_size >= self._subtree_limit:
+                self._exhausted = True
+                return _RESULT_NONE
+            self._objects_walked += 1
+            if self._time_limit is not None and (self._objects_walked & (DEADLINE_CHECK_PERIOD - 1)) == 0 \
+                    and perf_counter() > self._deadline:
+                self._exhausted = self._out_of_time = True
+                return _RESULT_NONE
+        self._current_subtree_size += 1
 
         # check object type
-        t = type(obj)
-        dispatch_f = self.dispatch.get(t)
-        # do nothing if saving constant or saving a forbidden obj
-        if dispatch_f is Walker.save_constant or \
-            (obj is type(None)) or (obj is type(NotImplemented)) or (obj is type(...)):
-            return None
-
-        was_visited = self._was_visited(obj)
-        self._visit_object(obj)
-
-        if was_visited or dispatch_f is Walker.ignore_subtree:
-            return None
+        cdef object t = type(obj)
+        cdef int action
+        if t is str or t is int or t is float or t is bool:
+            if self._fingerprint is not None:
+                self._feed_trivial(obj)
+            return _RESULT_CONSTANT
+        elif t is tuple:
+            if self._constants.contains(obj):
+                if self._fingerprint is not None:
+                    self._feed_cached_constant(obj)
+                return _RESULT_CONSTANT
+            action = _DISPATCH_TUPLE
+        elif t is list:
+            action = _DISPATCH_LIST
+        elif t is dict:
+            action = _DISPATCH_DICT
+        elif t is set:
+            action = _DISPATCH_SET
+        elif t is frozenset:
+            if self._constants.contains(obj):
+                if self._fingerprint is not None:
+                    self._feed_cached_constant(obj)
+                return _RESULT_CONSTANT
+            action = _DISPATCH_FROZENSET
+        else:
+            action = self._leaf_types.action(t)
 
-        # visit with dispatch table
-        if dispatch_f is not None:
-            # noinspection PyArgumentList
-            result = dispatch_f(self, obj)  # Call unbound method with explicit self
-            if result == self._constant:
-                self._unvisit_object(obj)
-            return result
+        # do nothing if saving constant or saving a forbidden obj
+        if action == _DISPATCH_CONSTANT:
+            if self._fingerprint is not None:
+                self._feed_constant(obj)
+            return _RESULT_CONSTANT
+        if (obj is _NoneType) or (obj is _NotImplementedType) or (obj is _EllipsisType):
+            if self._fingerprint is not None:
+                self._feed(b'S%a;' % obj)
+            return _RESULT_NONE
+
+        if self._visit_object(obj):
+            # was visited
+            if self._fingerprint is not None:
+                self._feed_reference(obj)
+            return _RESULT_NONE
+        if action == _DISPATCH_IGNORE:
+            if self._fingerprint is not None:
+                self._feed_digest(obj, False)
+            return _RESULT_NONE
+        if self._fingerprint is not None:
+            self._feed_header(obj, t, action)
+
+        # visit with fast paths
+        if action == _DISPATCH_TUPLE:
+            return self._save_tuple(obj)
+        elif action == _DISPATCH_LIST:
+            self._save_list(obj)
+            return _RESULT_NONE
+        elif action == _DISPATCH_DICT:
+            self._save_dict(obj)
+            return _RESULT_NONE
+        elif action == _DISPATCH_SET:
+            self._save_set(obj)
+            return _RESULT_NONE
+        elif action == _DISPATCH_FROZENSET:
+            return self._save_frozenset(obj)
 
         # check copyreg.dispatch_table
         reduce = self._dispatch_table.get(t)
-        if reduce is None and issubclass(t, type):
-            reduce = reduce_type
+        if reduce is None:
+            if issubclass(t, type):
+                reduce = reduce_type
+            else:
+                layout = self._instance_layouts.get(t, _NoneType)
+                if layout is _NoneType:
+                    layout = self._instance_layouts[t] = _instance_layout(t)
+                if layout is not None:
+                    self._save_instance(obj, layout)
+                    return _RESULT_NONE
 
         if reduce is not None:
             # noinspection PyTypeChecker
@@ -153,13 +1033,13 @@ class Walker:
         if rv is SAVE_GLOBAL:
             self._unvisit_object(obj)
             self._save_global(obj)
-            return None
+            return _RESULT_NONE
 
         # Check for string returned by reduce(), meaning "save as global"
         if isinstance(rv, str):
             self._unvisit_object(obj)
             self._save_global(obj, rv)
-            return None
+            return _RESULT_NONE
 
         # Assert that reduce() returned a tuple
         if not isinstance(rv, tuple):
@@ -171,151 +1051,198 @@ class Walker:
             raise Exception('Tuple returned by {!r} must have two to five elements'.format(reduce))
 
         # Save the reduce() output and finally memoize the object
-        if self._save_reduce(obj=obj, *rv) == self._constant:
-            self._unvisit_object(obj)
-
-    def _visit_object(self, obj: object) -> None:
-        labels = self._object_labels.setdefault(id(obj), self._labels_found)
-        self._labels_found.update(labels)
-        labels.add(self._current_label)
-        # co_names was removed here,
-        # co_names - tuple of names of local variables
-
-    def _unvisit_object(self, obj: object) -> None:
-        del self._object_labels[id(obj)]
+        rv = rv + (None,) * (5 - length)
+        self._current_keepalive.append(rv)
+        self._save_reduce(obj, rv[0], rv[1], rv[2], rv[3], rv[4])
+        return _RESULT_NONE
+
+    cdef inline int _visit_object(self, object obj) except -1:
+        """
+        Labels the object with the current label, returns whether it was visited before
+        """
+        cdef Py_ssize_t i = self._objects.insert(<uintptr_t> <PyObject *> obj)
+        cdef int label = self._objects._labels[i]
+        if label < 0:
+            self._objects._labels[i] = self._current_label
+            if self._current_ordinals is not None:
+                self._current_ordinals[<uintptr_t> <PyObject *> obj] = len(self._current_ordinals)
+            return False
+        if label != self._current_label:
+            self._labels_found.union(label, self._current_label)
+            if label in self._kept:
+                self._reached.add(label)
+        return True
+
+    cdef inline void _unvisit_object(self, object obj):
+        cdef Py_ssize_t i = self._objects.find(<uintptr_t> <PyObject *> obj)
+        if i < 0:
+            return
+        if self._objects._marks[i]:
+            self._objects._labels[i] = -1
+        else:
+            self._objects.erase(i)
 
-    def _save_reduce(self, func: Callable, args: Tuple, state=None, listitems=None, dictitems=None, obj=None) -> None:
+    cdef int _save_reduce(self, object obj, object func, object args, object state=None, object listitems=None,
+                          object dictitems=None) except -1:
         if not isinstance(args, tuple):
             raise Exception('args from save_reduce() must be a tuple')
         if not callable(func):
             raise Exception('func from save_reduce() must be callable')
 
-        func_name = getattr(func, "__name__", "")
-        if func_name == "__newobj__":
-            # Commented by tomato start
-            # cls = args[0]
-            # if not hasattr(cls, "__new__"):
-            #     raise Exception('args[0] from __newobj__ args has no __new__')
-            # if obj is not None and cls is not obj.__class__:
-            #     raise Exception('args[0] from __newobj__ args has the wrong class')
-            # cls_result = self._save(cls)
-            # Commented by tomato end
-
-            args = args[1:]
-            self._save(args)
-        else:
-            self._save(func)
-            self._save(args)
+        # the work stack is LIFO, so the parts are pushed in the reversed order
+        # of how the pickler saves them: func, args, obj memo, listitems, dictitems, state
 
-        if obj is not None:
-            if id(obj) not in self._memo:
-                self._memoize(obj)
-            else:
-                pass
-                # recursive
+        if state is not None:
+            self._push(_SAVE, state)
 
         # More new special cases (that work with older protocols as
         # well): when __reduce__ returns a tuple with 4 or 5 items,
         # the 4th and 5th item should be iterators that provide list
         # items and dict items (as (key, value) tuples), or None.
 
-        if listitems is not None:
-            self._batch_appends(listitems)
-
+        # items produced by the iterators may be transient
         if dictitems is not None:
-            self._batch_setitems(dictitems)
-
-        if state is not None:
-            self._save(state)
+            dictitems = list(dictitems)
+            self._current_keepalive.append(dictitems)
+            self._push(_PAIRS, iter(dictitems))
 
-    # Methods below this point are dispatched through the dispatch table
-
-    forbidden_objects = (type(None), type(NotImplemented), type(...))
-
-    dispatch = {}
-
-    def save_constant(self, _) -> object:
-        return self._constant
+        if listitems is not None:
+            listitems = list(listitems)
+            self._current_keepalive.append(listitems)
+            self._push(_LIST_ITEMS, listitems)
 
-    def ignore_subtree(self, _):
-        pass
+        if self._fingerprint is not None:
+            # the parts walked through next, so that the fingerprint is unambiguous
+            self._feed(b'R%d;%d;%d;%d;' % (
+                state is not None, -1 if listitems is None else len(listitems),
+                -1 if dictitems is None else len(dictitems), getattr(func, "__name__", "") == "__newobj__"))
 
-    dispatch[type(None)] = save_constant
-    dispatch[bool] = save_constant
-    dispatch[int] = save_constant
-    dispatch[float] = save_constant
-    dispatch[str] = save_constant
-    dispatch[ModuleType] = save_constant
+        if obj is not None:
+            # memoized after args unless it is recursive
+            self._push(_MEMOIZE, obj)
 
-    dispatch[bytes] = ignore_subtree
+        func_name = getattr(func, "__name__", "")
+        if func_name == "__newobj__":
+            # Commented by tomato start
+            # cls = args[0]
+            # if not hasattr(cls, "__new__"):
+            #     raise Exception('args[0] from __newobj__ args has no __new__')
+            # if obj is not None and cls is not obj.__class__:
+            #     raise Exception('args[0] from __newobj__ args has the wrong class')
+            # cls_result = self._save(cls)
+            # Commented by tomato end
 
-    def _save_tuple(self, obj: Tuple) -> object:
+            # the slice is a new tuple, its id must not be reused during the walk
+            args = args[1:]
+            self._current_keepalive.append(args)
+            self._push(_SAVE, args)
+        else:
+            self._push(_SAVE, args)
+            self._push(_SAVE, func)
+        return 0
+
+    cdef int _save_instance(self, object obj, tuple slots) except -1:
+        """
+        Walks through the state object.__reduce_ex__ would return, without building it
+        """
+        # args of __newobj__ are empty, the object is memoized right away
+        # slots and the state present, in the order they are walked through
+        cdef bytearray present = bytearray(b'I') if self._fingerprint is not None else None
+        if not self._is_memoized(obj):
+            self._memoize(obj)
+        for name in reversed(slots):
+            value = getattr(obj, name, _NoneType)
+            if value is not _NoneType:
+                self._push(_SAVE, value)
+            if present is not None:
+                present += b'0' if value is _NoneType else b'1'
+        state = getattr(obj, '__dict__', None)
+        if state:
+            self._push(_SAVE, state)
+        if present is not None:
+            present += b'd;' if state else b';'
+            self._feed(bytes(present))
+        return 0
+
+    # Fast paths for builtin collections
+
+    cdef int _save_tuple(self, tuple obj) except -1:
         if not obj:  # tuple is empty
-            return self._constant
+            self._unvisit_object(obj)
+            return _RESULT_CONSTANT
+
+        # constant property is known only after all the elements are walked through
+        frame = _ImmutableFrame(self._frame)
+        self._push(_END_IMMUTABLE, obj, frame)
+        if self._should_sample(len(obj)):
+            if not self._unsampled_are_trivial(islice(obj, self._collection_limit, None)):
+                frame.all_constants = False
+            self._push(_ITEMS, islice(obj, self._collection_limit), frame)
+        else:
+            self._push(_TUPLE_ITEMS, obj, frame)
+        return _RESULT_DEFERRED
 
-        all_constants = True
-        for element in obj:
-            if self._save(element) != self._constant:
-                all_constants = False
+    cdef int _end_immutable(self, object obj, _ImmutableFrame frame) except -1:
+        if frame.all_constants:
+            self._unvisit_object(obj)
+            self._constants.add(obj)
+            return 0
 
-        if all_constants:
-            # todo save constant property in memo
-            return self._constant
+        if frame.parent is not None:
+            frame.parent.all_constants = False
 
-        if id(obj) in self._memo:
-            # recursive tuple
-            return
+        if self._is_memoized(obj):
+            # recursive tuple or frozenset
+            return 0
 
         # No recursion
         self._memoize(obj)
+        return 0
 
-    dispatch[tuple] = _save_tuple
-
-    def _save_list(self, obj) -> None:
-        self._memoize(obj)
-        if self._should_stop_walking(obj, len(obj)):
-            return
-        for x in obj:
-            self._save(x)
-
-    dispatch[list] = _save_list
-
-    def _batch_appends(self, items) -> None:
-        for x in items:
-            self._save(x)
-
-    def _save_dict(self, obj) -> None:
+    cdef int _save_list(self, list obj) except -1:
         self._memoize(obj)
-        if self._should_stop_walking(obj, len(obj)):
-            return
-        self._batch_setitems(obj.items())
-
-    dispatch[dict] = _save_dict
-
-    def _batch_setitems(self, items) -> None:
-        for k, v in items:
-            self._save(k)
-            self._save(v)
+        if self._should_sample(len(obj)):
+            self._unsampled_are_trivial(islice(obj, self._collection_limit, None))
+            self._push(_ITEMS, islice(obj, self._collection_limit))
+        else:
+            self._push(_LIST_ITEMS, obj)
+        return 0
 
-    def _save_set(self, obj) -> None:
+    cdef int _save_dict(self, dict obj) except -1:
         self._memoize(obj)
-        if self._should_stop_walking(obj, len(obj)):
-            return
-        for item in obj:
-            self._save(item)
-
-    dispatch[set] = _save_set
+        if self._should_sample(len(obj)):
+            if self._unsampled_are_trivial(islice(obj.keys(), self._collection_limit, None)):
+                self._unsampled_are_trivial(islice(obj.values(), self._collection_limit, None))
+            self._push(_PAIRS, islice(obj.items(), self._collection_limit))
+        else:
+            self._push(_DICT_ITEMS, obj)
+        return 0
 
-    def _save_frozenset(self, obj) -> None:
+    cdef int _save_set(self, object obj) except -1:
         self._memoize(obj)
-        if self._should_stop_walking(obj, len(obj)):
-            return
-        for item in obj:
-            self._save(item)
+        if self._should_sample(len(obj)):
+            self._unsampled_are_trivial(islice(obj, self._collection_limit, None))
+            self._push(_ITEMS, islice(obj, self._collection_limit))
+        else:
+            self._push(_ITEMS, iter(obj))
+        return 0
 
-    dispatch[frozenset] = _save_frozenset
+    cdef int _save_frozenset(self, frozenset obj) except -1:
+        if not obj:
+            self._unvisit_object(obj)
+            return _RESULT_CONSTANT
+
+        frame = _ImmutableFrame(self._frame)
+        self._push(_END_IMMUTABLE, obj, frame)
+        if self._should_sample(len(obj)):
+            if not self._unsampled_are_trivial(islice(obj, self._collection_limit, None)):
+                frame.all_constants = False
+            self._push(_ITEMS, islice(obj, self._collection_limit), frame)
+        else:
+            self._push(_ITEMS, iter(obj), frame)
+        return _RESULT_DEFERRED
 
-    def _save_global(self, obj, name: str = None) -> None:
+    cdef int _save_global(self, object obj, str name = None) except -1:
         result = check_object_importable_by_name(obj, name)
         if result is None:
             raise Exception("Can't save_global {!r}, type: {}: object is not importable by name".format(obj, type(obj)))
@@ -325,18 +1252,26 @@ class Walker:
         code = copyreg._extension_registry.get((module_name, name))
         if code:
             assert code > 0
-            return
+            if self._fingerprint is not None:
+                self._feed(b'X%d;' % code)
+            return 0
 
         lastname = name.rpartition('.')[2]
         if parent is module:
             name = lastname
 
-        self._save(module_name)
-        self._save(name)
+        self._push(_MEMOIZE, obj)
+        self._push(_SAVE, name)
+        self._push(_SAVE, module_name)
+        if self._fingerprint is not None:
+            self._feed(b'G')
+        return 0
 
-        self._memoize(obj)
+    cdef inline bint _is_memoized(self, object obj):
+        cdef Py_ssize_t i = self._objects.find(<uintptr_t> <PyObject *> obj)
+        return i >= 0 and self._objects._marks[i]
 
-    def _memoize(self, obj: object) -> None:
+    cdef inline int _memoize(self, object obj) except -1:
         """Store an object in the memo."""
 
         # The Pickler memo is a dictionary mapping object ids to 2-tuples
@@ -351,14 +1286,349 @@ class Walker:
         # But there appears no advantage to any other scheme, and this
         # scheme allows the Unpickler memo to be implemented as a plain (but
         # growable) array, indexed by memo key.
-        # assert id(obj) not in self._memo
-        self._memo[id(obj)] = obj
-
-    def _should_stop_walking(self, obj, size: int) -> bool:
-        if not self._full_walk and (self._current_subtree_size + size > WALK_SUBTREE_LIMIT or size > WALK_COLLECTION_LIMIT):
-            if self._logger is not None:
-                message = f"Skipping walk through {str(type(obj))} with size: {str(size)}\n"\
-                          "Use %enable_full_walk to serialize all variables correctly"
-                self._logger.warn(message)
-            return True
-        return False
+        self._objects.mark(self._objects.insert(<uintptr_t> <PyObject *> obj))
+        return 0
+
+    # Sampling of large collections
+
+    cdef inline bint _should_sample(self, Py_ssize_t size):
+        return not self._full_walk and size > self._collection_limit
+
+    cdef bint _unsampled_are_trivial(self, object items) except -1:
+        """
+        Items left out of a sample are only checked for being trivial constants,
+        otherwise the current variable is walked through partially
+        """
+        for item in items:
+            if not _is_trivial(item):
+                self._current_inexact = True
+                return False
+            if self._fingerprint is not None:
+                self._feed_trivial(item)
+        return True
+
+    # Structural fingerprints: a stream of the objects in the order they are walked through,
+    # every object is followed by the objects it refers to. The stream is unambiguous,
+    # because the header of every object determines how many objects it refers to
+
+    cdef int _flush_tokens(self) except -1:
+        if not self._tokens.empty():
+            self._fingerprint.update(PyBytes_FromStringAndSize(self._tokens.data(), self._tokens.size()))
+            self._tokens.clear()
+        return 0
+
+    cdef inline int _put(self, const char *data, size_t size) except -1:
+        cdef size_t end = self._tokens.size()
+        if size == 0:
+            return 0
+        self._tokens.resize(end + size)
+        memcpy(self._tokens.data() + end, data, size)
+        if self._tokens.size() >= self._tokens_block_size:
+            self._flush_tokens()
+        return 0
+
+    cdef inline int _feed(self, bytes token) except -1:
+        return self._put(PyBytes_AS_STRING(token), PyBytes_GET_SIZE(token))
+
+    cdef inline int _feed_int(self, char tag, int64_t value) except -1:
+        """
+        Tags followed by fixed size values, e.g. of ints, floats and lengths
+        """
+        self._put(&tag, 1)
+        return self._put(<const char *> &value, sizeof(value))
+
+    cdef int _feed_trivial(self, object obj) except -1:
+        cdef object t = type(obj)
+        cdef int overflow = 0
+        cdef int64_t value
+        cdef double real
+        if t is str:
+            # strings are stored in the narrowest kind their characters fit, so raw data identify them
+            self._feed_int(b's', PyUnicode_GET_LENGTH(obj))
+            self._feed_int(b'k', PyUnicode_KIND(obj))
+            self._put(<const char *> PyUnicode_DATA(obj), PyUnicode_GET_LENGTH(obj) * PyUnicode_KIND(obj))
+        elif t is int:
+            value = PyLong_AsLongLongAndOverflow(obj, &overflow)
+            if overflow:
+                self._feed(b'j%d;' % obj)
+            else:
+                self._feed_int(b'i', value)
+        elif t is bool:
+            self._feed_int(b'b', obj is True)
+        elif t is float:
+            real = PyFloat_AS_DOUBLE(obj)
+            memcpy(&value, &real, sizeof(value))
+            self._feed_int(b'f', value)
+        elif t is complex:
+            self._feed(b'c%a;' % obj)
+        elif t is bytes:
+            self._feed_int(b'y', PyBytes_GET_SIZE(obj))
+            self._feed(obj)
+        else:
+            self._feed(b'N')
+        return 0
+
+    cdef int _feed_type(self, object t) except -1:
+        token = self._type_tokens.get(t)
+        if token is None:
+            token = self._type_tokens[t] = self._type_token(t)
+        if not token:
+            self._fingerprint = None
+            return 0
+        self._feed(token)
+        return 0
+
+    cdef bytes _type_token(self, object t):
+        """
+        Types are fingerprinted by name; the ones pickled by value, e.g. classes defined in a notebook,
+        by their pickles too, which tell redefined classes apart
+        """
+        token = f'T{t.__module__}.{t.__qualname__};'.encode('utf-8', 'surrogatepass')
+        if not type_needs_to_be_saved_as_local(t):
+            return token
+        try:
+            # pickling instances caches slot names in the class, so it is pickled with them
+            # noinspection PyProtectedMember
+            copyreg._slotnames(t)
+            h = new_hash()
+            h.update(cloudpickle.dumps(t, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return b''
+        return token + h.digest()
+
+    cdef int _feed_reference(self, object obj) except -1:
+        """
+        Objects reached before are referred to by the variable that reached them first and their position
+        """
+        cdef uintptr_t key = <uintptr_t> <PyObject *> obj
+        cdef int label = self._objects._labels[self._objects.find(key)]
+        if label == self._current_label:
+            ordinals = self._current_ordinals
+        else:
+            ordinals = self._ordinals.get(label)
+        ordinal = None if ordinals is None else ordinals.get(key)
+        if ordinal is None:
+            self._fingerprint = None
+            return 0
+        if label == self._current_label:
+            self._feed_int(b'^', ordinal)
+        else:
+            name = self._labels[label].encode('utf-8', 'surrogatepass')
+            self._feed_int(b'@', len(name))
+            self._feed(name)
+            self._feed_int(b'#', ordinal)
+        return 0
+
+    cdef int _feed_header(self, object obj, object t, int action) except -1:
+        if action == _DISPATCH_TUPLE:
+            self._feed_int(b'(', len(obj))
+        elif action == _DISPATCH_LIST:
+            self._feed_int(b'[', len(obj))
+        elif action == _DISPATCH_DICT:
+            self._feed_int(b'{', len(obj))
+        elif action == _DISPATCH_SET:
+            self._feed_int(b'<', len(obj))
+        elif action == _DISPATCH_FROZENSET:
+            self._feed_int(b'>', len(obj))
+        else:
+            self._feed_type(t)
+        return 0
+
+    cdef int _feed_constant(self, object obj) except -1:
+        if obj is None:
+            self._feed(b'N')
+        elif type(obj) is ModuleType:
+            self._feed(b'M%s;' % obj.__name__.encode('utf-8', 'surrogatepass'))
+        else:
+            self._feed_digest(obj, True)
+        return 0
+
+    cdef int _feed_cached_constant(self, object obj) except -1:
+        digest = self._constants.digest(obj)
+        if digest is None:
+            return self._feed_digest(obj, True)
+        self._feed_type(type(obj))
+        self._feed_int(b'h', len(digest))
+        self._feed(digest)
+        return 0
+
+    cdef int _feed_digest(self, object obj, bint constant) except -1:
+        """
+        Leaves are fingerprinted by content with the hash functions and small constants by their pickles,
+        otherwise the fingerprint of the current variable is unknown
+        """
+        cdef object t = type(obj)
+        digest = None
+        hash_function = self._hash_functions.get(t)
+        try:
+            if hash_function is not None:
+                digest = hash_function(obj)
+                if isinstance(digest, BlockHashes):
+                    digest = digest.root()
+            elif constant:
+                digest = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            digest = None
+        if digest is None:
+            self._fingerprint = None
+            return 0
+        self._feed_type(t)
+        self._feed_int(b'd', len(digest))
+        self._feed(digest)
+        return 0
+
+
+cdef class Walker:
+    """
+    Splits a namespace into components, i.e. groups of variables that share objects.
+    Every full walk runs in its own context with snapshots of the dispatch table and of the leaf types,
+    so one walker can walk different namespaces from several threads at once.
+    Incremental walks continue the context of the previous walk of the same namespace, given by a key;
+    only walks of the same namespace wait for each other
+    """
+    cdef object _logger
+    cdef object _dispatch_table
+    cdef LeafTypeRegistry _leaf_types
+    cdef ConstantCache _constants
+    cdef bint _full_walk
+    cdef object _time_limit
+    cdef Py_ssize_t _subtree_limit
+    cdef Py_ssize_t _collection_limit
+    cdef object _hash_functions
+
+    cdef object _lock
+    # namespace -> context of its latest walk
+    cdef dict _contexts
+    # namespace -> incremental walks since its latest full walk
+    cdef dict _incremental_walks
+    # context of the latest walk of any namespace
+    cdef _WalkContext _latest
+
+    def __init__(self, logger: Logger = None, dispatch_table=None, leaf_types: LeafTypeRegistry = None,
+                 time_limit: Optional[float] = WALK_TIME_LIMIT, subtree_limit: int = WALK_SUBTREE_LIMIT,
+                 collection_limit: int = WALK_COLLECTION_LIMIT, fingerprints: bool = False,
+                 hash_functions: DynamicTypeMapping = None):
+        """
+        Unless the full walk is enabled, a walk lasts about time_limit seconds at most (None for no limit),
+        every variable is walked through at most subtree_limit objects and larger collections are sampled.
+        Variables that do not fit into the budget are merged with all variables they might share objects with,
+        i.e. with all variables which are not constants; they are reported as partially_walked.
+        With fingerprints, the walk computes structural fingerprints of the variables as well,
+        leaves are hashed by hash_functions (bundled ones by default)
+        """
+        self._logger = logger
+        if dispatch_table is None:
+            dispatch_table = copyreg.dispatch_table
+        self._dispatch_table = dispatch_table
+        if leaf_types is None:
+            leaf_types = LeafTypeRegistry()
+        self._leaf_types = leaf_types
+        self._constants = ConstantCache()
+        self._full_walk = False
+        self._time_limit = time_limit
+        self._subtree_limit = subtree_limit
+        self._collection_limit = collection_limit
+        if fingerprints and hash_functions is None:
+            hash_functions = default_hash_functions()
+        self._hash_functions = hash_functions if fingerprints else None
+
+        self._lock = threading.Lock()
+        self._contexts = dict()
+        self._incremental_walks = dict()
+        self._latest = None
+
+    @property
+    def constant_cache(self) -> ConstantCache:
+        return self._constants
+
+    @property
+    def leaf_types(self) -> LeafTypeRegistry:
+        return self._leaf_types
+
+    @property
+    def partially_walked(self) -> Set[str]:
+        """
+        Variables of the latest walk which components were merged conservatively,
+        because they did not fit into the budget
+        """
+        cdef _WalkContext context = self._latest
+        if context is None:
+            return set()
+        with context._lock:
+            return set(context._inexact)
+
+    @property
+    def fingerprints(self) -> Dict[str, Optional[bytes]]:
+        """
+        Structural fingerprints of the variables of the latest walk: equal fingerprints of a variable
+        mean equal pickles of it, given that the objects it shares with other variables are the same.
+        A fingerprint is None if the variable is walked through partially or contains leaves without
+        a hash function. Empty unless fingerprints are enabled
+        """
+        cdef _WalkContext context = self._latest
+        if context is None or context._fingerprints is None:
+            return {}
+        with context._lock:
+            return dict(context._fingerprints)
+
+    def enable_full_walk(self):
+        self._full_walk = True
+        self.request_full_rewalk()
+
+    def disable_full_walk(self):
+        self._full_walk = False
+        self.request_full_rewalk()
+
+    def request_full_rewalk(self):
+        """
+        Makes the next walk_incremental call of every namespace walk through the whole namespace
+        """
+        with self._lock:
+            self._contexts.clear()
+            self._incremental_walks.clear()
+
+    def forget(self, namespace: Hashable = None):
+        """
+        Drops the context of the namespace, e.g. once it is closed
+        """
+        with self._lock:
+            self._contexts.pop(namespace, None)
+            self._incremental_walks.pop(namespace, None)
+
+    def walk(self, env: Dict[str, object], namespace: Hashable = None) -> Iterable[Set[str]]:
+        cdef _WalkContext context = self._new_context()
+        with context._lock:
+            components = context.walk(env)
+        with self._lock:
+            self._set_context(namespace, context)
+        return components
+
+    def walk_incremental(self, env: Dict[str, object], touched: Iterable[str],
+                         deleted: Iterable[str], namespace: Hashable = None) -> Iterable[Set[str]]:
+        """
+        Re-walks touched and deleted variables together with the components they belonged to
+        during the previous walk of the namespace. Falls back to the full walk periodically or on request
+        """
+        cdef _WalkContext context
+        with self._lock:
+            context = self._contexts.get(namespace)
+            if context is None or self._incremental_walks[namespace] >= FULL_REWALK_PERIOD:
+                # a new context is walked through as a whole by the first walk
+                context = self._new_context()
+                self._set_context(namespace, context)
+            else:
+                self._incremental_walks[namespace] += 1
+                self._latest = context
+        with context._lock:
+            return context.walk_incremental(env, touched, deleted)
+
+    cdef _WalkContext _new_context(self):
+        return _WalkContext(self._logger, dict(self._dispatch_table), self._leaf_types.snapshot(), self._constants,
+                            self._full_walk, self._time_limit, self._subtree_limit, self._collection_limit,
+                            self._hash_functions)
+
+    cdef int _set_context(self, object namespace, _WalkContext context) except -1:
+        self._contexts[namespace] = context
+        self._incremental_walks[namespace] = 0
+        self._latest = context
+        return 0
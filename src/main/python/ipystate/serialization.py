@@ -1,6 +1,13 @@
+import io
+import multiprocessing
+import os
 import sys
+import uuid
+import weakref
 from abc import abstractmethod
-from typing import BinaryIO, Iterable, Dict, Set, Tuple, Any, IO, Union
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Dict, Set, Tuple, Any, IO, Union, List, Callable
 import traceback
 
 from cloudpickle import CloudPickler
@@ -10,18 +17,48 @@ from .decl import VarDecl
 
 from .impl.components_fuser import ComponentsFuser
 from .impl.dispatch.common import CommonDispatcher
-from .impl.memo import ChunkedFile
+from .impl.memo import ChunkedFile, ChunkView, MemoryChunk, CHUNK_SPILL_THRESHOLD
 from ipystate.logger import Logger
 
 
+# bytes of dumps in flight in a concurrent Serializer.dump, running dumps estimated by previous dumps of their variables
+DUMP_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+# protocol 5 supports out-of-band buffers, Python < 3.8 does not have it
+PICKLE_PROTOCOL = min(pickle.HIGHEST_PROTOCOL, 5)
+# smaller buffers are pickled in-band even if out-of-band buffers are enabled
+OUT_OF_BAND_MIN_SIZE = 64 * 1024
+
+
+def _payload_nbytes(payload: Any) -> int:
+    if isinstance(payload, memoryview):
+        return payload.nbytes
+    if hasattr(payload, '__len__'):
+        return len(payload)
+    getbuffer = getattr(payload, 'getbuffer', None)
+    if getbuffer is not None:
+        return getbuffer().nbytes
+    try:
+        return memoryview(payload).nbytes
+    except TypeError:
+        return 0
+
+
 class Dump:
-    pass
+    def nbytes(self) -> int:
+        return 0
+
+    def var_nbytes(self) -> Dict[str, int]:
+        """
+        Bytes of the dumped variables by their names
+        """
+        return dict()
 
 
 class PrimitiveDump(Dump):
-    def __init__(self, var: VarDecl, payload: BinaryIO):
+    def __init__(self, var: VarDecl, payload: BinaryIO, out_of_band_buffers: Iterable[ChunkView] = ()):
         self._var = var
         self._payload = payload
+        self._out_of_band_buffers = list(out_of_band_buffers)
 
     def var(self) -> VarDecl:
         return self._var
@@ -29,6 +66,15 @@ class PrimitiveDump(Dump):
     def payload(self) -> BinaryIO:
         return self._payload
 
+    def out_of_band_buffers(self) -> List[ChunkView]:
+        return list(self._out_of_band_buffers)
+
+    def nbytes(self) -> int:
+        return _payload_nbytes(self._payload) + sum(map(len, self._out_of_band_buffers))
+
+    def var_nbytes(self) -> Dict[str, int]:
+        return {self._var.name(): self.nbytes()}
+
 
 class ComponentDump(Dump):
     """
@@ -36,10 +82,11 @@ class ComponentDump(Dump):
     """
 
     def __init__(self, all_vars: Set[VarDecl], serialized_vars: Iterable[Tuple[str, BinaryIO]],
-                 non_serialized_vars: Set[str]):
+                 non_serialized_vars: Set[str], out_of_band_buffers: Dict[str, List[ChunkView]] = None):
         self._all_vars = set(all_vars)
         self._serialized_vars = list(serialized_vars)
         self._non_serialized_vars = set(non_serialized_vars)
+        self._out_of_band_buffers = dict(out_of_band_buffers or {})
 
     def all_vars(self) -> Set[VarDecl]:
         return set(self._all_vars)
@@ -50,20 +97,145 @@ class ComponentDump(Dump):
     def non_serialized_vars(self) -> Set[str]:
         return set(self._non_serialized_vars)
 
+    def out_of_band_buffers(self) -> Dict[str, List[ChunkView]]:
+        """
+        Out-of-band buffers of serialized variables, in the order their pickles use them
+        """
+        return {name: list(buffers) for name, buffers in self._out_of_band_buffers.items()}
+
+    def nbytes(self) -> int:
+        return (sum(_payload_nbytes(payload) for _, payload in self._serialized_vars) +
+                sum(len(buffer) for buffers in self._out_of_band_buffers.values() for buffer in buffers))
+
+    def var_nbytes(self) -> Dict[str, int]:
+        return {name: _payload_nbytes(payload) + sum(map(len, self._out_of_band_buffers.get(name, ())))
+                for name, payload in self._serialized_vars}
+
+
+# types the pickler writes by value, never memoizing them
+_UNMEMOIZED_TYPES = (type(None), bool, int, float)
+# an unpickler memo entry nothing refers to
+_MEMO_PADDING = pickle.NONE + pickle.MEMOIZE + pickle.POP
+
+
+class StaleMemoError(pickle.PicklingError):
+    """
+    An object of a rolled back dump is pickled again: it may be memoized under an index the unpickler does not have
+    """
+
+
+class _Output:
+    """
+    File the pickler writes to, switched to a scratch buffer while the memo is probed
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        return self.file.write(data)
+
 
 class Pickler(CloudPickler):
-    def __init__(self, ns, dispatch_table, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """
+    Pickler with memo checkpoints: rollback() forgets objects memoized after the last checkpoint().
+    The memo of the C pickler can only be copied, so insertions are journaled in persistent_id,
+    called for every pickled object: objects not seen before a checkpoint are the ones memoized after it.
+    A rollback leaves them in the memo and pads the next dump with as many unpickler memo entries,
+    so that the indices stay aligned; pickling them again raises StaleMemoError, after which repair()
+    replaces them in the memo at the cost of a memo copy. Checkpoints and rollbacks cost O(1) amortized
+    """
+
+    def __init__(self, ns, dispatch_table, file, *args, **kwargs):
+        self._output = _Output(file)
+        super().__init__(self._output, *args, **kwargs)
         self._ns = ns
         self.dispatch_table = dispatch_table
+        # objects seen by id, referenced so their ids are not reused, and ids seen since the last checkpoint
+        self._seen = {}
+        self._journal = []
+        # ids of objects memoized by rolled back dumps
+        self._stale = set()
+        # memo entries the unpickler has, and the ones to pad the next dump with
+        self._visible = 0
+        self._padding = 0
 
     def persistent_id(self, obj):
         if id(obj) == id(self._ns):
             return "__ns__"
+        if self._stale and id(obj) in self._stale:
+            raise StaleMemoError(f'{type(obj).__name__} object is memoized by a rolled back dump')
+        if type(obj) not in _UNMEMOIZED_TYPES and id(obj) not in self._seen:
+            self._seen[id(obj)] = obj
+            self._journal.append(id(obj))
+        return None
+
+    def dump(self, obj):
+        if self._padding:
+            self._output.write(_MEMO_PADDING * self._padding)
+        super().dump(obj)
+
+    def checkpoint(self) -> None:
+        self._visible = self._memo_size()
+        # the probe is memoized after the visible entries
+        self._padding = 1
+        self._journal.clear()
+
+    def rollback(self) -> None:
+        framer = getattr(self, 'framer', None)
+        if framer:
+            framer.end_framing()
+        self._padding = self._memo_size() + 1 - self._visible
+        self._stale.update(self._journal)
+        self._journal.clear()
+
+    def repair(self) -> None:
+        """
+        Replaces objects of rolled back dumps in the memo with placeholders under the same indices
+        """
+        memo = self.memo.copy()
+        for obj_id in self._stale:
+            del self._seen[obj_id]
+            entry = memo.pop(obj_id, None)
+            if entry is not None:
+                placeholder = object()
+                memo[id(placeholder)] = (entry[0], placeholder)
+        self._stale.clear()
+        self.memo = memo
+
+    def _memo_size(self) -> int:
+        """
+        The index a new self-referencing list is memoized under, read from its back-reference; the list stays
+        in the memo
+        """
+        probe = []
+        probe.append(probe)
+        file, scratch = self._output.file, io.BytesIO()
+        self._output.file = scratch
+        try:
+            super().dump(probe)
+        finally:
+            self._output.file = file
+        data = scratch.getbuffer()
+        if data[-2:] == pickle.APPEND + pickle.STOP:
+            if data[-7:-6] == pickle.LONG_BINGET:
+                return int.from_bytes(data[-6:-2], 'little')
+            if data[-4:-3] == pickle.BINGET:
+                return data[-3]
+        raise pickle.PicklingError('Unexpected memo probe {!r}'.format(bytes(data)))
 
 
 class Unpickler(pickle.Unpickler):
-    def __init__(self, ns, *args, **kwargs):
+    def __init__(self, ns, *args, buffers: Iterable = None, **kwargs):
+        """
+        buffers are the out-of-band buffers of the loaded pickles. Objects supporting it, e.g. numpy arrays,
+        are built on top of buffers without copying, e.g. on memoryview slices of a memory map opened
+        with ACCESS_COPY, and are read-only if the buffers are. ChunkViews of dumps are copied to writable memory
+        """
+        if buffers is not None:
+            if PICKLE_PROTOCOL < 5:
+                raise ValueError('Out-of-band buffers require pickle protocol 5')
+            kwargs['buffers'] = (_writable_buffer(buffer) for buffer in buffers)
         super(Unpickler, self).__init__(*args, **kwargs)
         self._ns = ns
 
@@ -72,6 +244,35 @@ class Unpickler(pickle.Unpickler):
             return self._ns
 
 
+def _writable_buffer(buffer: Any) -> Any:
+    if not isinstance(buffer, ChunkView):
+        return buffer
+    getbuffer = getattr(buffer, 'getbuffer', None)
+    if getbuffer is not None:
+        return bytearray(getbuffer())
+    copy = bytearray(len(buffer))
+    buffer.seek(0)
+    buffer.readinto(copy)
+    return copy
+
+
+def _out_of_band_callback(buffers: List[ChunkView]) -> Callable[[Any], bool]:
+    """
+    Callback for the pickler: large contiguous buffers are appended to buffers, the rest are pickled in-band.
+    Writable buffers are copied once, they may change before the dump is consumed
+    """
+    def callback(buffer) -> bool:
+        try:
+            view = buffer.raw()
+        except BufferError:
+            return True
+        if view.nbytes < OUT_OF_BAND_MIN_SIZE:
+            return True
+        buffers.append(MemoryChunk([view if view.readonly else view.tobytes()]))
+        return False
+    return callback
+
+
 # class ComponentStructDump(Dump):
 #     '''
 #     Unchanged component structure dump
@@ -112,11 +313,65 @@ class BytesUtil:
         return int.from_bytes(b, "big")
 
 
+# dumps of forked processes: token -> serializer, namespace and components, inherited by the children
+_FORKED_DUMPS = {}
+
+
+def _dump_forked_component(token: str, index: int) -> Dump:
+    serializer, ns, components = _FORKED_DUMPS[token]
+    return serializer._dump_logged(components[index], ns)
+
+
+# serializers with thread pools; threads do not survive fork, so children start their own pools
+_THREAD_POOL_OWNERS = weakref.WeakSet()
+
+
+def _forget_thread_pools() -> None:
+    for serializer in list(_THREAD_POOL_OWNERS):
+        serializer._thread_pool = None
+    _THREAD_POOL_OWNERS.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_thread_pools)
+
+
 class Serializer:
-    def __init__(self, logger: Logger = None):
+    def __init__(self, logger: Logger = None, workers: int = 0, use_processes: bool = False,
+                 max_in_flight_bytes: int = DUMP_MAX_IN_FLIGHT_BYTES, spill_threshold: int = CHUNK_SPILL_THRESHOLD,
+                 out_of_band_buffers: bool = False, hash_payloads: bool = False):
+        """
+        With workers > 0, components are dumped concurrently: by a thread pool, which pays off
+        when reducers release the GIL (e.g. parquet encoding of DataFrames), or by processes forked
+        for every dump, which see the namespace copy-on-write, if use_processes is set.
+        Forking is safe only if no other thread holds a lock the dump needs;
+        _on_var_serialize_error is then called in the child processes.
+        Dumps are yielded in the same order anyway, at most max_in_flight_bytes of dumps are submitted and not
+        yielded yet, unless a single dump is larger; dumps are counted as they are submitted, by the sizes
+        of the previous dumps of their variables, and by their own sizes once they finish.
+        Pickled variables of a component are kept in memory up to spill_threshold bytes, the rest is spilled
+        to a temporary file; payloads are file-like views in both cases.
+        With out_of_band_buffers, buffers of at least OUT_OF_BAND_MIN_SIZE bytes, e.g. of numpy arrays, are not
+        written to the pickles but are kept as separate views in the dumps, to be passed to Unpickler.
+        With hash_payloads, pickled variables are hashed as they are written and payloads tell their block_hashes(),
+        so change detectors compare them without reading them again
+        """
+        if use_processes and 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError('Dumping in processes requires the fork start method')
+        if out_of_band_buffers and PICKLE_PROTOCOL < 5:
+            raise ValueError('Out-of-band buffers require pickle protocol 5')
         self._configurable_dispatch_table = CloudPickler.dispatch_table
         self._tmp_path = None
         self._logger = logger
+        self._workers = workers
+        self._use_processes = use_processes
+        self._max_in_flight_bytes = max_in_flight_bytes
+        self._spill_threshold = spill_threshold
+        self._out_of_band_buffers = out_of_band_buffers
+        self._hash_payloads = hash_payloads
+        self._thread_pool = None
+        # bytes of the last dumps of variables, estimates of the dumps in flight
+        self._var_nbytes = dict()
 
     @property
     def logger(self):
@@ -164,7 +419,8 @@ class Serializer:
     @abstractmethod
     def _primitive_var_repr(self, value: Any) -> Tuple[BinaryIO, str]:
         """
-        Should return binary value representation and type string
+        Should return binary value representation and type string,
+        optionally followed by out-of-band buffers of the representation
         """
         pass
 
@@ -175,10 +431,10 @@ class Serializer:
         # TODO allow subclass to skip serializing this variable
         # TODO  ... and report to non serialized
         # TODO  ... and self._on_var_serialize_error()
-        payload, typ = self._primitive_var_repr(value)
+        payload, typ, *buffers = self._primitive_var_repr(value)
         var = VarDecl(name=name, type=typ)
 
-        return PrimitiveDump(var=var, payload=payload)
+        return PrimitiveDump(var=var, payload=payload, out_of_band_buffers=buffers[0] if buffers else ())
 
     def _no_refs(self, value: Any) -> bool:
         """"
@@ -205,10 +461,12 @@ class Serializer:
     def _dump_pickle_component(self, component: Set[str], ns: Dict[str, object]) -> Dump:
         serialized_vars = list()
         non_serialized_var_names = set()
+        out_of_band_buffers = dict()
 
-        cf = ChunkedFile()
-        pickler = Pickler(ns, self.configurable_dispatch_table, cf, protocol=4)
-        committed_memo = pickler.memo.copy()
+        cf = ChunkedFile(self._spill_threshold, self._tmp_path, hash_chunks=self._hash_payloads)
+        var_buffers = list()
+        kwargs = {'buffer_callback': _out_of_band_callback(var_buffers)} if self._out_of_band_buffers else {}
+        pickler = Pickler(ns, self.configurable_dispatch_table, cf, protocol=PICKLE_PROTOCOL, **kwargs)
 
         comp_sorted_vars = self._sort_component_vars(component, ns)
         for var_name in comp_sorted_vars:
@@ -216,23 +474,31 @@ class Serializer:
             # TODO allow subclass to skip serializing this variable
             # TODO  and report to non serialized
             try:
-                pickler.dump(var_value)
-                committed_memo = pickler.memo.copy()
+                try:
+                    pickler.dump(var_value)
+                except StaleMemoError:
+                    # the variable shares objects with one which failed, they are pickled anew
+                    pickler.rollback()
+                    pickler.repair()
+                    cf.reset()
+                    var_buffers.clear()
+                    pickler.dump(var_value)
+                pickler.checkpoint()
                 chunk = cf.current_chunk()
                 serialized_vars.append((var_name, chunk))
+                if var_buffers:
+                    out_of_band_buffers[var_name] = list(var_buffers)
             except Exception as e:
-                framer = getattr(pickler, 'framer', None)
-                if framer:
-                    framer.end_framing()
-                pickler.memo = committed_memo
+                pickler.rollback()
                 non_serialized_var_names.add(var_name)
                 self._on_var_serialize_error(var_name, var_value, e)
             finally:
                 cf.reset()
+                var_buffers.clear()
 
         component_decl = self._component_decl(component, ns)
         return ComponentDump(all_vars=component_decl, serialized_vars=serialized_vars,
-                             non_serialized_vars=non_serialized_var_names)
+                             non_serialized_vars=non_serialized_var_names, out_of_band_buffers=out_of_band_buffers)
 
     def _dump_component(self, component: Set[str], ns: Dict[str, object]) -> Dump:
         if len(component) == 1 and self._is_primitive(ns.get(list(component)[0])):
@@ -242,19 +508,88 @@ class Serializer:
         else:
             return self._dump_pickle_component(component, ns)
 
+    def _dump_logged(self, component: Set[str], ns: Dict[str, object]) -> Dump:
+        if self._logger:
+            self._logger.info(f'Dumping component {component}')
+        try:
+            return self._dump_component(component, ns)
+        finally:
+            if self._logger:
+                self._logger.info(f'Dumped component {component}')
+
+    def _estimated_nbytes(self, component: Set[str]) -> int:
+        return sum(self._var_nbytes.get(name, 0) for name in component)
+
+    def _may_submit(self, pending: deque, component: Set[str]) -> bool:
+        if len(pending) >= 2 * self._workers:
+            return False
+        in_flight = self._estimated_nbytes(component)
+        for future, estimate in pending:
+            if future.done() and future.exception() is None:
+                in_flight += future.result().nbytes()
+            else:
+                in_flight += estimate
+        return in_flight <= self._max_in_flight_bytes
+
+    def _dump_concurrently(self, submit: Callable[[int], Future], components: List[Set[str]],
+                           ns: Dict[str, object]) -> Iterable[Dump]:
+        self._var_nbytes = {name: nbytes for name, nbytes in self._var_nbytes.items() if name in ns}
+        pending = deque()
+        submitted = 0
+        try:
+            while submitted < len(components) or pending:
+                while submitted < len(components) and \
+                        (not pending or self._may_submit(pending, components[submitted])):
+                    pending.append((submit(submitted), self._estimated_nbytes(components[submitted])))
+                    submitted += 1
+                future, _ = pending.popleft()
+                dump = future.result()
+                self._var_nbytes.update(dump.var_nbytes())
+                yield dump
+        finally:
+            for future, _ in pending:
+                future.cancel()
+
+    def _dump_in_threads(self, components: List[Set[str]], ns: Dict[str, object]) -> Iterable[Dump]:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(self._workers, thread_name_prefix='ipystate-dump')
+            _THREAD_POOL_OWNERS.add(self)
+        executor = self._thread_pool
+        yield from self._dump_concurrently(lambda i: executor.submit(self._dump_logged, components[i], ns), components,
+                                           ns)
+
+    def _dump_in_processes(self, components: List[Set[str]], ns: Dict[str, object]) -> Iterable[Dump]:
+        token = str(uuid.uuid4())
+        # set before the pool forks its processes on the first submit
+        _FORKED_DUMPS[token] = (self, ns, components)
+        # workers are forked anew to see the namespace as it is now, no more of them than there are components
+        executor = ProcessPoolExecutor(min(self._workers, len(components)),
+                                       mp_context=multiprocessing.get_context('fork'))
+        try:
+            yield from self._dump_concurrently(lambda i: executor.submit(_dump_forked_component, token, i), components,
+                                               ns)
+        finally:
+            executor.shutdown(wait=True)
+            del _FORKED_DUMPS[token]
+
+    def close(self) -> None:
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True)
+            self._thread_pool = None
+            _THREAD_POOL_OWNERS.discard(self)
+
     def dump(self, ns: Dict[str, object], dirty: Iterable[str], comps0: Iterable[Set[str]],
              comps1: Iterable[Set[str]]) -> Iterable[Dump]:
         affected_var_names, components = self._compute_affected(dirty, comps0, comps1)
+        components = [component for component in components if len(component & affected_var_names) > 0]
 
-        for component in components:
-            if len(component & affected_var_names) > 0:
-                if self._logger:
-                    self._logger.info(f'Dumping component {component}')
-                try:
-                    yield self._dump_component(component, ns)
-                finally:
-                    if self._logger:
-                        self._logger.info(f'Dumped component {component}')
+        if self._workers <= 0 or len(components) <= 1:
+            for component in components:
+                yield self._dump_logged(component, ns)
+        elif self._use_processes:
+            yield from self._dump_in_processes(components, ns)
+        else:
+            yield from self._dump_in_threads(components, ns)
 
 
 class Deserializer:
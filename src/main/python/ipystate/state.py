@@ -1,19 +1,32 @@
 import abc
+import os
 import uuid
 
-from typing import Iterable, Set, FrozenSet
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, FrozenSet, Tuple
 
-from ipystate.change import AtomicChange, PrimitiveAtomicChange, ComponentAtomicChange, RemoveAtomicChange
+from ipystate.change import AtomicChange, PrimitiveAtomicChange, ComponentAtomicChange, RemoveAtomicChange, \
+    DeltaComponentAtomicChange
 from ipystate.serialization import Serializer, PrimitiveDump, ComponentDump
+from ipystate.impl.cellanalysis import CellAnalyzer
 from ipystate.impl.changedetector import ChangeDetector, ChangeStage, ChangedState
+from ipystate.impl.compression import Compressor
+from ipystate.impl.chunkstore import ChunkStore, chunk_digest
+from ipystate.impl.delta import encode_delta, DeltaBase, DELTA_MAX_CHAIN, DELTA_MAX_RATIO, DELTA_MIN_SIZE
+from ipystate.impl.memo import MemoryChunk
+from ipystate.impl.snapshot import BackgroundSnapshot, fork_snapshot
 from ipystate.impl.walker import Walker
 from ipystate.logger import Logger
 
 
 class CellEffects:
-    def __init__(self, touched: Iterable[str], deleted: Iterable[str]):
+    def __init__(self, touched: Iterable[str], deleted: Iterable[str], sources: Optional[Iterable[str]] = None):
+        """
+        sources of the cells run in the transaction, if the state knows them, narrow touched down
+        to the variables the cells may change
+        """
         self._touched = frozenset(touched)
         self._deleted = frozenset(deleted)
+        self._sources = tuple(sources) if sources is not None else None
 
     @property
     def touched(self) -> FrozenSet[str]:
@@ -23,6 +36,10 @@ class CellEffects:
     def deleted(self) -> FrozenSet[str]:
         return self._deleted
 
+    @property
+    def sources(self) -> Optional[Tuple[str, ...]]:
+        return self._sources
+
 
 class State(abc.ABC):
     @abc.abstractmethod
@@ -63,15 +80,55 @@ class State(abc.ABC):
 
 
 class StateManager(abc.ABC):
-    def __init__(self, state: State, serializer: Serializer, change_detector: ChangeDetector, logger: Logger = None):
+    def __init__(self, state: State, serializer: Serializer, change_detector: ChangeDetector, logger: Logger = None,
+                 max_background_snapshots: int = 1, chunk_store: ChunkStore = None, delta_encoding: bool = False,
+                 compressor: Compressor = None, structural_fingerprints: bool = False,
+                 cell_analyzer: CellAnalyzer = None):
+        """
+        With a chunk_store, pickled variables of component changes are put to the store and changes refer to them.
+        The manager retains the chunks of the current state and collects the rest;
+        consumers keeping older changes should retain their digests() too.
+        With delta_encoding, pickled variables of at least DELTA_MIN_SIZE bytes are sent as deltas against
+        their previous payloads, kept in temporary files, in DeltaComponentAtomicChanges; every DELTA_MAX_CHAIN deltas
+        a full payload is sent. Background snapshots send full payloads.
+        With a compressor, payloads and out-of-band buffers of component changes, deltas included,
+        are compressed with codecs it chooses by variable type; changes tell the codecs()
+        With structural_fingerprints, the walker fingerprints variables as it walks through them, and components
+        which fingerprints are UNCHANGED at the STRUCTURE stage are skipped without being checked or pickled.
+        With a cell_analyzer, variables which the sources of cell effects only read are not touched,
+        so they are neither checked nor walked through again, as long as the cells can not run code of other types
+        than builtin ones; effects without sources are taken as they are
+        """
+        if chunk_store is not None and delta_encoding:
+            raise ValueError('Chunk store deduplicates chunks, deltas against them are not supported')
         self._state = state
         self._comps0 = []
         self._serializer = serializer
-        self._walker = Walker(logger=logger, dispatch_table=serializer.configurable_dispatch_table)
+        self._structural_fingerprints = structural_fingerprints
+        self._walker = Walker(logger=logger, dispatch_table=serializer.configurable_dispatch_table,
+                              fingerprints=structural_fingerprints)
         self._change_detector = change_detector
         self._in_transaction = False
         self._logger = logger
 
+        self._max_background_snapshots = max_background_snapshots
+        self._snapshots = []
+        # effects of background snapshots which results are not applied yet; redone by the next commit
+        self._carried_touched = frozenset()
+        self._carried_deleted = frozenset()
+
+        self._chunk_store = chunk_store
+        # digests of the chunks of variables in the current state, and their changes made by a commit
+        self._chunk_digests = dict()
+        self._chunk_delta = dict()
+
+        self._delta_encoding = delta_encoding
+        # variable name -> full payload sent last, its digest and the number of deltas sent since a full payload
+        self._delta_bases = dict()
+
+        self._compressor = compressor
+        self._cell_analyzer = cell_analyzer
+
     @property
     def state(self) -> State:
         return self._state
@@ -85,8 +142,13 @@ class StateManager(abc.ABC):
         return self._change_detector
 
     def _set_components(self, new_comps: Iterable[Set[str]]) -> None:
+        """
+        Replaces the components, e.g. of a loaded or restored state; the walker does not know them,
+        so the next commit walks through the whole namespace
+        """
         if new_comps is not None:
             self._comps0 = new_comps
+            self._walker.request_full_rewalk()
         else:
             self._comps0 = self._compute_comps()
 
@@ -130,12 +192,51 @@ class StateManager(abc.ABC):
 
         return False if (ChangedState.UNCHANGED == change_state) else True
 
+    def _structurally_unchanged(self, touched: FrozenSet[str], comps: Iterable[Set[str]]) -> Set[str]:
+        """
+        Variables of the components with touched variables which fingerprints are all UNCHANGED.
+        Components are compared as a whole, as objects shared by variables are fingerprinted with one of them
+        """
+        unchanged = set()
+        if not self._structural_fingerprints:
+            return unchanged
+        fingerprints = self._walker.fingerprints
+        for component in comps:
+            if component.isdisjoint(touched):
+                continue
+            component_unchanged = True
+            for name in component:
+                # unknown fingerprints are updated too, so that they are not compared to stale ones later
+                fingerprint = fingerprints.get(name)
+                change_state = self._change_detector.update(ChangeStage.STRUCTURE, name, fingerprint)
+                if fingerprint is None or ChangedState.UNCHANGED != change_state:
+                    component_unchanged = False
+            if component_unchanged:
+                unchanged.update(component)
+        return unchanged
+
+    def _walk_env(self) -> Dict[str, object]:
+        return {name: self._state[name] for name in self._state.varnames() if not self._skip_variable(name)}
+
     def _compute_comps(self) -> Iterable[Set[str]]:
-        return self._walker.walk(
-            {name: self._state[name] for name in self._state.varnames() if not self._skip_variable(name)}
-        )
+        return self._walker.walk(self._walk_env())
 
-    def _component_dump_changed(self, dump: ComponentDump) -> bool:
+    def _compute_comps_incremental(self, touched: Iterable[str], deleted: Iterable[str]) -> Iterable[Set[str]]:
+        return self._walker.walk_incremental(self._walk_env(), touched, deleted)
+
+    @staticmethod
+    def _regrouped(comps0: Iterable[Set[str]], comps1: Iterable[Set[str]]) -> FrozenSet[str]:
+        """
+        Variables which share objects with other variables than before, so their pickles change with the dumps
+        they are in, even if their values are equal
+        """
+        before = {name: component for component in map(frozenset, comps0) for name in component}
+        regrouped = set()
+        for component in map(frozenset, comps1):
+            regrouped.update(name for name in component if before.get(name, component) != component)
+        return frozenset(regrouped)
+
+    def _component_dump_changed(self, dump: ComponentDump, regrouped: FrozenSet[str] = frozenset()) -> bool:
         if len(dump.serialized_vars()) == 0:
             # safety fallback
             return True
@@ -145,41 +246,243 @@ class StateManager(abc.ABC):
             return True
 
         has_changed = False
+        out_of_band_buffers = dump.out_of_band_buffers()
         for pickled_var in dump.serialized_vars():
+            if pickled_var[0] in regrouped:
+                has_changed = True
             changed_state = self._change_detector.update(ChangeStage.PICKLED, pickled_var[0], pickled_var[1])
             if ChangedState.UNCHANGED != changed_state:
                 has_changed = True
+            # pickles do not change with the contents of their out-of-band buffers
+            for i, buffer in enumerate(out_of_band_buffers.get(pickled_var[0], ())):
+                changed_state = self._change_detector.update(ChangeStage.PICKLED, f'{pickled_var[0]}#{i}', buffer)
+                if ChangedState.UNCHANGED != changed_state:
+                    has_changed = True
 
         return has_changed
 
+    def _read_only(self, effects: CellEffects) -> FrozenSet[str]:
+        if self._cell_analyzer is None or effects.sources is None:
+            return frozenset()
+        return self._cell_analyzer.read_only(effects.sources, self._state)
+
+    def _end_transaction(self) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        effects = self._state.end_transaction()
+        self._in_transaction = False
+        touched = frozenset(filter(lambda v: not self._skip_variable(v), effects.touched))
+        touched -= self._read_only(effects)
+        return touched | self._carried_touched, effects.deleted | self._carried_deleted
+
     def post_cell_commit(self) -> Iterable[AtomicChange]:
+        self.wait_background_snapshots()
         self._change_detector.begin()
         try:
-            effects = self._state.end_transaction()
-            touched = frozenset(filter(lambda v: not self._skip_variable(v), effects.touched))
-            deleted = effects.deleted
-            probably_dirty = frozenset(filter(self._probably_dirty, touched)).union(deleted)
-            comps1 = self._compute_comps()
-            dumps = self._serializer.dump(self._state.ns, probably_dirty, self._comps0, comps1)
-
-            for dump in dumps:
-                change = None
-                change_id = str(uuid.uuid4())
-                if isinstance(dump, PrimitiveDump):
-                    change = PrimitiveAtomicChange(change_id, dump.var(), dump.payload(), None)
-                elif isinstance(dump, ComponentDump) and self._component_dump_changed(dump):
-                    change = ComponentAtomicChange(change_id,
-                                                   dump.all_vars(),
-                                                   dump.serialized_vars(),
-                                                   dump.non_serialized_vars(),
-                                                   None)
-                if change is not None:
-                    yield change
-
-            for var_name in deleted:
-                yield RemoveAtomicChange(str(uuid.uuid4()), var_name, None)
-
-            self._set_components(new_comps=comps1)
+            touched, deleted = self._end_transaction()
+            # effects of failed or cancelled commits are redone by the next one
+            self._carried_touched = touched
+            self._carried_deleted = deleted
+            yield from self._commit(touched, deleted)
+            self._update_chunk_refs(self._chunk_delta)
+            self._change_detector.commit()
+            self._carried_touched = frozenset()
+            self._carried_deleted = frozenset()
         finally:
             self._change_detector.end()
             self._in_transaction = False
+
+    def post_cell_commit_background(self) -> BackgroundSnapshot:
+        """
+        Forks the kernel process, so that the child computes changes from its copy-on-write image,
+        while the user continues. Snapshots have to be consumed in the order they are started.
+        At most max_background_snapshots children run at once, older ones are waited for.
+        Effects of failed or cancelled snapshots are redone by the next commit
+        """
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Background snapshots require os.fork')
+        self._snapshots = [snapshot for snapshot in self._snapshots if not snapshot.finished]
+        while len(self._snapshots) >= max(self._max_background_snapshots, 1):
+            self._snapshots[0].wait()
+            self._snapshots.pop(0)
+
+        touched, deleted = self._end_transaction()
+        self._carried_touched = touched
+        self._carried_deleted = deleted
+        # the child sends full payloads, which the bases would not follow
+        for name in list(self._delta_bases):
+            self._forget_delta_base(name)
+        predecessor = self._snapshots[-1] if self._snapshots else None
+
+        snapshot = fork_snapshot(lambda send: self._commit_in_child(touched, deleted, send),
+                                 lambda result: self._apply_snapshot(snapshot, result), predecessor)
+        self._snapshots.append(snapshot)
+        return snapshot
+
+    def wait_background_snapshots(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for all the running snapshots, buffering their changes, returns whether they are finished
+        """
+        for snapshot in list(self._snapshots):
+            if not snapshot.wait(timeout):
+                return False
+        self._snapshots = []
+        return True
+
+    def cancel_background_snapshots(self) -> None:
+        for snapshot in self._snapshots:
+            snapshot.cancel()
+        self._snapshots = []
+
+    def _commit_in_child(self, touched: FrozenSet[str], deleted: FrozenSet[str],
+                         send: Callable[[AtomicChange], None]) -> Tuple[List[Set[str]], Any]:
+        self._delta_encoding = False
+        self._change_detector.begin()
+        try:
+            for change in self._commit(touched, deleted):
+                send(change)
+            self._change_detector.commit()
+        finally:
+            self._change_detector.end()
+        return list(self._comps0), self._change_detector.state(), self._chunk_delta
+
+    def _apply_snapshot(self, snapshot: BackgroundSnapshot,
+                        result: Tuple[List[Set[str]], Any, Dict[str, Tuple[str, ...]]]) -> None:
+        comps, change_detector_state, chunk_delta = result
+        self._set_components(new_comps=comps)
+        self._change_detector.set_state(change_detector_state)
+        self._update_chunk_refs(chunk_delta)
+        if self._snapshots and self._snapshots[-1] is snapshot:
+            # later snapshots would redo the carried effects anyway
+            self._carried_touched = frozenset()
+            self._carried_deleted = frozenset()
+
+    def _update_chunk_refs(self, chunk_delta: Dict[str, Tuple[str, ...]]) -> None:
+        if self._chunk_store is None or not chunk_delta:
+            return
+        for name, digests in chunk_delta.items():
+            self._chunk_store.retain(digests)
+            self._chunk_store.release(self._chunk_digests.pop(name, ()))
+            if digests:
+                self._chunk_digests[name] = digests
+        self._chunk_store.collect()
+
+    def _store_chunks(self, dump: ComponentDump, serialized_vars: List[Tuple[str, Any]],
+                      out_of_band_buffers: Dict[str, List[Any]]) -> Tuple[List[Tuple[str, Any]], Dict[str, List[Any]]]:
+        serialized_vars = [(name, self._chunk_store.put(payload)) for name, payload in serialized_vars]
+        out_of_band_buffers = {name: [self._chunk_store.put(buffer) for buffer in buffers]
+                               for name, buffers in out_of_band_buffers.items()}
+        for name, ref in serialized_vars:
+            self._chunk_delta[name] = (ref.digest(),) + tuple(buffer.digest()
+                                                              for buffer in out_of_band_buffers.get(name, ()))
+        for name in dump.non_serialized_vars():
+            self._chunk_delta[name] = ()
+        return serialized_vars, out_of_band_buffers
+
+    def _encode_deltas(self, serialized_vars: List[Tuple[str, Any]]) -> Tuple[List[Tuple[str, Any]], Dict[str, str]]:
+        encoded_vars = []
+        delta_bases = dict()
+        for name, payload in serialized_vars:
+            base = self._delta_bases.pop(name, None)
+            if len(payload) < DELTA_MIN_SIZE:
+                if base is not None:
+                    base.close()
+                encoded_vars.append((name, payload))
+                continue
+            new_base = DeltaBase(payload, chunk_digest(payload))
+            delta = None
+            if base is not None and base.chain < DELTA_MAX_CHAIN:
+                with base.mapped() as base_view, new_base.mapped() as data:
+                    delta = encode_delta(base_view, data, int(len(data) * DELTA_MAX_RATIO))
+            if delta is not None:
+                encoded_vars.append((name, MemoryChunk([delta])))
+                delta_bases[name] = base.digest
+                new_base.chain = base.chain + 1
+            else:
+                encoded_vars.append((name, payload))
+            if base is not None:
+                base.close()
+            self._delta_bases[name] = new_base
+        return encoded_vars, delta_bases
+
+    def _forget_delta_base(self, name: str) -> None:
+        base = self._delta_bases.pop(name, None)
+        if base is not None:
+            base.close()
+
+    def _compress(self, dump: ComponentDump, serialized_vars: List[Tuple[str, Any]],
+                  out_of_band_buffers: Dict[str, List[Any]], delta_bases: Dict[str, str]) \
+            -> Tuple[List[Tuple[str, Any]], Dict[str, List[Any]], Dict[str, str]]:
+        types = {var.name(): var.type() for var in dump.all_vars()}
+        codecs = dict()
+
+        def compress(key: str, typ: str, payload: Any) -> Any:
+            payload, codec = self._compressor.compress(typ, payload)
+            if codec is not None:
+                codecs[key] = codec
+            return payload
+
+        # deltas and buffers compress unlike pickles of the same type, their codecs are chosen apart
+        serialized_vars = [(name, compress(name, types[name] + (':delta' if name in delta_bases else ''), payload))
+                           for name, payload in serialized_vars]
+        out_of_band_buffers = {name: [compress(f'{name}#{i}', types[name] + ':buffer', buffer)
+                                      for i, buffer in enumerate(buffers)]
+                               for name, buffers in out_of_band_buffers.items()}
+        return serialized_vars, out_of_band_buffers, codecs
+
+    def _commit(self, touched: FrozenSet[str], deleted: FrozenSet[str]) -> Iterable[AtomicChange]:
+        self._chunk_delta = dict()
+        comps1 = self._compute_comps_incremental(touched, deleted)
+        unchanged = self._structurally_unchanged(touched, comps1)
+        probably_dirty = frozenset(name for name in touched
+                                   if name not in unchanged and self._probably_dirty(name)).union(deleted)
+        regrouped = self._regrouped(self._comps0, comps1)
+        probably_dirty = probably_dirty.union(regrouped)
+        dumps = self._serializer.dump(self._state.ns, probably_dirty, self._comps0, comps1)
+
+        for dump in dumps:
+            change = None
+            change_id = str(uuid.uuid4())
+            if isinstance(dump, PrimitiveDump):
+                change = PrimitiveAtomicChange(change_id, dump.var(), dump.payload(), None,
+                                               dump.out_of_band_buffers())
+                self._chunk_delta[dump.var().name()] = ()
+                self._forget_delta_base(dump.var().name())
+            elif isinstance(dump, ComponentDump) and self._component_dump_changed(dump, regrouped):
+                serialized_vars, out_of_band_buffers = dump.serialized_vars(), dump.out_of_band_buffers()
+                delta_bases, codecs = dict(), None
+                if self._delta_encoding:
+                    for name in dump.non_serialized_vars():
+                        self._forget_delta_base(name)
+                    serialized_vars, delta_bases = self._encode_deltas(serialized_vars)
+                if self._compressor is not None:
+                    serialized_vars, out_of_band_buffers, codecs = self._compress(dump, serialized_vars,
+                                                                                  out_of_band_buffers, delta_bases)
+                if self._chunk_store is not None:
+                    serialized_vars, out_of_band_buffers = self._store_chunks(dump, serialized_vars,
+                                                                              out_of_band_buffers)
+                if delta_bases:
+                    change = DeltaComponentAtomicChange(change_id,
+                                                        dump.all_vars(),
+                                                        serialized_vars,
+                                                        dump.non_serialized_vars(),
+                                                        None,
+                                                        out_of_band_buffers,
+                                                        delta_bases,
+                                                        codecs)
+                else:
+                    change = ComponentAtomicChange(change_id,
+                                                   dump.all_vars(),
+                                                   serialized_vars,
+                                                   dump.non_serialized_vars(),
+                                                   None,
+                                                   out_of_band_buffers,
+                                                   codecs)
+            if change is not None:
+                yield change
+
+        for var_name in deleted:
+            self._chunk_delta[var_name] = ()
+            self._forget_delta_base(var_name)
+            yield RemoveAtomicChange(str(uuid.uuid4()), var_name, None)
+
+        # the walker continues from comps1 with the next incremental walk
+        self._comps0 = comps1
@@ -1,11 +1,64 @@
-from typing import BinaryIO
+from typing import BinaryIO, Iterable
+
+STREAMING_BUFFER_SIZE = 1024 * 1024
 
 
 class StreamingUtils:
     @staticmethod
     def transfer(src: BinaryIO, dst: BinaryIO):
-        pass
+        """
+        Copies src from its current position to dst without materializing it
+        """
+        buffers = getattr(src, 'buffers', None)
+        if buffers is not None and src.tell() == 0:
+            for buffer in buffers():
+                dst.write(buffer)
+            src.seek(0, 2)
+            return
+        getbuffer = getattr(src, 'getbuffer', None)
+        if getbuffer is not None and hasattr(src, 'tell'):
+            buffer = getbuffer()
+            dst.write(buffer[src.tell():])
+            src.seek(0, 2)
+            return
+        buffer = bytearray(STREAMING_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            dst.write(view[:n])
+
+    @staticmethod
+    def buffers(src: BinaryIO) -> Iterable[memoryview]:
+        """
+        Buffers of the whole of src, whatever its position is, read in pieces if src is not in memory
+        """
+        buffers = getattr(src, 'buffers', None)
+        if buffers is not None:
+            yield from buffers()
+            return
+        getbuffer = getattr(src, 'getbuffer', None)
+        if getbuffer is not None:
+            yield getbuffer()
+            return
+        src.seek(0)
+        while True:
+            buffer = bytearray(STREAMING_BUFFER_SIZE)
+            n = src.readinto(buffer)
+            if not n:
+                break
+            yield memoryview(buffer)[:n]
 
     @staticmethod
     def to_bytes(src: BinaryIO) -> bytes:
-        pass
+        if isinstance(src, (bytes, bytearray, memoryview)):
+            return bytes(src)
+        buffers = getattr(src, 'buffers', None)
+        if buffers is not None:
+            return b''.join(buffers())
+        getbuffer = getattr(src, 'getbuffer', None)
+        if getbuffer is not None:
+            return bytes(getbuffer())
+        src.seek(0)
+        return src.read()
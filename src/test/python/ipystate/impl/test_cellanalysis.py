@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+from ipystate.impl.cellanalysis import Access, CellAnalyzer, TransformerManager
+
+
+class _Dunders:
+    def __len__(self):
+        return 0
+
+    def __repr__(self):
+        return '_Dunders()'
+
+
+class TestCellAnalyzer(TestCase):
+    def _accesses(self, source):
+        return {name: access.name for name, access in CellAnalyzer().analyze(source).accesses().items()}
+
+    def test_accesses(self):
+        self.assertEqual({'x': 'READ_ONLY', 'y': 'READ_ONLY', 'n': 'REBOUND'},
+                         self._accesses('print(x, [y], sep=f"{n}")\nn = 1'))
+        self.assertEqual({'x': 'READ_ONLY', 'y': 'READ_ONLY', 'z': 'REBOUND'},
+                         self._accesses('if x or y:\n    z = 1'))
+        self.assertEqual({'x': 'MUTATED', 'y': 'REBOUND'}, self._accesses('y = x'))
+        for source in ('x.append(1)', 'x.a.b = 1', 'x[0] = 1', 'del x[0]', 'x += [1]', 'f(x)', 'y = [x]', 'y[x] = 1',
+                       'y = x or 1', 'x.shape', 'x[:1]', '-x'):
+            self.assertEqual('MUTATED', self._accesses(source)['x'], source)
+        self.assertEqual({'x': 'REBOUND', 'np': 'REBOUND', 'f': 'REBOUND'},
+                         self._accesses('x = 1\nimport numpy as np\ndef f():\n    pass'))
+
+    def test_closed(self):
+        analyzer = CellAnalyzer()
+        self.assertEqual({'x', 'y'}, analyzer.analyze('x\nprint(len(y), f"{x!r}")').read_only())
+        self.assertEqual({'x'}, analyzer.analyze('y = 1\ndel z\nassert x, "x"').read_only())
+        # anything else may run code of the values, every name the cell refers to is touched
+        for source in ('f()\nx', 'x.copy()', 'for i in x:\n    pass', 'import os\nx', 'x == len(y)', 'x.shape',
+                       'x[0]', 'x + 1', 'a += b', 'y = x; y.append(1)', 'x.sort()', 'x.a = 1', 'print(*x)',
+                       'y, z = x', 'len(x)\nx.append(1)'):
+            accesses = analyzer.analyze(source)
+            self.assertFalse(accesses.closed(), source)
+            self.assertEqual(frozenset(), accesses.read_only(), source)
+        self.assertIsNone(analyzer.analyze('x ='))
+        self.assertIs(analyzer.analyze('x'), analyzer.analyze('x'))
+
+    def test_aliases(self):
+        analyzer = CellAnalyzer()
+        accesses = analyzer.analyze('y = x; y.append(1)')
+        self.assertEqual({'x': Access.MUTATED, 'y': Access.MUTATED}, accesses.accesses())
+        # the alias may be mutated by a later cell, so x is not read only even in a closed cell
+        self.assertEqual(frozenset(), analyzer.read_only(['y = x'], {'x': [], 'y': []}))
+        for source in ('a += b', 'a.extend(b)', 'a.update(b=b)'):
+            accesses = analyzer.analyze(source)
+            self.assertFalse(accesses.closed(), source)
+            self.assertEqual({'a': Access.MUTATED, 'b': Access.MUTATED}, accesses.accesses(), source)
+
+    def test_read_only(self):
+        analyzer = CellAnalyzer()
+        self.assertEqual({'x'}, analyzer.read_only(['x', 'z = 1'], {'x': 1, 'z': 2}))
+        self.assertEqual(frozenset(), analyzer.read_only(['x', 'f(y)'], {'x': 1, 'y': 2}))
+        self.assertEqual(frozenset(), analyzer.read_only(['x', 'x ='], {'x': 1}))
+        # len is shadowed by a variable
+        self.assertEqual(frozenset(), analyzer.read_only(['len(x)'], {'x': [], 'len': len}))
+
+    def test_read_only_types(self):
+        analyzer = CellAnalyzer()
+        namespace = {'i': 1, 's': 's', 'l': [_Dunders()], 'd': {}, 'o': _Dunders()}
+        self.assertEqual({'i', 's', 'l', 'd'},
+                         analyzer.read_only(['print(i, f"{s}")', 'if l and len(d):\n    pass', 'bool(s)'], namespace))
+        # dunders of other values may mutate anything
+        for source in ('o', 'len(o)', 'if o:\n    pass', 'f"{o}"', 'print(l)', 'l', 'str(d)', 'x'):
+            self.assertEqual(frozenset(), analyzer.read_only([source, 'i'], namespace), source)
+        # the sized value may have been another one
+        self.assertEqual(frozenset(), analyzer.read_only(['len(i)', 'i = 1'], namespace))
+        self.assertEqual(frozenset(), analyzer.read_only(['s = o; print(s)', 'i'], namespace))
+
+    def test_magics(self):
+        if TransformerManager is None:
+            self.skipTest('IPython is not installed')
+        accesses = CellAnalyzer().analyze('%time x\nx')
+        self.assertFalse(accesses.closed())
+        self.assertEqual(Access.READ_ONLY, accesses.accesses()['x'])
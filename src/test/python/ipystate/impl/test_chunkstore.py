@@ -0,0 +1,82 @@
+import io
+import json
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+
+from ipystate.impl.chunkstore import ChunkRef, LocalChunkStore, chunk_digest
+from ipystate.impl.memo import ChunkedFile
+
+
+class TestLocalChunkStore(TestCase):
+    def test_put_and_collect(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalChunkStore(root)
+            cf = ChunkedFile(spill_threshold=0)
+            cf.write(b'spilled')
+            spilled = cf.current_chunk()
+            self.assertEqual(chunk_digest(io.BytesIO(b'spilled')), chunk_digest(spilled))
+
+            ref = store.put(spilled)
+            self.assertIsInstance(ref, ChunkRef)
+            self.assertEqual(b'spilled', bytes(ref))
+            self.assertEqual(b'lle', ref.read()[3:6])
+
+            # unchanged chunks are not rewritten
+            path = store._path(ref.digest())
+            mtime = os.stat(path).st_mtime_ns
+            self.assertEqual(ref.digest(), store.put(io.BytesIO(b'spilled')).digest())
+            self.assertEqual(mtime, os.stat(path).st_mtime_ns)
+
+            # references are pickled as digests and read from the store
+            loaded = pickle.loads(pickle.dumps(ref))
+            self.assertNotIn(b'spilled', pickle.dumps(ref))
+            self.assertEqual(b'spilled', bytes(loaded))
+
+            store.retain([ref.digest(), ref.digest()])
+            store.release([ref.digest()])
+            self.assertEqual(0, store.collect())
+            self.assertEqual(1, LocalChunkStore(root).refcount(ref.digest()))
+
+            store.release([ref.digest()])
+            store.retain([ref.digest()])
+            store.release([ref.digest()])
+            self.assertEqual(1, store.collect())
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(0, LocalChunkStore(root).refcount(ref.digest()))
+
+    def test_refcounts_journal(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalChunkStore(root)
+            digests = [store.put(io.BytesIO(bytes([i]))).digest() for i in range(10)]
+            store.retain(digests)
+            store.collect()
+            # the journal is merged once it holds more counts than the store has
+            store.retain(digests[9:])
+            store.collect()
+            self.assertFalse(os.path.exists(os.path.join(root, LocalChunkStore.JOURNAL_FILE)))
+
+            # small changes are appended to the journal rather than rewriting all the counts
+            store.retain(digests[:2])
+            store.release(digests[2:3])
+            self.assertEqual(1, store.collect())
+            with open(os.path.join(root, LocalChunkStore.JOURNAL_FILE)) as f:
+                self.assertEqual({digests[0]: 2, digests[1]: 2, digests[2]: 0}, json.loads(f.readlines()[-1]))
+            restarted = LocalChunkStore(root)
+            self.assertEqual([2, 2, 0, 1, 2], [restarted.refcount(digest) for digest in digests[:4] + digests[9:]])
+
+            # a line which was not written to the end is ignored
+            with open(os.path.join(root, LocalChunkStore.JOURNAL_FILE), 'a') as f:
+                f.write('{"' + digests[3])
+            self.assertEqual([2, 2, 0, 1], [LocalChunkStore(root).refcount(digest) for digest in digests[:4]])
+
+            store.release(digests + digests[:2] + digests[9:])
+            store.collect()
+            self.assertEqual({}, LocalChunkStore(root)._counts())
+
+    def test_unpickled_refs_share_the_store(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalChunkStore(root)
+            ref = store.put(io.BytesIO(b'shared'))
+            self.assertIs(store, pickle.loads(pickle.dumps(ref))._store)
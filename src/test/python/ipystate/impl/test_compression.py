@@ -0,0 +1,53 @@
+import os
+import pickle
+from unittest import TestCase, mock
+
+from ipystate.impl.compression import CODECS, NO_CODEC, Compressor, compress, decompressed
+from ipystate.impl.memo import ChunkedFile, MemoryChunk
+
+
+class TestCompression(TestCase):
+    def test_codecs(self):
+        data = pickle.dumps([str(i) for i in range(100000)])
+        for name, codec in CODECS.items():
+            compressed = compress(codec, [data[:1000], data[1000:]])
+            self.assertLess(len(compressed), len(data) // 2, name)
+            stream = decompressed(compressed, name)
+            parts = []
+            while True:
+                part = stream.read(1000)
+                if not part:
+                    break
+                parts.append(part)
+            self.assertEqual(data, b''.join(parts), name)
+
+    def test_compressor(self):
+        compressor = Compressor(['zlib', 'lzma'], bandwidth=2 ** 20)
+        cf = ChunkedFile(spill_threshold=0)
+        pickle.dump(list(range(100000)), cf)
+        spilled = cf.current_chunk()
+        payload, codec = compressor.compress('list', spilled)
+        self.assertIn(codec, ('zlib', 'lzma'))
+        self.assertEqual(list(range(100000)), pickle.load(decompressed(payload, codec)))
+
+        # incompressible and small payloads are kept as is
+        incompressible = MemoryChunk([os.urandom(100000)])
+        self.assertEqual((incompressible, None), compressor.compress('bytes', incompressible))
+        small = MemoryChunk([b'x' * 100])
+        self.assertEqual((small, None), compressor.compress('bytes', small))
+
+        stats = compressor.stats()
+        self.assertEqual(len(spilled), stats[codec].nbytes())
+        self.assertGreater(stats[codec].ratio(), 2)
+        self.assertEqual(2, stats[NO_CODEC].payloads())
+
+    def test_choices_are_cached(self):
+        compressor = Compressor(['zlib'], bandwidth=2 ** 20)
+        payload = MemoryChunk([b'abc' * 10000])
+        with mock.patch.object(compressor, '_probe', wraps=compressor._probe) as probe:
+            for _ in range(3):
+                self.assertEqual('zlib', compressor.compress('bytes', payload)[1])
+            compressor.compress('str', payload)
+            compressor.compress('bytes', MemoryChunk([b'abc' * 100000]))
+        # once per type and size class
+        self.assertEqual(3, probe.call_count)
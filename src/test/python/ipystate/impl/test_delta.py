@@ -0,0 +1,52 @@
+import os
+import pickle
+from unittest import TestCase
+
+from ipystate.impl.delta import apply_delta, encode_delta, DeltaBase
+from ipystate.impl.memo import ChunkedFile
+
+
+class TestDelta(TestCase):
+    def _check(self, base: bytes, data: bytes) -> bytes:
+        delta = encode_delta(base, data)
+        self.assertEqual(data, apply_delta(base, delta))
+        return delta
+
+    def test_pickles(self):
+        values = list(range(100000))
+        base = pickle.dumps(values, protocol=4)
+        values.insert(10, 'inserted')
+        values[50000] = -1
+        del values[90000:90010]
+        data = pickle.dumps(values, protocol=4)
+        self.assertLess(len(self._check(base, data)), len(data) // 20)
+        self.assertLess(len(self._check(base, base)), 100)
+
+    def test_bytes(self):
+        base = os.urandom(100000)
+        self.assertLess(len(self._check(base, base[:100] + b'inserted' + base[100:50000] + base[50100:])), 200)
+        for data in (b'', b'x', base[:10], base + b'appended'):
+            self._check(base, data)
+            self._check(data, base)
+
+        other = os.urandom(100000)
+        self.assertIsNone(encode_delta(base, other, max_size=len(other) // 2))
+        self.assertRaises(ValueError, apply_delta, base, other)
+
+    def test_delta_base(self):
+        values = list(range(10000))
+        base = pickle.dumps(values, protocol=4)
+        values[5000] = -1
+        data = pickle.dumps(values, protocol=4)
+        # a spilled payload is copied to the base file without being read into memory
+        cf = ChunkedFile(spill_threshold=0)
+        cf.write(base)
+        kept = DeltaBase(cf.current_chunk(), 'digest')
+        try:
+            with kept.mapped() as view:
+                self.assertEqual(base, view[:])
+                delta = encode_delta(view, data)
+            self.assertEqual(data, apply_delta(base, delta))
+            self.assertLess(len(delta), 100)
+        finally:
+            kept.close()
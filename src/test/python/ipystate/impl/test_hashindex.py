@@ -0,0 +1,68 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from ipystate.impl.changedetector import ChangedState, ChangeStage, HashChangeDetector
+from ipystate.impl.hashindex import SqliteHashIndex
+
+
+class TestSqliteHashIndex(TestCase):
+    def test_restart(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'hashes.db')
+            detector = HashChangeDetector(index=SqliteHashIndex(path))
+            detector.begin()
+            detector.update(ChangeStage.RAW, 'a', [1, 2])
+            detector.update(ChangeStage.RAW, 'b', bytearray(b'b'))
+            detector.commit()
+            detector.end()
+
+            # a restarted kernel with the variables restored
+            restarted = HashChangeDetector(index=SqliteHashIndex(path))
+            restarted.begin()
+            self.assertEqual(ChangedState.UNCHANGED, restarted.update(ChangeStage.RAW, 'a', [1, 2]))
+            self.assertEqual(ChangedState.CHANGED, restarted.update(ChangeStage.RAW, 'b', bytearray(b'c')))
+            self.assertEqual(ChangedState.NEW, restarted.update(ChangeStage.RAW, 'c', 'c'))
+            restarted.commit()
+            restarted.end()
+
+            restarted.reset()
+            restarted.commit()
+            self.assertEqual({}, SqliteHashIndex(path).load())
+
+    def test_failed_commit(self):
+        with tempfile.TemporaryDirectory() as root:
+            index = SqliteHashIndex(os.path.join(root, 'hashes.db'))
+            detector = HashChangeDetector(index=index)
+            detector.begin()
+            detector.update(ChangeStage.RAW, 'a', [1])
+            detector.commit()
+            detector.end()
+            saved = index.load()
+
+            # hashes of a commit which did not succeed are neither saved nor kept
+            detector.begin()
+            self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'a', [2]))
+            self.assertEqual(ChangedState.NEW, detector.update(ChangeStage.RAW, 'b', 'b'))
+            detector.end()
+            self.assertEqual(saved, index.load())
+            detector.begin()
+            self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'a', [2]))
+            self.assertEqual(ChangedState.NEW, detector.update(ChangeStage.RAW, 'b', 'b'))
+            detector.commit()
+            detector.end()
+            self.assertNotEqual(saved, index.load())
+
+    def test_forked_processes_do_not_save(self):
+        with tempfile.TemporaryDirectory() as root:
+            index = SqliteHashIndex(os.path.join(root, 'hashes.db'))
+            detector = HashChangeDetector(index=index)
+            with mock.patch('os.getpid', return_value=-1):
+                detector.update(ChangeStage.RAW, 'a', 'a')
+                detector.commit()
+            self.assertEqual({}, index.load())
+
+            # the state of the child is saved once the parent applies it
+            state = detector.state()
+            HashChangeDetector(index=index).set_state(state)
+            self.assertEqual(state, index.load())
@@ -0,0 +1,138 @@
+import pickle
+from unittest import TestCase, mock
+
+from ipystate.impl.changedetector import ChangedState, ChangeStage, HashChangeDetector
+from ipystate.impl.hashing import CONTAINER_HASH_MAX_SIZE, default_hash_functions, default_sample_functions, \
+    hash_arrow, hash_ndarray, hash_pandas, hash_primitives
+from ipystate.impl.memo import MemoryChunk
+
+
+class TestHashing(TestCase):
+    def _assert_detects(self, value, change):
+        detector = HashChangeDetector()
+        self.assertEqual(ChangedState.NEW, detector.update(ChangeStage.RAW, 'x', value))
+        self.assertEqual(ChangedState.UNCHANGED, detector.update(ChangeStage.RAW, 'x', value))
+        change(value)
+        self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'x', value))
+
+    def test_primitives(self):
+        self._assert_detects([1, 'a', {'b': (2.0, None)}], lambda v: v[2].__setitem__('b', (2, None)))
+        self._assert_detects(bytearray(b'abc'), lambda v: v.__setitem__(0, 0))
+        self.assertNotEqual(hash_primitives([1, 'a']), hash_primitives([1, b'a']))
+        self.assertNotEqual(hash_primitives(['ab']), hash_primitives(['a', 'b']))
+        self.assertNotEqual(hash_primitives({1: 2}), hash_primitives({1: 2.0}))
+        self.assertRaises(TypeError, hash_primitives, [object()])
+        self.assertRaises(TypeError, hash_primitives, list(range(CONTAINER_HASH_MAX_SIZE + 1)))
+
+        detector = HashChangeDetector()
+        cyclic = []
+        cyclic.append(cyclic)
+        self.assertEqual(ChangedState.UNKNOWN, detector.update(ChangeStage.RAW, 'x', cyclic))
+        self.assertEqual(ChangedState.UNKNOWN, detector.update(ChangeStage.RAW, 'y', object()))
+
+    def test_pickled(self):
+        detector = HashChangeDetector()
+        payload = pickle.dumps(list(range(100)))
+        self.assertEqual(ChangedState.NEW, detector.update(ChangeStage.PICKLED, 'x', MemoryChunk([payload])))
+        self.assertEqual(ChangedState.UNCHANGED,
+                         detector.update(ChangeStage.PICKLED, 'x', MemoryChunk([payload[:10], payload[10:]])))
+
+    def test_numpy(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        a = np.arange(12, dtype=np.int64).reshape(3, 4)
+        self._assert_detects(a, lambda v: v.__setitem__((2, 3), -1))
+        self.assertNotEqual(hash_ndarray(a), hash_ndarray(a.view(np.uint64)))
+        self.assertNotEqual(hash_ndarray(a), hash_ndarray(a.reshape(4, 3)))
+        self.assertNotEqual(hash_ndarray(a[:, ::2]), hash_ndarray(a[:, 1::2]))
+        self.assertEqual(hash_ndarray(a.T), hash_ndarray(np.asfortranarray(a.T)))
+        self.assertRaises(TypeError, hash_ndarray, np.array([[1]], dtype=object))
+
+    def test_pandas(self):
+        try:
+            import pandas as pd
+        except ImportError:
+            self.skipTest('pandas is not installed')
+        df = pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', None]})
+        self._assert_detects(df, lambda v: v.loc.__setitem__((1, 'b'), 'z'))
+        self.assertNotEqual(hash_pandas(df), hash_pandas(df.rename(columns={'a': 'c'})))
+        self.assertNotEqual(hash_pandas(df), hash_pandas(df.set_index(pd.Index([3, 4, 5]))))
+        self.assertNotEqual(hash_pandas(df['a']), hash_pandas(df['a'].astype(float)))
+        # row hashes do not follow the index names and dtypes, nor attrs
+        self.assertNotEqual(hash_pandas(df), hash_pandas(df.rename_axis('i')))
+        self.assertNotEqual(hash_pandas(df.set_axis(pd.Index([3, 4, 5], dtype='int64'))),
+                            hash_pandas(df.set_axis(pd.Index([3, 4, 5], dtype='int32'))))
+        self.assertNotEqual(hash_pandas(df['a']), hash_pandas(df['a'].rename_axis('i')))
+        self.assertNotEqual(hash_pandas(pd.Index([1, 2])), hash_pandas(pd.Index([1, 2], dtype='int32')))
+        multi = pd.MultiIndex.from_arrays([[1, 2], ['x', 'y']])
+        self.assertNotEqual(hash_pandas(multi), hash_pandas(multi.set_names(['i', 'j'])))
+        self._assert_detects(df, lambda v: v.attrs.__setitem__('unit', 'm'))
+        self._assert_detects(df, lambda v: setattr(v.index, 'name', 'i'))
+        self.assertRaises(TypeError, hash_pandas, pd.Series([[1], [2]]))
+
+    def test_arrow(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        values = pa.array([1, 2, None, 4])
+        self.assertEqual(hash_arrow(values), hash_arrow(pa.array([1, 2, None, 4])))
+        self.assertNotEqual(hash_arrow(values.slice(1)), hash_arrow(values.slice(2)))
+        self.assertNotEqual(hash_arrow(pa.array(['a', 'b']).dictionary_encode()),
+                            hash_arrow(pa.array(['a', 'c']).dictionary_encode()))
+        table = pa.table({'a': values})
+        self.assertNotEqual(hash_arrow(table), hash_arrow(table.rename_columns(['b'])))
+        self.assertEqual(hash_arrow(pa.py_buffer(b'abc')), hash_arrow(pa.py_buffer(bytearray(b'abc'))))
+        self.assertRaises(TypeError, hash_arrow, pa.array([[1], [2]]))
+
+    @mock.patch('ipystate.impl.hashing.MERKLE_BLOCK_SIZE', 1024)
+    def test_changed_blocks(self):
+        detector = HashChangeDetector()
+        value = bytearray(4096)
+        detector.update(ChangeStage.RAW, 'x', value)
+        value[1500] = 1
+        value[4095] = 1
+        self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'x', value))
+        self.assertEqual([1, 3], detector.changed_blocks(ChangeStage.RAW, 'x'))
+        self.assertEqual(ChangedState.UNCHANGED, detector.update(ChangeStage.RAW, 'x', value))
+        self.assertIsNone(detector.changed_blocks(ChangeStage.RAW, 'x'))
+        value.extend(b'x')
+        self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'x', value))
+        # the shape changed
+        self.assertIsNone(detector.changed_blocks(ChangeStage.RAW, 'x'))
+
+    @mock.patch('ipystate.impl.hashing.MERKLE_ROW_GROUP_SIZE', 10)
+    def test_changed_row_groups(self):
+        try:
+            import pandas as pd
+        except ImportError:
+            self.skipTest('pandas is not installed')
+        detector = HashChangeDetector()
+        df = pd.DataFrame({'a': range(30), 'b': [str(i) for i in range(30)]})
+        detector.update(ChangeStage.RAW, 'df', df)
+        df.loc[15, 'b'] = 'changed'
+        self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'df', df))
+        self.assertEqual([(1, 1)], detector.changed_blocks(ChangeStage.RAW, 'df'))
+
+    def test_sampled_precheck(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        detector = HashChangeDetector(sample_functions=default_sample_functions())
+        a = np.zeros(1000)
+        detector.update(ChangeStage.RAW, 'a', a)
+        a[0] = 1
+        with mock.patch('ipystate.impl.hashing.hash_ndarray') as hash_ndarray:
+            detector._dispatch[np.ndarray] = hash_ndarray
+            self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'a', a))
+            hash_ndarray.assert_not_called()
+        detector._dispatch[np.ndarray] = default_hash_functions()[np.ndarray]
+        # nothing to compare to after a pre-check
+        self.assertEqual(ChangedState.UNKNOWN, detector.update(ChangeStage.RAW, 'a', a))
+        self.assertEqual(ChangedState.UNCHANGED, detector.update(ChangeStage.RAW, 'a', a))
+        # changes between the samples are found by hashing
+        a[300] = 1
+        self.assertEqual(ChangedState.CHANGED, detector.update(ChangeStage.RAW, 'a', a))
@@ -0,0 +1,99 @@
+import io
+import pickle
+from unittest import TestCase, mock
+
+from ipystate.impl.hashing import hash_chunk
+from ipystate.impl.memo import ChunkedFile, MemoryChunk, FileChunk
+from ipystate.utils import StreamingUtils
+
+
+class TestChunkedFile(TestCase):
+    def _write_chunks(self, cf, chunks):
+        views = []
+        for chunk in chunks:
+            for i in range(0, len(chunk), 3):
+                cf.write(chunk[i:i + 3])
+            views.append(cf.current_chunk())
+            cf.reset()
+        return views
+
+    def test_in_memory(self):
+        cf = ChunkedFile()
+        views = self._write_chunks(cf, [b'first', b'', b'third chunk'])
+        self.assertFalse(cf.spilled)
+        self.assertTrue(all(isinstance(view, MemoryChunk) for view in views))
+        self.assertEqual([b'first', b'', b'third chunk'], [bytes(view) for view in views])
+
+    def test_zero_copy(self):
+        frame = bytes(range(256)) * 64
+        mutable = bytearray(frame)
+        cf = ChunkedFile()
+        cf.write(b'head')
+        cf.write(frame)
+        cf.write(mutable)
+        cf.write(b'tail')
+        view = cf.current_chunk()
+        cf.reset()
+        cf.write(b'next')
+        next_view = cf.current_chunk()
+        mutable[:4] = b'XXXX'
+
+        head, by_reference, copied, tail = view.buffers()
+        self.assertIs(frame, by_reference.obj)
+        self.assertIsNot(mutable, copied.obj)
+        # small writes of consecutive chunks share an arena block
+        self.assertIs(tail.obj, next_view.buffers()[0].obj)
+        self.assertEqual(b'head' + frame + frame + b'tail', bytes(view))
+        self.assertEqual(frame[:10], view.read(14)[4:])
+        view.seek(len(frame))
+        self.assertEqual(frame[-4:] + frame[:-4], view.read(len(frame)))
+        self.assertEqual(bytes(view), view.getbuffer())
+        self.assertEqual(b'next', bytes(next_view))
+
+    def test_spill(self):
+        chunks = [bytes([i]) * (i * 10) for i in range(10)]
+        cf = ChunkedFile(spill_threshold=100)
+        views = self._write_chunks(cf, chunks)
+        self.assertTrue(cf.spilled)
+        self.assertIsInstance(views[-1], FileChunk)
+        self.assertEqual(chunks, [bytes(view) for view in views])
+        self.assertEqual(list(map(len, chunks)), list(map(len, views)))
+
+        # views are independent file-like objects
+        view = views[-1]
+        self.assertEqual(bytes([9]) * 5, view.read(5))
+        view.seek(-2, io.SEEK_END)
+        self.assertEqual(bytes([9]) * 2, view.read())
+        self.assertEqual(b'', view.read())
+        self.assertEqual(chunks[-2], views[-2].read())
+
+        self.assertEqual(chunks[-1], bytes(pickle.loads(pickle.dumps(view))))
+
+    @mock.patch('ipystate.impl.hashing.MERKLE_BLOCK_SIZE', 16)
+    def test_hash_chunks(self):
+        chunks = [bytes([i]) * (i * 10) for i in range(10)]
+        views = self._write_chunks(ChunkedFile(spill_threshold=100, hash_chunks=True), chunks)
+        self.assertIsInstance(views[-1], FileChunk)
+        for chunk, view in zip(chunks, views):
+            # the same as if the chunk was read again
+            self.assertEqual(hash_chunk(MemoryChunk([chunk])), view.block_hashes())
+            self.assertEqual(len(chunk) // 16 + (len(chunk) % 16 > 0), len(view.block_hashes().blocks()))
+        self.assertEqual(views[-1].block_hashes(), pickle.loads(pickle.dumps(views[-1])).block_hashes())
+
+        view, = self._write_chunks(ChunkedFile(), [b'abc'])
+        self.assertIsNone(view.block_hashes())
+
+    def test_streaming_utils(self):
+        cf = ChunkedFile(spill_threshold=0)
+        view, = self._write_chunks(cf, [b'x' * 10000])
+        out = io.BytesIO()
+        StreamingUtils.transfer(view, out)
+        self.assertEqual(b'x' * 10000, out.getvalue())
+        self.assertEqual(b'x' * 10000, StreamingUtils.to_bytes(view))
+        self.assertEqual(b'abc', StreamingUtils.to_bytes(io.BytesIO(b'abc')))
+
+        view, = self._write_chunks(ChunkedFile(), [b'x' * 10000])
+        out = io.BytesIO()
+        StreamingUtils.transfer(view, out)
+        self.assertEqual(b'x' * 10000, out.getvalue())
+        self.assertEqual(b'x' * 10000, StreamingUtils.to_bytes(view))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+from unittest import TestCase, skipUnless
+
+from ipystate.impl.snapshot import fork_snapshot, SnapshotFailedError
+
+
+@skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+class TestSnapshot(TestCase):
+    def test_stream_changes(self):
+        data = list(range(10))
+        results = []
+
+        def run(send):
+            for x in data:
+                send(x)
+            data.append('child only')
+            return len(data)
+
+        snapshot = fork_snapshot(run, results.append)
+        data.append('parent only')
+        self.assertEqual(list(range(10)), list(snapshot.changes()))
+        self.assertTrue(snapshot.finished)
+        self.assertFalse(snapshot.failed)
+        self.assertEqual([11], results)
+
+    def test_unread_changes(self):
+        with tempfile.TemporaryDirectory() as root:
+            marker = os.path.join(root, 'done')
+
+            def run(send):
+                # much more than a pipe buffer holds
+                for i in range(16):
+                    send(bytes(1 << 20))
+                open(marker, 'w').close()
+
+            snapshot = fork_snapshot(run, lambda result: None)
+            # the child finishes before the parent reads anything
+            deadline = time.monotonic() + 30
+            while not os.path.exists(marker) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(marker))
+            self.assertEqual([1 << 20] * 16, [len(change) for change in snapshot.changes()])
+            self.assertFalse(snapshot.failed)
+
+    def test_failure(self):
+        def run(send):
+            send(1)
+            raise ValueError('boom')
+
+        results = []
+        snapshot = fork_snapshot(run, results.append)
+        self.assertTrue(snapshot.wait())
+        self.assertTrue(snapshot.failed)
+        self.assertIn('boom', snapshot.error)
+        with self.assertRaises(SnapshotFailedError):
+            list(snapshot.changes())
+        self.assertEqual([], results)
+
+    def test_crash(self):
+        snapshot = fork_snapshot(lambda send: os._exit(3), lambda result: None)
+        self.assertTrue(snapshot.wait())
+        self.assertIn('status 3', snapshot.error)
+
+    def test_wait_and_cancel(self):
+        def run(send):
+            time.sleep(60)
+
+        snapshot = fork_snapshot(run, lambda result: None)
+        self.assertFalse(snapshot.wait(timeout=0.1))
+        snapshot.cancel()
+        self.assertTrue(snapshot.finished)
+        self.assertEqual('cancelled', snapshot.error)
+
+    def test_results_in_order(self):
+        results = []
+        first = fork_snapshot(lambda send: time.sleep(0.2) or 1, results.append)
+        second = fork_snapshot(lambda send: 2, results.append, first)
+        second.wait()
+        self.assertTrue(first.finished)
+        self.assertEqual([1, 2], results)
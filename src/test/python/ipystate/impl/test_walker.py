@@ -1,6 +1,63 @@
+import copyreg
+import gc
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
 
-from ipystate.impl.walker import Walker
+from ipystate.impl.walker import Walker, LeafTypeRegistry, LEAF, CONSTANT
+
+
+class _Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class _SlottedPoint:
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class _Reduced:
+    def __init__(self, x):
+        self.x = x
+
+    def __reduce__(self):
+        return _Reduced, (None,)
+
+
+class _Blocking:
+    def __init__(self, entered, release):
+        self.entered = entered
+        self.release = release
+
+    def __reduce__(self):
+        self.entered.set()
+        self.release.wait(10)
+        return _Blocking, (None, None)
+
+
+class _Transient:
+    def __init__(self, x):
+        self.x = x
+
+    def __reduce__(self):
+        # fresh containers on every call
+        return _Transient, ([self.x],), {'x': [self.x]}, iter([[self.x]]), iter([('x', [self.x])])
+
+
+class _NewObj:
+    def __init__(self, x):
+        self.x = x
+
+    def __reduce_ex__(self, protocol):
+        # a fresh args tuple on every call, which the walker slices
+        return copyreg.__newobj__, (_NewObj, self.x), None
 
 
 class TestWalker(TestCase):
@@ -11,3 +68,360 @@ class TestWalker(TestCase):
             [frozenset({'a'}), frozenset({'b'}), frozenset({'time'})],
             Walker().walk({'a': [time], 'b': [time], 'time': time}),
         )
+
+    def test_walk_incremental(self):
+        shared = [1]
+        env = {'a': [shared], 'b': [shared], 'c': [2], 'd': {'k': [3]}}
+        walker = Walker()
+        self.assertCountEqual([frozenset({'a', 'b'}), frozenset({'c'}), frozenset({'d'})], walker.walk(env))
+
+        env['c'] = [shared]
+        del env['b']
+        self.assertCountEqual(
+            [frozenset({'a', 'c'}), frozenset({'d'})],
+            walker.walk_incremental(env, touched={'c'}, deleted={'b'}),
+        )
+
+        env['e'] = env['d']['k']
+        self.assertCountEqual(
+            [frozenset({'a', 'c'}), frozenset({'d', 'e'})],
+            walker.walk_incremental(env, touched={'e'}, deleted=()),
+        )
+        self.assertCountEqual(Walker().walk(env), walker.walk_incremental(env, touched=(), deleted=()))
+
+    def test_walk_incremental_splits_components(self):
+        shared = [1]
+        env = {'a': [shared], 'b': [shared]}
+        walker = Walker()
+        self.assertCountEqual([frozenset({'a', 'b'})], walker.walk(env))
+
+        env['b'] = [2]
+        self.assertCountEqual(
+            [frozenset({'a'}), frozenset({'b'})],
+            walker.walk_incremental(env, touched={'b'}, deleted=()),
+        )
+
+    def test_walk_incremental_random(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            env = {f'v{i}': [i] for i in range(8)}
+            walker = Walker()
+            walker.walk(env)
+            for _ in range(5):
+                # only assigned variables are touched, a cell may change objects of others through aliases
+                touched = set()
+                for _ in range(rng.randrange(1, 4)):
+                    a, b = rng.sample(sorted(env), 2)
+                    op = rng.randrange(3)
+                    if op == 0:
+                        env[a] = env[b]
+                    elif op == 1:
+                        env[a].append(env[b])
+                    else:
+                        env[a] = [rng.randrange(10)]
+                    touched.add(a)
+                self.assertEqual(sorted(map(sorted, Walker().walk(env))),
+                                 sorted(map(sorted, walker.walk_incremental(env, touched, []))))
+
+    def test_walk_incremental_reused_ids(self):
+        walker = Walker()
+        shared = [0]
+        env = {'k': _Transient(1), 'm': shared, 'x': [1]}
+        walker.walk(env)
+        for i in range(200):
+            # new objects may take the ids of freed ones, e.g. of the transient reduce results of k
+            env['x'] = [[[i]] for _ in range(10)] + [shared] if i % 2 else [[i] for _ in range(10)]
+            env['m'] = [shared] if i % 3 else shared
+            gc.collect()
+            self.assertEqual(
+                sorted(map(sorted, Walker().walk(env))),
+                sorted(map(sorted, walker.walk_incremental(env, touched={'x', 'm'}, deleted=()))),
+            )
+
+    def test_walk_newobj_args(self):
+        shared = [0]
+        env = {'a': _NewObj([1]), 'b': _NewObj(shared), 'c': _NewObj(shared)}
+        for _ in range(100):
+            # the sliced args of a must not take an id of the args of b or c
+            self.assertEqual([['a'], ['b', 'c']], sorted(map(sorted, Walker().walk(env))))
+
+    def test_walk_many_variables(self):
+        shared = [0]
+        env = {f'v{i}': [i, shared] if i % 2 else [i] for i in range(100)}
+        components = Walker().walk(env)
+        self.assertIn(frozenset(f'v{i}' for i in range(1, 100, 2)), components)
+        self.assertEqual(51, len(components))
+
+    def test_walk_deep_structures(self):
+        shared = [0]
+        deep_list, deep_tuple = [shared], (shared,)
+        for _ in range(10 ** 5):
+            deep_list = [deep_list]
+            deep_tuple = (deep_tuple,)
+        walker = Walker()
+        walker.enable_full_walk()
+        self.assertCountEqual([frozenset({'a', 'b'})], walker.walk({'a': deep_list, 'b': deep_tuple}))
+
+    def test_walk_constant_cache(self):
+        table = tuple((i, str(i), (float(i),)) for i in range(1000))
+        mixed = tuple([i] for i in range(1000))
+        env = {'table': table, 'ref': [table], 'mixed': mixed, 'mixed_ref': [mixed]}
+        walker = Walker()
+        walker.enable_full_walk()
+        expected = [frozenset({'table'}), frozenset({'ref'}), frozenset({'mixed', 'mixed_ref'})]
+        self.assertCountEqual(expected, walker.walk(env))
+        self.assertEqual(1, len(walker.constant_cache))
+        self.assertTrue(walker.constant_cache.contains(table))
+        self.assertCountEqual(expected, walker.walk(env))
+        # digests of cached constants are computed once
+        digest = walker.constant_cache.digest(table)
+        self.assertIsNotNone(digest)
+        self.assertIs(digest, walker.constant_cache.digest(table))
+        self.assertIsNone(walker.constant_cache.digest(mixed))
+
+        del env['table'], env['ref'], table
+        walker.walk(env)
+        self.assertEqual(0, len(walker.constant_cache))
+
+    def test_walk_instances(self):
+        shared = [0]
+        env = {
+            'a': _Point(1, shared), 'b': _SlottedPoint(shared, 2), 'c': _SlottedPoint(3, 4),
+            'd': _Reduced(shared), 'e': [shared],
+        }
+        self.assertCountEqual(
+            [frozenset({'a', 'b', 'e'}), frozenset({'c'}), frozenset({'d'})],
+            Walker().walk(env),
+        )
+
+    def test_walk_leaf_types(self):
+        leaf_types = LeafTypeRegistry()
+        leaf_types.register(('lazy.module', 'Opaque'), LEAF)
+        leaf_types.register(('lazy.module', 'Scalar'), CONSTANT)
+        walker = Walker(leaf_types=leaf_types)
+
+        # defined after the registration, as if the module was imported later
+        Opaque = type('Opaque', (), {'__module__': 'lazy.module'})
+        Scalar = type('Scalar', (), {'__module__': 'lazy.module'})
+        SubOpaque = type('SubOpaque', (Opaque,), {})
+        shared = [0]
+        opaque, sub_opaque, scalar = Opaque(), SubOpaque(), Scalar()
+        opaque.ref = sub_opaque.ref = scalar.ref = shared
+
+        self.assertEqual(LEAF, leaf_types.action(SubOpaque))
+        self.assertCountEqual(
+            [frozenset({'a', 'b'}), frozenset({'c', 'd'}), frozenset({'e'}), frozenset({'f'}), frozenset({'g'})],
+            walker.walk({'a': [opaque], 'b': [opaque], 'c': [sub_opaque], 'd': sub_opaque,
+                         'e': [scalar], 'f': [scalar], 'g': shared}),
+        )
+
+    def test_walk_sampled_collections(self):
+        walker = Walker(collection_limit=10)
+        shared = [0]
+        env = {
+            'ints': list(range(100)),
+            'pairs': {str(i): i for i in range(100)},
+            'head': [shared] + list(range(100)),
+            'tuple': tuple(range(100)),
+            'shared': shared,
+        }
+        self.assertCountEqual(
+            [frozenset({'ints'}), frozenset({'pairs'}), frozenset({'head', 'shared'}), frozenset({'tuple'})],
+            walker.walk(env),
+        )
+        self.assertEqual(set(), walker.partially_walked)
+
+        # shared object is left out of the sample, tail is merged with all variables but constants
+        env['tail'] = list(range(100)) + [shared]
+        self.assertCountEqual(
+            [frozenset({'ints', 'pairs', 'head', 'shared', 'tail'}), frozenset({'tuple'})],
+            walker.walk(env),
+        )
+        self.assertEqual({'tail'}, walker.partially_walked)
+
+    def test_walk_budget(self):
+        walker = Walker(subtree_limit=100)
+        shared = [0]
+        env = {
+            'big': [shared] + [[i] for i in range(1000)],
+            'other_big': [[i] for i in range(1000)] + [shared],
+            'small': [1],
+            'const': 1,
+            'const_tuple': (1, 2),
+        }
+        # partially walked variables might share objects with any variable which is not a constant
+        self.assertCountEqual(
+            [frozenset({'big', 'other_big', 'small'}), frozenset({'const'}), frozenset({'const_tuple'})],
+            walker.walk(env),
+        )
+        self.assertEqual({'big', 'other_big'}, walker.partially_walked)
+
+        env['new'] = [2]
+        self.assertCountEqual(
+            [frozenset({'big', 'other_big', 'small', 'new'}), frozenset({'const'}), frozenset({'const_tuple'})],
+            walker.walk_incremental(env, ['new'], []),
+        )
+        self.assertEqual({'big', 'other_big'}, walker.partially_walked)
+
+        walker.enable_full_walk()
+        self.assertCountEqual(
+            [frozenset({'big', 'other_big'}), frozenset({'small'}), frozenset({'new'}), frozenset({'const'}),
+             frozenset({'const_tuple'})],
+            walker.walk(env),
+        )
+        self.assertEqual(set(), walker.partially_walked)
+
+    def test_walk_budget_shared_beyond(self):
+        shared = [0]
+        # the shared object is neither in the budget nor in the sample
+        env = {'a': [[i] for i in range(2000)] + [shared], 'b': shared, 'c': 'c'}
+        for walker in (Walker(subtree_limit=100), Walker()):
+            self.assertCountEqual([frozenset({'a', 'b'}), frozenset({'c'})], walker.walk(env))
+            self.assertEqual({'a'}, walker.partially_walked)
+
+    def test_walk_deadline(self):
+        walker = Walker(time_limit=0)
+        env = {
+            'big': [[i] for i in range(10000)],
+            'skipped': [1],
+            'const': 1,
+        }
+        self.assertCountEqual(
+            [frozenset({'big', 'skipped'}), frozenset({'const'})],
+            walker.walk(env),
+        )
+        self.assertEqual({'big', 'skipped'}, walker.partially_walked)
+
+    def test_fingerprints(self):
+        leaf_types = LeafTypeRegistry()
+        leaf_types.register(('lazy.module', 'Opaque'), LEAF)
+        walker = Walker(leaf_types=leaf_types, subtree_limit=100, collection_limit=10, fingerprints=True)
+        Opaque = type('Opaque', (), {'__module__': 'lazy.module'})
+        shared = [0]
+
+        def fingerprints(env):
+            walker.walk(env)
+            return walker.fingerprints
+
+        def namespace():
+            return {
+                'nested': [1, 'a', {'b': (2.0, None)}, b'c', bytearray(b'd')],
+                'point': _Point(1, _SlottedPoint(2, [3])),
+                'sampled': list(range(100)),
+                'shared': [shared, shared],
+                'reduced': _Transient(1),
+            }
+
+        expected = fingerprints(namespace())
+        self.assertEqual(expected, fingerprints(namespace()))
+        self.assertNotIn(None, expected.values())
+
+        changes = {
+            'nested': lambda v: v[2].__setitem__('b', (2, None)),
+            'point': lambda v: v.y.y.append(4),
+            'sampled': lambda v: v.__setitem__(50, -1),
+            # the same contents, but not the same objects
+            'shared': lambda v: v.__setitem__(1, [0]),
+            'reduced': lambda v: setattr(v, 'x', 2),
+        }
+        for name, change in changes.items():
+            env = namespace()
+            change(env[name])
+            actual = fingerprints(env)
+            self.assertNotEqual(expected[name], actual[name], name)
+            self.assertEqual({k: v for k, v in expected.items() if k != name},
+                             {k: v for k, v in actual.items() if k != name})
+
+        # back-references are fingerprinted by position, not by address
+        def aliased():
+            owned, own = [0], [1]
+            return {'owner': owned, 'ref': [owned, own, own]}
+
+        expected = fingerprints(aliased())
+        self.assertEqual(expected, fingerprints(aliased()))
+        env = aliased()
+        env['ref'][2] = [1]
+        self.assertNotEqual(expected['ref'], fingerprints(env)['ref'])
+
+        # classes pickled by value are fingerprinted by their pickles, redefined ones differ
+        def local_class():
+            class Local:
+                pass
+            return Local
+
+        cls = local_class()
+        expected = fingerprints({'x': cls()})
+        self.assertEqual(expected, fingerprints({'x': cls()}))
+        self.assertNotEqual(expected, fingerprints({'x': local_class()()}))
+
+        # leaves without a hash function and partially walked variables are unknown
+        actual = fingerprints({'opaque': [Opaque()], 'big': [[i] for i in range(1000)], 'const': 1})
+        self.assertEqual({'opaque': None, 'big': None}, {k: v for k, v in actual.items() if k != 'const'})
+        self.assertIsNotNone(actual['const'])
+        self.assertEqual({}, Walker().fingerprints)
+
+    def test_walk_transient_reduce_results(self):
+        walker = Walker()
+        shared = [0]
+        env = {f'v{i}': _Transient([i]) for i in range(1000)}
+        env.update({'a': _Transient(shared), 'b': shared})
+        components = walker.walk(env)
+        self.assertEqual(1001, len(components))
+        self.assertIn(frozenset({'a', 'b'}), components)
+
+    def test_walk_concurrently(self):
+        def namespace(seed):
+            shared = [seed]
+            constant = tuple(range(seed, seed + 100))
+            env = {f'v{i}': [i, _Point(i, shared if i % 7 == 0 else [i])] for i in range(200)}
+            env.update({f'c{i}': (constant, i) for i in range(50)})
+            env['shared'] = shared
+            return env
+
+        namespaces = [namespace(seed) for seed in range(32)]
+        walker = Walker()
+
+        def walk(seed):
+            return sorted(map(sorted, walker.walk(namespaces[seed], namespace=seed)))
+
+        def walk_incremental(seed, step):
+            # every namespace changes differently, some of them not at all
+            env, touched, deleted = namespaces[seed], [], []
+            if (seed + step) % 3 == 0:
+                env[f'v{step}'] = [env['shared']]
+                touched.append(f'v{step}')
+            if (seed + step) % 4 == 0:
+                del env[f'c{step}']
+                deleted.append(f'c{step}')
+            if (seed + step) % 5 == 0:
+                touched.append('shared')
+            return sorted(map(sorted, walker.walk_incremental(env, touched, deleted, namespace=seed)))
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                expected = [sorted(map(sorted, Walker().walk(env))) for env in namespaces]
+                self.assertEqual(expected, list(pool.map(walk, range(len(namespaces)))))
+                for step in range(5):
+                    actual = list(pool.map(lambda seed: walk_incremental(seed, step), range(len(namespaces))))
+                    expected = [sorted(map(sorted, Walker().walk(env))) for env in namespaces]
+                    self.assertEqual(expected, actual)
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+    def test_walk_namespaces_independently(self):
+        walker = Walker()
+        walker.walk({'a': [1]}, namespace='blocked')
+        entered, release = threading.Event(), threading.Event()
+        blocked = {'a': [_Blocking(entered, release)]}
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(walker.walk_incremental, blocked, ['a'], [], namespace='blocked')
+            try:
+                self.assertTrue(entered.wait(10))
+                # the walk of another namespace does not wait for the blocked one
+                self.assertEqual([{'b'}], walker.walk_incremental({'b': [2]}, ['b'], [], namespace='other'))
+                self.assertFalse(future.done())
+            finally:
+                release.set()
+            self.assertEqual([{'a'}], future.result())
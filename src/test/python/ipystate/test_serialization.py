@@ -1,10 +1,32 @@
 import io
+import pickle
+from itertools import chain
 from unittest import TestCase
 
-from ipystate.serialization import Pickler, Unpickler
+import numpy as np
+
+from ipystate.impl.dispatch.dispatcher import OutOfBandBuffer
+from ipystate.impl.hashing import hash_chunk
+from ipystate.impl.memo import MemoryChunk
+from ipystate.serialization import Pickler, Unpickler, Serializer, PrimitiveDump, ComponentDump, OUT_OF_BAND_MIN_SIZE
 from cloudpickle import CloudPickler
 
 
+class _Serializer(Serializer):
+    def _is_primitive(self, value):
+        return isinstance(value, (int, str))
+
+    def _primitive_var_repr(self, value):
+        return io.BytesIO(repr(value).encode()), type(value).__name__
+
+
+def _dump_repr(dump):
+    if isinstance(dump, PrimitiveDump):
+        return dump.var().name(), dump.payload().getvalue()
+    assert isinstance(dump, ComponentDump)
+    return sorted(var.name() for var in dump.all_vars()), [(name, bytes(p)) for name, p in dump.serialized_vars()]
+
+
 class TestSerializer(TestCase):
     def test_persisting_namespace(self):
         __globals__ = {}
@@ -23,3 +45,134 @@ class TestSerializer(TestCase):
         self.assertEqual('old', unpickled())
         __globals__['a'] = 'new'
         self.assertEqual('new', unpickled())
+
+    def test_dump_concurrently(self):
+        shared = [0]
+        ns = {f'v{i}': [i] * 1000 for i in range(20)}
+        ns.update({'s': shared, 't': {'shared': shared}, 'i': 1, 'x': 'x'})
+        components = [{name} for name in ns if name not in ('s', 't')] + [{'s', 't'}]
+        expected = [_dump_repr(d) for d in _Serializer().dump(ns, ns.keys(), [], components)]
+        self.assertEqual(len(components), len(expected))
+
+        for serializer in (_Serializer(workers=4), _Serializer(workers=4, max_in_flight_bytes=1),
+                           _Serializer(workers=2, use_processes=True), _Serializer(spill_threshold=1000)):
+            try:
+                actual = [_dump_repr(d) for d in serializer.dump(ns, ns.keys(), [], components)]
+                self.assertEqual(expected, actual)
+            finally:
+                serializer.close()
+
+    def test_in_flight_bytes(self):
+        ns = {f'v{i}': [i] * 1000 for i in range(8)}
+        components = [{name} for name in ns]
+        started = []
+
+        class Counting(_Serializer):
+            def _dump_logged(self, component, ns):
+                started.append(component)
+                return super()._dump_logged(component, ns)
+
+        one = _Serializer().dump(ns, ns.keys(), [], components[:1])
+        serializer = Counting(workers=4, max_in_flight_bytes=next(iter(one)).nbytes() + 1)
+        try:
+            list(serializer.dump(ns, ns.keys(), [], components))
+            started.clear()
+            # running dumps are counted by the previous dumps of their variables, one fits at a time
+            for i, _ in enumerate(serializer.dump(ns, ns.keys(), [], components)):
+                self.assertEqual(i + 1, len(started))
+        finally:
+            serializer.close()
+
+    def test_memo_rollback(self):
+        shared = list(range(100))
+
+        class Unpicklable:
+            def __reduce__(self):
+                raise TypeError('unpicklable')
+
+        ns = {'a': [shared], 'b': [shared, 'b' * 10, [shared], Unpicklable()], 'c': {'shared': shared, 'b': 'b' * 10}}
+        for b in (ns['b'], ('b' * 10, [shared], Unpicklable())):
+            ns['b'] = b
+            dump, = _Serializer().dump(ns, ns.keys(), [], [{'a', 'b', 'c'}])
+            self.assertEqual({'b'}, dump.non_serialized_vars())
+            unpickler = Unpickler(ns, io.BytesIO(b''.join(bytes(payload) for _, payload in dump.serialized_vars())))
+            loaded = {name: unpickler.load() for name, _ in dump.serialized_vars()}
+            self.assertEqual({'a': ns['a'], 'c': ns['c']}, loaded)
+            self.assertIs(loaded['a'][0], loaded['c']['shared'])
+
+    def test_memo_rollbacks(self):
+        shared = list(range(100))
+
+        class Unpicklable:
+            def __reduce__(self):
+                raise TypeError('unpicklable')
+
+        # objects of the failed dumps are memoized before the failures
+        first, second = ['first'], ['second']
+        ns = {'a': [shared], 'b': [first, shared, Unpicklable()], 'c': ['c', shared], 'd': [second, Unpicklable()]}
+        ns['e'] = [ns['c'], shared, 'e', second]
+        ns['f'] = [first, ns['c'], ns['e']]
+        dump, = _Serializer().dump(ns, ns.keys(), [], [set(ns)])
+        self.assertEqual({'b', 'd'}, dump.non_serialized_vars())
+        unpickler = Unpickler(ns, io.BytesIO(b''.join(bytes(payload) for _, payload in dump.serialized_vars())))
+        loaded = {name: unpickler.load() for name, _ in dump.serialized_vars()}
+        self.assertEqual({name: ns[name] for name in 'acef'}, loaded)
+        # back-references to objects of earlier dumps resolve after the rollbacks
+        self.assertIs(loaded['a'][0], loaded['c'][1])
+        self.assertIs(loaded['c'], loaded['e'][0])
+        self.assertIs(loaded['e'], loaded['f'][2])
+
+    def test_out_of_band_buffers(self):
+        large = np.arange(OUT_OF_BAND_MIN_SIZE, dtype=np.int64)
+        # buffers of non-contiguous arrays and small buffers are pickled in-band
+        ns = {'large': large, 'small': np.arange(10), 'strided': large[::2],
+              'blob': OutOfBandBuffer(b'x' * OUT_OF_BAND_MIN_SIZE)}
+        dump, = _Serializer(out_of_band_buffers=True).dump(ns, ns.keys(), [], [set(ns)])
+        buffers = dump.out_of_band_buffers()
+        self.assertEqual({'large', 'blob'}, set(buffers))
+        self.assertEqual([large.nbytes], list(map(len, buffers['large'])))
+        in_band = sum(len(payload) for _, payload in dump.serialized_vars())
+        self.assertLess(in_band, large.nbytes)
+        self.assertEqual(in_band + large.nbytes + OUT_OF_BAND_MIN_SIZE, dump.nbytes())
+
+        stream = b''.join(bytes(payload) for _, payload in dump.serialized_vars())
+        names = [name for name, _ in dump.serialized_vars()]
+        # bytearrays stand for a writable memory map, loaded objects use it without copying
+        for raw in (buffers, {name: [bytearray(bytes(b)) for b in bs] for name, bs in buffers.items()}):
+            unpickler = Unpickler(ns, io.BytesIO(stream), buffers=chain(*(raw.get(name, []) for name in names)))
+            loaded = {name: unpickler.load() for name in names}
+            np.testing.assert_array_equal(large, loaded['large'])
+            np.testing.assert_array_equal(ns['small'], loaded['small'])
+            np.testing.assert_array_equal(ns['strided'], loaded['strided'])
+            self.assertEqual(b'x' * OUT_OF_BAND_MIN_SIZE, bytes(loaded['blob']))
+            self.assertTrue(loaded['large'].flags.writeable)
+        self.assertTrue(np.shares_memory(loaded['large'], np.frombuffer(raw['large'][0], dtype=np.uint8)))
+
+        # with older protocols the buffers are pickled in-band
+        self.assertEqual(b'abc', bytes(pickle.loads(pickle.dumps(OutOfBandBuffer(b'abc'), protocol=4))))
+
+    def test_dump_spilled_component(self):
+        shared = list(range(1000))
+        ns = {'a': [shared], 'b': {'shared': shared}, 'c': 'c' * 10000}
+        dump, = _Serializer(spill_threshold=100).dump(ns, ns.keys(), [], [{'a', 'b', 'c'}])
+        self.assertEqual(sum(len(payload) for _, payload in dump.serialized_vars()), dump.nbytes())
+        loaded = {}
+        unpickler_input = io.BytesIO()
+        for name, payload in dump.serialized_vars():
+            unpickler_input.write(bytes(payload))
+        unpickler_input.seek(0)
+        unpickler = Unpickler(ns, unpickler_input)
+        for name, _ in dump.serialized_vars():
+            loaded[name] = unpickler.load()
+        self.assertEqual(ns, loaded)
+        self.assertIs(loaded['a'][0], loaded['b']['shared'])
+
+    def test_hash_payloads(self):
+        ns = {'a': list(range(1000)), 'b': 'b' * 10000}
+        for serializer in (_Serializer(hash_payloads=True), _Serializer(hash_payloads=True, spill_threshold=100),
+                           _Serializer(hash_payloads=True, workers=2, use_processes=True)):
+            dump, = serializer.dump(ns, ns.keys(), [], [{'a', 'b'}])
+            for _, payload in dump.serialized_vars():
+                self.assertEqual(hash_chunk(MemoryChunk([bytes(payload)])), payload.block_hashes())
+        dump, = _Serializer().dump(ns, ns.keys(), [], [{'a', 'b'}])
+        self.assertIsNone(dump.serialized_vars()[0][1].block_hashes())
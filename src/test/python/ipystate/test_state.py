@@ -0,0 +1,307 @@
+import io
+import os
+import pickle
+import tempfile
+from unittest import TestCase, mock, skipUnless
+
+from ipystate.change import ComponentAtomicChange, DeltaComponentAtomicChange, PrimitiveAtomicChange, \
+    RemoveAtomicChange
+from ipystate.impl.cellanalysis import CellAnalyzer
+from ipystate.impl.changedetector import DummyChangeDetector, HashChangeDetector
+from ipystate.impl.chunkstore import LocalChunkStore
+from ipystate.impl.compression import Compressor, decompressed
+from ipystate.logger import Logger
+from ipystate.serialization import Serializer
+from ipystate.state import CellEffects, State, StateManager
+
+
+class _TrackingDict(dict):
+    def __init__(self):
+        super().__init__()
+        self.touched = set()
+
+    def __getitem__(self, key):
+        self.touched.add(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self.touched.add(key)
+        super().__setitem__(key, value)
+
+
+class _State(State):
+    def __init__(self):
+        self.ns = _TrackingDict()
+        self._before = set()
+        self.sources = None
+
+    def start_transaction(self):
+        self._before = set(self.ns)
+        self.ns.touched = set()
+
+    def pre_cell(self):
+        pass
+
+    def post_cell(self):
+        pass
+
+    def end_transaction(self):
+        return CellEffects(self.ns.touched & set(self.ns), self._before - set(self.ns), self.sources)
+
+    def varnames(self):
+        return list(self.ns)
+
+    def __contains__(self, item):
+        return item in self.ns
+
+    def __getitem__(self, varname):
+        return self.ns[varname]
+
+    def __setitem__(self, varname, value):
+        self.ns[varname] = value
+
+    def __delitem__(self, varname):
+        del self.ns[varname]
+
+
+class _Serializer(Serializer):
+    def _is_primitive(self, value):
+        return isinstance(value, (int, str))
+
+    def _primitive_var_repr(self, value):
+        return io.BytesIO(repr(value).encode()), type(value).__name__
+
+
+class _StateManager(StateManager):
+    def clear_state(self):
+        pass
+
+    def _skip_variable(self, var_name):
+        return var_name.startswith('_')
+
+
+def _change_repr(change):
+    if isinstance(change, PrimitiveAtomicChange):
+        return 'primitive', change.var().name(), change.payload().getvalue()
+    if isinstance(change, ComponentAtomicChange):
+        return 'component', sorted(v.name() for v in change.all_vars()), \
+            [(name, bytes(payload)) for name, payload in change.serialized_vars()]
+    assert isinstance(change, RemoveAtomicChange)
+    return 'remove', change.name()
+
+
+def _run_cell(manager, cell):
+    manager.pre_cell()
+    cell(manager.state.ns)
+    manager.post_cell()
+
+
+@skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+class TestStateManager(TestCase):
+    cells = [
+        lambda ns: [ns.__setitem__('a', 1), ns.__setitem__('b', [1, 2]), ns.__setitem__('c', {'x': 'y'})],
+        lambda ns: [ns['b'].append(3), ns.__setitem__('d', ns['b'])],
+        lambda ns: ns.pop('a'),
+    ]
+
+    def test_background_snapshots(self):
+        foreground = _StateManager(_State(), _Serializer(), DummyChangeDetector())
+        background = _StateManager(_State(), _Serializer(), DummyChangeDetector())
+        for cell in self.cells:
+            _run_cell(foreground, cell)
+            expected = sorted(map(_change_repr, foreground.post_cell_commit()), key=repr)
+
+            _run_cell(background, cell)
+            snapshot = background.post_cell_commit_background()
+            self.assertEqual(expected, sorted(map(_change_repr, snapshot.changes()), key=repr))
+            self.assertFalse(snapshot.failed)
+            self.assertEqual(sorted(map(sorted, foreground._comps0)), sorted(map(sorted, background._comps0)))
+
+    def test_cancelled_snapshot_is_redone(self):
+        manager = _StateManager(_State(), _Serializer(), DummyChangeDetector())
+        _run_cell(manager, self.cells[0])
+        manager.post_cell_commit_background().cancel()
+
+        manager.pre_cell()
+        manager.post_cell()
+        changes = sorted(map(_change_repr, manager.post_cell_commit()), key=repr)
+        self.assertEqual([('component', ['b']), ('component', ['c']), ('primitive', 'a')],
+                         sorted(change[:2] for change in changes))
+
+    def test_cancelled_commit_is_redone(self):
+        manager = _StateManager(_State(), _Serializer(), HashChangeDetector())
+        _run_cell(manager, lambda ns: [ns.__setitem__('a', [1]), ns.__setitem__('b', [2])])
+        list(manager.post_cell_commit())
+
+        _run_cell(manager, lambda ns: [ns['a'].append(1), ns['b'].append(2)])
+        commit = manager.post_cell_commit()
+        next(commit)
+        commit.close()
+
+        manager.pre_cell()
+        manager.post_cell()
+        changes = list(manager.post_cell_commit())
+        self.assertEqual([('component', ['a']), ('component', ['b'])],
+                         sorted(_change_repr(change)[:2] for change in changes))
+
+    def test_chunk_store(self):
+        for background in (False, True):
+            with tempfile.TemporaryDirectory() as root:
+                store = LocalChunkStore(root)
+                manager = _StateManager(_State(), _Serializer(), DummyChangeDetector(), chunk_store=store)
+
+                def commit(cell):
+                    _run_cell(manager, cell)
+                    if not background:
+                        return list(manager.post_cell_commit())
+                    snapshot = manager.post_cell_commit_background()
+                    changes = list(snapshot.changes())
+                    manager.wait_background_snapshots()
+                    return changes
+
+                changes = commit(lambda ns: [ns.__setitem__('b', [1, 2]), ns.__setitem__('c', [1, 2])])
+                # byte-identical variables share a chunk
+                digest, = set().union(*(change.digests() for change in changes))
+                self.assertEqual(2, store.refcount(digest))
+                self.assertEqual([1, 2], pickle.loads(bytes(changes[0].serialized_vars()[0][1])))
+
+                changes = commit(lambda ns: ns['b'].append(3))
+                new_digest, = changes[0].digests()
+                self.assertEqual([1, 2, 3], pickle.loads(bytes(changes[0].serialized_vars()[0][1])))
+                self.assertEqual((1, 1), (store.refcount(digest), store.refcount(new_digest)))
+
+                commit(lambda ns: ns.pop('c'))
+                self.assertEqual(0, store.refcount(digest))
+                self.assertFalse(store._contains(digest))
+                self.assertEqual(1, LocalChunkStore(root).refcount(new_digest))
+
+    @mock.patch('ipystate.state.DELTA_MAX_CHAIN', 2)
+    @mock.patch('ipystate.state.DELTA_MIN_SIZE', 1000)
+    def test_delta_encoding(self):
+        manager = _StateManager(_State(), _Serializer(), DummyChangeDetector(), delta_encoding=True)
+        _run_cell(manager, lambda ns: [ns.__setitem__('big', list(range(10000))), ns.__setitem__('small', [1])])
+        payloads = {change.serialized_vars()[0][0]: bytes(change.serialized_vars()[0][1])
+                    for change in manager.post_cell_commit()}
+
+        kinds = []
+        for i in range(4):
+            _run_cell(manager, lambda ns: [ns['big'].insert(i, -i), ns['small'].append(i)])
+            for change in manager.post_cell_commit():
+                name, payload = change.serialized_vars()[0]
+                if name == 'big':
+                    kinds.append(type(change))
+                    if isinstance(change, DeltaComponentAtomicChange):
+                        self.assertLess(len(payload), len(payloads[name]) // 10)
+                        payloads[name] = change.full_payload(name, io.BytesIO(payloads[name]))
+                    else:
+                        payloads[name] = bytes(payload)
+                else:
+                    self.assertNotIsInstance(change, DeltaComponentAtomicChange)
+                    payloads[name] = bytes(payload)
+            self.assertEqual(manager.state.ns, {name: pickle.loads(payload) for name, payload in payloads.items()})
+        # the chain is re-based to a full payload every DELTA_MAX_CHAIN deltas
+        self.assertEqual([DeltaComponentAtomicChange, DeltaComponentAtomicChange, ComponentAtomicChange,
+                          DeltaComponentAtomicChange], kinds)
+
+    def test_compression(self):
+        manager = _StateManager(_State(), _Serializer(), DummyChangeDetector(), 
+                                compressor=Compressor(['zlib'], bandwidth=2 ** 20))
+        _run_cell(manager, lambda ns: [ns.__setitem__('big', list(range(10000))), ns.__setitem__('small', [1])])
+        changes = {change.serialized_vars()[0][0]: change for change in manager.post_cell_commit()}
+        self.assertEqual({'big': 'zlib'}, changes['big'].codecs())
+        self.assertEqual({}, changes['small'].codecs())
+        payload = changes['big'].serialized_vars()[0][1]
+        self.assertEqual(list(range(10000)), pickle.load(decompressed(payload, 'zlib')))
+
+    def test_incremental_walks(self):
+        logger = mock.Mock(spec=Logger)
+        manager = _StateManager(_State(), _Serializer(), DummyChangeDetector(), logger=logger)
+
+        def walked(cell):
+            logger.reset_mock()
+            _run_cell(manager, cell)
+            list(manager.post_cell_commit())
+            prefix = 'Walking through variable '
+            return {message[len(prefix):] for (message,), _ in logger.info.call_args_list
+                    if message.startswith(prefix)}
+
+        self.assertEqual({'a', 'b', 'c', 'd'}, walked(lambda ns: [ns.__setitem__('a', [1]), ns.__setitem__('b', [2]),
+                                                                  ns.__setitem__('c', [3]),
+                                                                  ns.__setitem__('d', ns['c'])]))
+        # d is affected through the component it shares with c
+        self.assertEqual({'a'}, walked(lambda ns: ns['a'].append(1)))
+        self.assertEqual({'c', 'd'}, walked(lambda ns: ns['c'].append(1)))
+        self.assertEqual([frozenset({'a'}), frozenset({'b'}), frozenset({'c', 'd'})],
+                         sorted(manager._comps0, key=sorted))
+
+    def test_partially_walked(self):
+        manager = _StateManager(_State(), _Serializer(), HashChangeDetector())
+        # big is sampled, so it is walked through partially and merged with s
+        _run_cell(manager, lambda ns: [ns.__setitem__('big', [[i] for i in range(2000)]), ns.__setitem__('s', [1])])
+        self.assertEqual([('component', ['big', 's'])],
+                         [_change_repr(change)[:2] for change in manager.post_cell_commit()])
+
+        # s is shared beyond the sample and stays shared when loaded
+        _run_cell(manager, lambda ns: ns['big'].append(ns['s']))
+        change, = manager.post_cell_commit()
+        unpickler = pickle.Unpickler(io.BytesIO(b''.join(bytes(payload) for _, payload in change.serialized_vars())))
+        loaded = {name: unpickler.load() for name, _ in change.serialized_vars()}
+        self.assertEqual(manager.state.ns, loaded)
+        self.assertIs(loaded['s'], loaded['big'][-1])
+
+    def test_alias_changes(self):
+        manager = _StateManager(_State(), _Serializer(), HashChangeDetector())
+        _run_cell(manager, lambda ns: [ns.__setitem__('a', [1, 2]), ns.__setitem__('b', [1, 2])])
+        list(manager.post_cell_commit())
+
+        # equal values, but b is a back-reference to a now
+        _run_cell(manager, lambda ns: ns.__setitem__('b', ns['a']))
+        changes = list(manager.post_cell_commit())
+        self.assertEqual([('component', ['a', 'b'])], [_change_repr(change)[:2] for change in changes])
+
+        _run_cell(manager, lambda ns: ns.__setitem__('b', [1, 2]))
+        changes = list(manager.post_cell_commit())
+        self.assertEqual([('component', ['a']), ('component', ['b'])],
+                         sorted(_change_repr(change)[:2] for change in changes))
+
+    def test_structural_fingerprints(self):
+        manager = _StateManager(_State(), _Serializer(), HashChangeDetector(), structural_fingerprints=True)
+        _run_cell(manager, lambda ns: [ns.__setitem__('a', [1, 2]), ns.__setitem__('s', [0]),
+                                       ns.__setitem__('t', [ns['s']])])
+        self.assertEqual(['a', 's', 't'], sorted(name for change in manager.post_cell_commit()
+                                                 for name, _ in change.serialized_vars()))
+
+        with mock.patch.object(manager, '_probably_dirty', wraps=manager._probably_dirty) as probably_dirty:
+            _run_cell(manager, lambda ns: [ns['a'], ns['t']])
+            self.assertEqual([], list(manager.post_cell_commit()))
+            probably_dirty.assert_not_called()
+
+        # s is changed through t, the component is compared as a whole
+        _run_cell(manager, lambda ns: ns['t'][0].append(1))
+        changes = list(manager.post_cell_commit())
+        self.assertEqual([('component', ['s', 't'])], [_change_repr(change)[:2] for change in changes])
+
+    def test_cell_analysis(self):
+        manager = _StateManager(_State(), _Serializer(), HashChangeDetector(), cell_analyzer=CellAnalyzer())
+        _run_cell(manager, lambda ns: [ns.__setitem__('a', [1, 2]), ns.__setitem__('b', 'b')])
+        list(manager.post_cell_commit())
+
+        with mock.patch.object(manager, '_probably_dirty', wraps=manager._probably_dirty) as probably_dirty:
+            manager.state.sources = ['print(len(a))\nb']
+            _run_cell(manager, lambda ns: [ns['a'], ns['b']])
+            self.assertEqual([], list(manager.post_cell_commit()))
+            probably_dirty.assert_not_called()
+
+            # a cell which calls anything else falls back to the touched variables
+            manager.state.sources = ['a.append(3)\nb']
+            _run_cell(manager, lambda ns: [ns['a'].append(3), ns['b']])
+            changes = list(manager.post_cell_commit())
+            self.assertEqual({'a', 'b'}, {call.args[0] for call in probably_dirty.call_args_list})
+            self.assertEqual([('component', ['a'])], [_change_repr(change)[:2] for change in changes])
+
+            # displaying a list runs the code of its items
+            probably_dirty.reset_mock()
+            manager.state.sources = ['a']
+            _run_cell(manager, lambda ns: ns['a'])
+            self.assertEqual([], list(manager.post_cell_commit()))
+            self.assertEqual({'a'}, {call.args[0] for call in probably_dirty.call_args_list})